@@ -0,0 +1,165 @@
+"""
+Concurrency benchmark comparing the synchronous DRF endpoints served over
+WSGI with the async endpoints served over ASGI.
+
+Start both servers against the same database, e.g.
+
+    python manage.py runserver 0.0.0.0:8000
+    uvicorn hydroponics.asgi:application --port 8001
+
+and run
+
+    python benchmarks/concurrency.py --username <user> --password <pass> \\
+        --system-name <name> --concurrency 10 100 500
+
+Only the standard library is used, so the script can run anywhere.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+ENDPOINTS = {
+    'last': (
+        'GET',
+        '/api/measurements/last-measurements/'
+        '?system_name={system_name}&num_measurements=10',
+        '/api/async/measurements/last-measurements/'
+        '?system_name={system_name}&num_measurements=10'),
+    'list': (
+        'GET',
+        '/api/measurements/?system={system_id}',
+        '/api/async/measurements/?system={system_id}'),
+    'create': (
+        'POST',
+        '/api/measurements/',
+        '/api/async/measurements/'),
+}
+
+
+def obtain_token(base_url, username, password):
+    request = urllib.request.Request(
+        base_url + '/api/token/',
+        data=json.dumps(
+            {'username': username, 'password': password}).encode(),
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)['access']
+
+
+async def send(url, method, token, body=b'', delay=0.0):
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, parts.port or 80)
+    head = (
+        f'{method} {path} HTTP/1.1\r\n'
+        f'Host: {parts.netloc}\r\n'
+        f'Authorization: Bearer {token}\r\n'
+        'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n'
+        'Connection: close\r\n\r\n').encode()
+    writer.write(head)
+    if delay:
+        # Simulate a slow sensor trickling its request body.
+        await writer.drain()
+        await asyncio.sleep(delay)
+    writer.write(body)
+    await writer.drain()
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    elapsed = time.perf_counter() - started
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        status = 0
+    return status, elapsed
+
+
+async def run(url, method, token, body, concurrency, total, delay):
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            queue.get_nowait()
+            try:
+                status, elapsed = await send(
+                    url, method, token, body, delay)
+            except OSError:
+                errors += 1
+                continue
+            if status >= 400 or status == 0:
+                errors += 1
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+    return latencies, errors, duration
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--wsgi-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--asgi-url', default='http://127.0.0.1:8001')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--system-name', default='')
+    parser.add_argument('--system-id', type=int, default=0)
+    parser.add_argument(
+        '--endpoint', choices=sorted(ENDPOINTS), default='last')
+    parser.add_argument(
+        '--concurrency', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument(
+        '--delay', type=float, default=0.0,
+        help='seconds each client waits before sending its body')
+    args = parser.parse_args()
+
+    token = obtain_token(args.wsgi_url, args.username, args.password)
+    method, sync_path, async_path = ENDPOINTS[args.endpoint]
+    body = b''
+    if method == 'POST':
+        body = json.dumps({
+            'system': args.system_id,
+            'ph': 6.5,
+            'temperature': 25.5,
+            'tds': 800}).encode()
+
+    print(f"{'path':<6} {'conc':>6} {'ok':>7} {'errors':>7} "
+          f"{'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for concurrency in args.concurrency:
+        for label, base_url, path in (
+                ('wsgi', args.wsgi_url, sync_path),
+                ('asgi', args.asgi_url, async_path)):
+            url = base_url + path.format(
+                system_name=args.system_name, system_id=args.system_id)
+            latencies, errors, duration = asyncio.run(run(
+                url, method, token, body,
+                concurrency, args.requests, args.delay))
+            ok = len(latencies) - errors
+            print(f"{label:<6} {concurrency:>6} {ok:>7} {errors:>7} "
+                  f"{len(latencies) / duration:>9.1f} "
+                  f"{statistics.median(latencies or [0]) * 1000:>9.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
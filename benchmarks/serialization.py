@@ -0,0 +1,89 @@
+"""
+Benchmark of the read-only fast path of measurement responses against
+`MeasurementSerializer`.
+
+Both paths start from the rows the database driver returns. The
+serializer path builds model instances like a queryset does and
+represents them with `MeasurementSerializer(many=True)`; the fast path
+builds dicts like a `values()` queryset does and represents them with
+`represent_measurements`. Both are rendered to JSON, and the outputs are
+checked to be identical. No database is needed:
+
+    python benchmarks/serialization.py --rows 100 10000 100000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hydroponics.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+from management.models import Measurement  # noqa: E402
+from management.serializers import (  # noqa: E402
+    MEASUREMENT_VALUES,
+    MeasurementSerializer,
+    represent_measurements)
+
+
+def make_rows(count):
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    return [
+        (index, 1 + index % 10, 6.0 + index % 10 / 10,
+         None if index % 7 == 0 else 25.5, 800.0,
+         start + timedelta(seconds=index, microseconds=index % 1000),
+         f'reading-{index}' if index % 2 else None)
+        for index in range(count)]
+
+
+def serializer_path(rows):
+    measurements = [
+        Measurement.from_db('default', MEASUREMENT_VALUES, row)
+        for row in rows]
+    return JSONRenderer().render(
+        MeasurementSerializer(measurements, many=True).data)
+
+
+def fast_path(rows):
+    values = [dict(zip(MEASUREMENT_VALUES, row)) for row in rows]
+    return JSONRenderer().render(represent_measurements(values))
+
+
+def measure(function, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = function(rows)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'serializer ms':>14} {'fast path ms':>13} "
+          f"{'speedup':>8}")
+    for count in args.rows:
+        rows = make_rows(count)
+        slow, expected = measure(serializer_path, rows, args.repeat)
+        fast, output = measure(fast_path, rows, args.repeat)
+        if output != expected:
+            sys.exit(f"Outputs differ for {count} rows.")
+        print(f"{count:>8} {slow * 1000:>14.1f} {fast * 1000:>13.1f} "
+              f"{slow / fast:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
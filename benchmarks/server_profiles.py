@@ -0,0 +1,77 @@
+"""
+Benchmark of the development server against the production profile
+(gunicorn with persistent database connections and DEBUG off), on the
+same synchronous endpoints.
+
+Start both servers against the same database, e.g.
+
+    python manage.py runserver 0.0.0.0:8000
+    DJANGO_PROFILE=production ALLOWED_HOSTS=127.0.0.1 \\
+        gunicorn hydroponics.wsgi --bind 127.0.0.1:8002
+
+and run
+
+    python benchmarks/server_profiles.py --username <user> \\
+        --password <pass> --system-name <name> --concurrency 10 50
+
+Only the standard library is used, so the script can run anywhere.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+from concurrency import ENDPOINTS, obtain_token, percentile, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--before-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--after-url', default='http://127.0.0.1:8002')
+    parser.add_argument('--username', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--system-name', default='')
+    parser.add_argument('--system-id', type=int, default=0)
+    parser.add_argument(
+        '--endpoint', choices=sorted(ENDPOINTS), default='last')
+    parser.add_argument(
+        '--concurrency', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument(
+        '--warmup', type=int, default=200,
+        help='requests sent before measuring, so that every worker has '
+             'started and opened its database connection')
+    args = parser.parse_args()
+
+    token = obtain_token(args.before_url, args.username, args.password)
+    method, path, _ = ENDPOINTS[args.endpoint]
+    path = path.format(
+        system_name=args.system_name, system_id=args.system_id)
+    body = b''
+    if method == 'POST':
+        body = json.dumps({
+            'system': args.system_id,
+            'ph': 6.5,
+            'temperature': 25.5,
+            'tds': 800}).encode()
+
+    print(f"{'server':<7} {'conc':>6} {'ok':>7} {'errors':>7} "
+          f"{'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for concurrency in args.concurrency:
+        for label, base_url in (
+                ('before', args.before_url),
+                ('after', args.after_url)):
+            asyncio.run(run(
+                base_url + path, method, token, body,
+                concurrency, args.warmup, 0.0))
+            latencies, errors, duration = asyncio.run(run(
+                base_url + path, method, token, body,
+                concurrency, args.requests, 0.0))
+            ok = len(latencies) - errors
+            print(f"{label:<7} {concurrency:>6} {ok:>7} {errors:>7} "
+                  f"{len(latencies) / duration:>9.1f} "
+                  f"{statistics.median(latencies or [0]) * 1000:>9.1f} "
+                  f"{percentile(latencies, 0.99) * 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+"""
+Gunicorn configuration of the production profile, loaded from the
+working directory:
+
+    DJANGO_PROFILE=production gunicorn hydroponics.wsgi
+
+Each worker thread keeps its own database connection open for
+`DB_CONN_MAX_AGE` seconds, so PostgreSQL needs `max_connections` of at
+least `WEB_CONCURRENCY * WEB_THREADS` per server.
+"""
+import multiprocessing
+import os
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:8000')
+workers = int(os.getenv(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4))
+worker_class = 'gthread'
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# Restart workers now and then, so that leaks cannot accumulate.
+max_requests = 10000
+max_requests_jitter = 1000
+accesslog = '-'
@@ -0,0 +1,160 @@
+"""
+JWT authentication without a user query per request.
+
+`CachedJWTAuthentication` resolves the user of a validated token through
+an in-process LRU cache of users by id, whose entries expire after
+`USER_CACHE_TIMEOUT` seconds. Saving or deleting a user evicts it from
+the cache of the process doing it right away; other processes see the
+change once their entry expires, so the timeout bounds how long a
+deactivated user can still be authenticated there.
+
+With `STATELESS_INGEST`, the ingest endpoints authenticate with the
+claims of the token alone, as a simplejwt `TokenUser`, without looking
+up the user at all. A deactivated user can then keep ingesting until
+their access token expires.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import (
+    AuthenticationFailed,
+    InvalidToken)
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+DEFAULT_SETTINGS = {
+    'USER_CACHE_TIMEOUT': 60,
+    'USER_CACHE_MAX_SIZE': 10000,
+    'STATELESS_INGEST': False,
+}
+
+
+def get_jwt_authentication_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'JWT_AUTHENTICATION', {})}
+
+
+class ExpiringLRUCache:
+    """
+    Thread-safe LRU cache of model instances, e.g. users by id, whose
+    entries expire. `get_limits` returns the timeout in seconds and the
+    maximum number of entries. Instances are copied in and out, so
+    requests never share one.
+    """
+
+    def __init__(self, get_limits):
+        self.get_limits = get_limits
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented by every eviction, so that an instance loaded
+        # before it was changed is not stored afterwards.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        timeout = self.get_limits()[0]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > timeout:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return copy.copy(entry[0])
+
+    def put(self, key, instance, generation: int) -> None:
+        """
+        Store `instance`, loaded when the cache was at `generation`,
+        unless an entry was evicted since.
+        """
+        max_size = self.get_limits()[1]
+        if max_size < 1:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (copy.copy(instance), time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        generation = self.generation
+        instance = self.get(key)
+        if instance is None:
+            instance = load(key)
+            self.put(key, instance, generation)
+        return instance
+
+    def evict(self, key) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+def get_user_cache_limits():
+    config = get_jwt_authentication_settings()
+    return config['USER_CACHE_TIMEOUT'], config['USER_CACHE_MAX_SIZE']
+
+
+user_cache = ExpiringLRUCache(get_user_cache_limits)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def evict_changed_user(sender, instance, **kwargs):
+    user_cache.evict(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+def check_user(user, validated_token) -> None:
+    """
+    Run the checks of simplejwt's `JWTAuthentication.get_user` on a
+    user which was not necessarily just loaded.
+    """
+    if not api_settings.USER_AUTHENTICATION_RULE(user):
+        raise AuthenticationFailed(
+            _("User is inactive"), code="user_inactive")
+    if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(
+            api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(
+                user.password):
+        raise AuthenticationFailed(
+            _("The user's password has been changed."),
+            code="password_changed")
+
+
+def get_user_id(validated_token):
+    try:
+        return validated_token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken(
+            _("Token contained no recognizable user identification"))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        user = user_cache.get_or_load(
+            get_user_id(validated_token), self.load_user)
+        check_user(user, validated_token)
+        return user
+
+    def load_user(self, user_id):
+        try:
+            return self.user_model.objects.get(
+                **{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(
+                _("User not found"), code="user_not_found")
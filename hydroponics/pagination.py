@@ -1,6 +1,317 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import b64decode, b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from functools import partial
+from django.core.paginator import EmptyPage, Page, Paginator as DjangoPaginator
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (
+    BasePagination,
+    PageNumberPagination,
+    _positive_int)
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+COUNT_STRATEGIES = ('exact', 'capped', 'estimated')
+
+
+def estimate_count(queryset) -> int:
+    """
+    Return the number of rows the PostgreSQL planner expects `queryset`
+    to return, read from `EXPLAIN` without running the query.
+    """
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+async def aestimate_count(queryset) -> int:
+    plan = json.loads(await queryset.order_by().aexplain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class InexactCountPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class CountStrategyPaginator(DjangoPaginator):
+    """
+    Paginator whose `count` is computed with one of the count strategies:
+
+    `exact` runs a full `COUNT(*)`.
+    `capped` counts at most `count_limit + 1` rows and reports
+    `count_limit` when there are more.
+    `estimated` counts like `capped` and replaces a count over the limit
+    with the planner's estimate, which is never less than `count_limit`.
+
+    `count_type` tells whether the count is `exact`, `capped` or
+    `estimated`. When it is not exact, pages are not validated against
+    it, and whether there is a next page is checked by reading one row
+    past the page.
+    """
+
+    def __init__(
+            self, object_list, per_page,
+            count_strategy: str = 'exact', count_limit: int = 10000,
+            **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_strategy = count_strategy
+        self.count_limit = count_limit
+        self.count_type = None
+
+    @cached_property
+    def count(self):
+        if self.count_strategy == 'exact':
+            self.count_type = 'exact'
+            return self.object_list.count()
+        count = self.object_list[:self.count_limit + 1].count()
+        if count <= self.count_limit:
+            self.count_type = 'exact'
+            return count
+        if self.count_strategy == 'capped':
+            self.count_type = 'capped'
+            return self.count_limit
+        self.count_type = 'estimated'
+        return max(estimate_count(self.object_list), self.count_limit)
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.count_type == 'exact' or int(number) < 1:
+                raise
+            return int(number)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.count_type == 'exact':
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return InexactCountPage(
+            rows[:self.per_page], number, self,
+            has_next=len(rows) > self.per_page)
 
 
 class CustomPageNumberPagination(PageNumberPagination):
+    """
+    Page number pagination with a configurable count strategy, see
+    `CountStrategyPaginator`. The strategy is taken from the `count`
+    query parameter, then from the `count_strategy` attribute of the
+    view, then from the class. Responses report it as `count_type`.
+    """
+
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    count_strategy = 'exact'
+    count_strategy_query_param = 'count'
+    count_limit = 10000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.django_paginator_class = partial(
+            CountStrategyPaginator,
+            count_strategy=self.get_count_strategy(request, view),
+            count_limit=self.count_limit)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_count_strategy(self, request, view):
+        strategy = request.query_params.get(
+            self.count_strategy_query_param)
+        if strategy in COUNT_STRATEGIES:
+            return strategy
+        return getattr(view, 'count_strategy', self.count_strategy)
+
+    def get_paginated_response(self, data):
+        paginator = self.page.paginator
+        return Response({
+            'count': paginator.count,
+            'count_type': paginator.count_type,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['properties']['count_type'] = {
+            'type': 'string',
+            'enum': list(COUNT_STRATEGIES)}
+        return response_schema
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pagination by the position of the last row of a page instead of an
+    offset. A page is selected with a condition on the ordering field and
+    the `id` tie-breaker, and no count is run, so a deep page costs the
+    same as the first one and rows inserted meanwhile do not shift pages.
+
+    The ordering is a single field from the view's `ordering_fields`,
+    optionally prefixed with `-`, and rows with a null value are ordered
+    last in both directions. Rows can be model instances or the dicts of
+    a `values()` queryset which includes the ordering field and `id`.
+    """
+
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
     page_size_query_param = 'page_size'
     max_page_size = 100
+    default_ordering = 'id'
+    invalid_cursor_message = 'Invalid cursor.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(request, view)
+        cursor = self.decode_cursor(request, queryset.model)
+
+        self.reverse = cursor is not None and cursor['previous']
+        if cursor is not None:
+            queryset = queryset.filter(self.position_filter(
+                cursor['value'], cursor['id'], after=not self.reverse))
+        rows = list(
+            queryset.order_by(*self.get_order_by())[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if self.reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.rows = rows
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {
+                    'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema}}
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE
+
+    def get_ordering(self, request, view):
+        """
+        Return the ordering field and whether it is descending. Unknown
+        fields fall back to the default ordering, like `OrderingFilter`.
+        """
+        ordering = request.query_params.get(
+            self.ordering_query_param, self.default_ordering).strip()
+        field = ordering.lstrip('-')
+        if field != 'id' and field not in getattr(
+                view, 'ordering_fields', []):
+            ordering = self.default_ordering
+            field = ordering.lstrip('-')
+        return field, ordering.startswith('-')
+
+    def get_order_by(self):
+        descending = self.descending != self.reverse
+        # Nulls are last in the page order, so first when reversed.
+        nulls = {'nulls_first': True} if self.reverse else {
+            'nulls_last': True}
+        order_by = [
+            F(self.field).desc(**nulls) if descending
+            else F(self.field).asc(**nulls)]
+        if self.field != 'id':
+            order_by.append(F('id').desc() if descending else F('id').asc())
+        return order_by
+
+    def position_filter(self, value, pk, after):
+        """
+        Condition selecting the rows ordered after, or before, the row
+        whose ordering value and id are `value` and `pk`.
+        """
+        lookup = 'lt' if self.descending == after else 'gt'
+        by_id = Q(**{f'id__{lookup}': pk})
+        if self.field == 'id':
+            return by_id
+        if value is None:
+            condition = Q(**{f'{self.field}__isnull': True}) & by_id
+            if not after:
+                condition |= Q(**{f'{self.field}__isnull': False})
+            return condition
+        condition = (
+            Q(**{f'{self.field}__{lookup}': value})
+            | Q(**{self.field: value}) & by_id)
+        if after:
+            condition |= Q(**{f'{self.field}__isnull': True})
+        return condition
+
+    def encode_cursor(self, row, previous):
+        if isinstance(row, dict):
+            value, pk = row[self.field], row['id']
+        else:
+            value, pk = getattr(row, self.field), row.pk
+        position = {
+            'ordering': ('-' if self.descending else '') + self.field,
+            'value': value,
+            'id': pk,
+            'previous': previous}
+        # Timestamps keep their microseconds, so ties are split exactly.
+        encoded = b64encode(
+            json.dumps(position, default=datetime.isoformat).encode()
+        ).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            encoded)
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(b64decode(encoded, validate=True))
+            ordering = ('-' if self.descending else '') + self.field
+            if position['ordering'] != ordering:
+                raise ValueError()
+            value = position['value']
+            if value is not None:
+                value = model._meta.get_field(self.field).to_python(value)
+            return {
+                'value': value,
+                'id': int(position['id']),
+                'previous': bool(position['previous'])}
+        except (BinasciiError, KeyError, TypeError, ValueError,
+                ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if not self.rows:
+            return remove_query_param(
+                self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.rows[-1], previous=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.rows:
+            return remove_query_param(
+                self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.rows[0], previous=True)
@@ -0,0 +1,114 @@
+"""
+Query budgets of API views.
+
+A budget is the largest number of database queries one request to a
+view action may run, whatever the number of rows involved, so that an
+N+1 pattern shows up as a violation instead of a slow endpoint. Budgets
+of extra viewset actions are declared with the `query_budget` decorator,
+and those of the standard actions (`list`, `retrieve`, ...) and of plain
+views (`get`, `post`, ...) in the `query_budgets` attribute of the view
+class. Actions whose queries grow with their input by design, one per
+chunk of a streamed upload for example, declare the `UNLIMITED` budget.
+
+`QueryBudgetMiddleware` counts the queries of every request to a view
+with a budget and logs or raises `QueryBudgetExceeded` when the budget
+is exceeded, see the `QUERY_BUDGET` setting.
+"""
+import logging
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'ENABLED': False,
+    'RAISE': False,
+}
+
+UNLIMITED = float('inf')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def get_query_budget_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'QUERY_BUDGET', {})}
+
+
+def query_budget(max_queries: int):
+    """
+    Declare the query budget of a view action or handler.
+    """
+    def decorator(function):
+        function.query_budget = max_queries
+        return function
+    return decorator
+
+
+def get_query_budget(view_class, name: str):
+    """
+    Return the budget of the action or handler `name` of `view_class`,
+    or `None` when it has none.
+    """
+    budgets = getattr(view_class, 'query_budgets', {})
+    if name in budgets:
+        return budgets[name]
+    return getattr(getattr(view_class, name, None), 'query_budget', None)
+
+
+def get_view_action(view_func, method: str):
+    """
+    Return the view class and the name of the action or handler which
+    `view_func`, as returned by `as_view()`, runs for `method`.
+    """
+    # Viewsets only set `cls`, other views set `view_class` too.
+    view_class = getattr(
+        view_func, 'cls', getattr(view_func, 'view_class', None))
+    if view_class is None:
+        return None, None
+    actions = getattr(view_func, 'actions', None)
+    if actions is not None:
+        return view_class, actions.get(method.lower())
+    return view_class, method.lower()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, get_response):
+        config = get_query_budget_settings()
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and len(counter.queries) > budget:
+            message = (
+                f"{request.method} {request.path} ran "
+                f"{len(counter.queries)} queries, its budget is {budget}:\n"
+                + "\n".join(counter.queries))
+            if get_query_budget_settings()['RAISE']:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class, name = get_view_action(view_func, request.method)
+        if name is not None:
+            request.query_budget = get_query_budget(view_class, name)
@@ -27,10 +27,18 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('SECRET_KEY')
 
+# Settings profile: 'development' (default) or 'production', which
+# turns DEBUG off and keeps database connections open between requests.
+# See gunicorn.conf.py for the application server of the production
+# profile.
+PROFILE = os.getenv('DJANGO_PROFILE', 'development')
+PRODUCTION = PROFILE == 'production'
+
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = not PRODUCTION
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [
+    host for host in os.getenv('ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -57,8 +65,17 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'hydroponics.query_budget.QueryBudgetMiddleware',
 ]
 
+# Query budgets of API views, see hydroponics/query_budget.py. Requests
+# exceeding the budget of their view are logged, or raise when RAISE is
+# set.
+QUERY_BUDGET = {
+    'ENABLED': DEBUG,
+    'RAISE': False,
+}
+
 ROOT_URLCONF = 'hydroponics.urls'
 
 TEMPLATES = [
@@ -91,12 +108,19 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('POSTGRES_HOST'),
         'PORT': '5432',
+        # Seconds a connection is reused by the requests of one thread
+        # instead of being opened per request; checked before reuse.
+        # Keep it at 0 under ASGI, where requests do not run in
+        # long-lived threads.
+        'CONN_MAX_AGE': int(os.getenv(
+            'DB_CONN_MAX_AGE', 600 if PRODUCTION else 0)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'hydroponics.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ],
@@ -111,6 +135,77 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
 }
 
+# Resolution of the users of JWT authenticated requests, see
+# hydroponics/authentication.py for the meaning of each option.
+JWT_AUTHENTICATION = {
+    'USER_CACHE_TIMEOUT': 60,
+    'USER_CACHE_MAX_SIZE': 10000,
+    'STATELESS_INGEST': os.getenv('STATELESS_INGEST') == 'true',
+}
+
+# Lookup of the device keys sensors ingest with, see
+# management/device_keys.py for the meaning of each option.
+DEVICE_KEYS = {
+    'CACHE_TIMEOUT': 60,
+    'CACHE_MAX_SIZE': 10000,
+}
+
+# Write-behind buffering of created measurements,
+# see management/buffer.py for the meaning of each option.
+MEASUREMENT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('MEASUREMENT_WRITE_BEHIND') == 'true',
+    'MAX_SIZE': 10000,
+    'BATCH_SIZE': 1000,
+    'MAX_LAG': 1.0,
+    'PUT_TIMEOUT': 0.0,
+    'FLUSH_ON_SHUTDOWN': True,
+    'MAX_RETRIES': 3,
+    'RETRY_BACKOFF': 0.5,
+}
+
+# Default retention of measurements and of their hourly and daily
+# rollups, in days; None keeps them forever. Systems can override it
+# with a retention policy, see management/retention.py.
+MEASUREMENT_RETENTION = {
+    'RAW_DAYS': None,
+    'HOURLY_DAYS': None,
+    'DAILY_DAYS': None,
+    'BATCH_SIZE': 10000,
+}
+
+# Caches. The response cache needs a cache shared by all processes
+# serving the API, e.g. django.core.cache.backends.redis.RedisCache or
+# memcached, when more than one process is run.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+# Caching of the responses of read endpoints, see
+# management/response_cache.py for the meaning of each option.
+RESPONSE_CACHE = {
+    'ENABLED': os.getenv('RESPONSE_CACHE') == 'true',
+    'CACHE': 'default',
+    'TIMEOUT': 60,
+    'LOCK_TIMEOUT': 10,
+    'LOCK_WAIT': 5.0,
+}
+
+# SQL is only logged with DEBUG on, never in production.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'loggers': {
+        'django.db.backends': {
+            'level': 'DEBUG' if DEBUG else 'WARNING',
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
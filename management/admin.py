@@ -1,5 +1,28 @@
 from django.contrib import admin
-from .models import HydroponicSystem, Measurement
+from .models import (
+    DeviceKey,
+    HydroponicSystem,
+    Measurement,
+    RetentionPolicy,
+    SystemCurrentState)
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """
+    Admin of rows which are written together with the current state,
+    rollups and cached responses of their systems, see
+    `management.state`. Saving them here would bypass those, so they
+    are changed through the API only.
+    """
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 class HydroponicSystemAdmin(admin.ModelAdmin):
@@ -17,7 +40,7 @@ class HydroponicSystemAdmin(admin.ModelAdmin):
         ('updated_at', admin.DateFieldListFilter)]
 
 
-class MeasurementAdmin(admin.ModelAdmin):
+class MeasurementAdmin(ReadOnlyAdmin):
     list_display = [
         'id',
         'system',
@@ -31,6 +54,47 @@ class MeasurementAdmin(admin.ModelAdmin):
         ('timestamp', admin.DateFieldListFilter)]
 
 
+class SystemCurrentStateAdmin(ReadOnlyAdmin):
+    list_display = [
+        'system',
+        'ph',
+        'temperature',
+        'tds',
+        'timestamp',
+        'reading_count',
+        'last_seen']
+    readonly_fields = [
+        'ph',
+        'temperature',
+        'tds',
+        'timestamp',
+        'reading_count',
+        'last_seen']
+
+
+class RetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = [
+        'system',
+        'raw_days',
+        'hourly_days',
+        'daily_days']
+
+
+class DeviceKeyAdmin(admin.ModelAdmin):
+    list_display = [
+        'id',
+        'system',
+        'name',
+        'prefix',
+        'created_at']
+    readonly_fields = ['system', 'prefix', 'key_hash', 'created_at']
+    list_filter = ['system']
+
+    def has_add_permission(self, request):
+        # The secret is only shown once, see the create_device_key command.
+        return False
+
+
 admin.site.register(
     HydroponicSystem,
     HydroponicSystemAdmin)
@@ -38,3 +102,15 @@ admin.site.register(
 admin.site.register(
     Measurement,
     MeasurementAdmin)
+
+admin.site.register(
+    SystemCurrentState,
+    SystemCurrentStateAdmin)
+
+admin.site.register(
+    RetentionPolicy,
+    RetentionPolicyAdmin)
+
+admin.site.register(
+    DeviceKey,
+    DeviceKeyAdmin)
@@ -0,0 +1,176 @@
+"""
+Time-bucketed aggregation of measurements, computed in SQL.
+
+Buckets are either a calendar unit (`minute`, `hour`, `day`), truncated
+with `date_trunc` in the current time zone, or a custom interval such as
+`15m`, `6h` or `2d`, aligned to the Unix epoch. `date_bin` would do the
+latter but needs PostgreSQL 14, so the epoch is floored instead.
+
+Buckets of whole hours or days can also be combined from the hourly and
+daily rollups, see `management.rollups`, which is much cheaper than
+scanning the measurements over long ranges.
+"""
+import math
+import re
+from datetime import timedelta, timezone as dt_timezone
+from functools import partial
+from django.db.models import (
+    Avg,
+    Count,
+    DateTimeField,
+    F,
+    Func,
+    Max,
+    Min,
+    StdDev,
+    Sum)
+from django.db.models.functions import Extract, Floor, Trunc
+from django.utils import timezone
+from .models import (
+    METRIC_FIELDS,
+    DailyMeasurementRollup,
+    HourlyMeasurementRollup)
+
+BUCKET_UNITS = ('minute', 'hour', 'day')
+INTERVAL_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+INTERVAL_RE = re.compile(r'^(\d+)([smhd])$')
+MIN_INTERVAL_SECONDS = 1
+MAX_INTERVAL_SECONDS = 366 * 86400
+
+AGGREGATES = {
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+    'stddev': partial(StdDev, sample=True),
+    'count': Count}
+
+
+class ToTimestamp(Func):
+    function = 'to_timestamp'
+    output_field = DateTimeField()
+
+
+def parse_bucket(value):
+    """
+    Return the calendar unit or the number of seconds of a bucket
+    parameter, or `None` when it is not a valid bucket.
+    """
+    if value in BUCKET_UNITS:
+        return value
+    return parse_interval(value)
+
+
+def parse_interval(value):
+    """
+    Return the number of seconds of an interval such as 15m, 6h or 2d,
+    or `None` when it is not a valid interval.
+    """
+    match = INTERVAL_RE.match(value or '')
+    if match is None:
+        return None
+    seconds = int(match.group(1)) * INTERVAL_SECONDS[match.group(2)]
+    if not MIN_INTERVAL_SECONDS <= seconds <= MAX_INTERVAL_SECONDS:
+        return None
+    return seconds
+
+
+def bucket_expression(bucket, field: str = 'timestamp'):
+    """
+    Return the expression mapping `field` to the start of its bucket.
+    """
+    if bucket in BUCKET_UNITS:
+        return Trunc(field, bucket)
+    return ToTimestamp(
+        Floor(Extract(field, 'epoch', tzinfo=dt_timezone.utc) / bucket)
+        * bucket)
+
+
+def aggregate_by_bucket(queryset, bucket):
+    """
+    Group measurements by system and bucket, and compute the aggregates
+    of every metric. Rows are ordered by system and bucket start.
+    """
+    return queryset.order_by().annotate(
+        bucket=bucket_expression(bucket),
+    ).values('system_id', 'bucket').annotate(**{
+        f'{name}_{metric}': aggregate(F(metric))
+        for metric in METRIC_FIELDS
+        for name, aggregate in AGGREGATES.items()
+    }).order_by('system_id', 'bucket')
+
+
+def format_bucket(row) -> dict:
+    return {
+        'system': row['system_id'],
+        'bucket': row['bucket'],
+        **{metric: {
+            name: row[f'{name}_{metric}'] for name in AGGREGATES}
+           for metric in METRIC_FIELDS}}
+
+
+def rollup_model_for(bucket):
+    """
+    Return the rollup model whose buckets add up to `bucket`, or `None`
+    when the bucket is finer than an hour, or not aligned to the hours
+    of the current time zone.
+    """
+    if isinstance(bucket, int):
+        # Intervals are aligned to the epoch, whatever the time zone.
+        if bucket % 86400 == 0:
+            return DailyMeasurementRollup
+        if bucket % 3600 == 0:
+            return HourlyMeasurementRollup
+        return None
+    # Rollups are aligned to UTC hours and days.
+    if bucket == 'day' and timezone.get_current_timezone_name() == 'UTC':
+        return DailyMeasurementRollup
+    if bucket in ('hour', 'day') and (
+            timezone.localtime().utcoffset() % timedelta(hours=1)
+            == timedelta(0)):
+        return HourlyMeasurementRollup
+    return None
+
+
+def aggregate_rollups(queryset, bucket):
+    """
+    Combine rollups into buckets, like `aggregate_by_bucket` does with
+    measurements. Averages and standard deviations are derived from the
+    sums by `format_rollup_bucket`.
+    """
+    return queryset.order_by().annotate(
+        period=bucket_expression(bucket, 'bucket'),
+    ).values('system_id', 'period').annotate(**{
+        f'{name}_{metric}': aggregate(f'{metric}_{name}')
+        for metric in METRIC_FIELDS
+        for name, aggregate in (
+            ('count', Sum),
+            ('sum', Sum),
+            ('sum_squares', Sum),
+            ('min', Min),
+            ('max', Max))
+    }).order_by('system_id', 'period')
+
+
+def format_rollup_bucket(row) -> dict:
+    metrics = {}
+    for metric in METRIC_FIELDS:
+        count = row[f'count_{metric}']
+        total = row[f'sum_{metric}']
+        avg = stddev = None
+        if count:
+            avg = total / count
+        if count > 1:
+            variance = (
+                row[f'sum_squares_{metric}'] - total * total / count
+            ) / (count - 1)
+            stddev = math.sqrt(max(variance, 0))
+        metrics[metric] = {
+            'min': row[f'min_{metric}'],
+            'max': row[f'max_{metric}'],
+            'avg': avg,
+            'stddev': stddev,
+            'count': count}
+    return {
+        'system': row['system_id'],
+        'bucket': row['period'],
+        **metrics}
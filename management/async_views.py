@@ -0,0 +1,311 @@
+"""
+Async variants of the measurement create, list and last-measurements
+endpoints. They use Django's async ORM end to end, so when served by an
+ASGI server a single worker can hold many slow sensor connections. The
+insert of a created measurement, which also updates the current state
+of its system, runs in a thread like the async ORM queries do.
+"""
+import json
+import math
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.authentication import get_authorization_header
+from rest_framework.pagination import _positive_int
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from rest_framework_simplejwt.authentication import (
+    JWTAuthentication,
+    JWTStatelessUserAuthentication)
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from hydroponics.authentication import (
+    check_user,
+    get_jwt_authentication_settings,
+    get_user_id,
+    user_cache)
+from hydroponics.pagination import (
+    COUNT_STRATEGIES,
+    CustomPageNumberPagination,
+    aestimate_count)
+from .device_keys import (
+    DeviceUser,
+    parse_device_key_header,
+    verify_device_key)
+from .filters import MeasurementFilter
+from .ingest import clean_measurement
+from .models import DeviceKey, HydroponicSystem, Measurement
+from .serializers import (
+    MeasurementSerializer,
+    measurement_values,
+    represent_measurements)
+from .state import save_measurements
+from .utils import parse_system_id
+
+PAGE_SIZE = 10
+
+jwt_authentication = JWTAuthentication()
+stateless_authentication = JWTStatelessUserAuthentication()
+
+
+async def authenticate(request, stateless: bool = False):
+    """
+    Resolve the user from the JWT in the request headers, through the
+    user cache of `hydroponics.authentication` and the async ORM, or
+    from the token claims alone when `stateless`. Returns `None` when no
+    token was sent, and raises the simplejwt exceptions for invalid
+    tokens.
+    """
+    header = jwt_authentication.get_header(request)
+    if header is None:
+        return None
+    raw_token = jwt_authentication.get_raw_token(header)
+    if raw_token is None:
+        return None
+    validated_token = jwt_authentication.get_validated_token(raw_token)
+    if stateless:
+        return stateless_authentication.get_user(validated_token)
+
+    user_id = get_user_id(validated_token)
+    generation = user_cache.generation
+    user = user_cache.get(user_id)
+    if user is None:
+        try:
+            user = await User.objects.aget(
+                **{api_settings.USER_ID_FIELD: user_id})
+        except User.DoesNotExist:
+            raise AuthenticationFailed("User not found")
+        user_cache.put(user_id, user, generation)
+    check_user(user, validated_token)
+    return user
+
+
+def error_response(detail, status):
+    return JsonResponse({"error": detail}, status=status)
+
+
+async def authenticate_device(request):
+    """
+    Return the device key of an `Authorization: Device <key>` header, or
+    `None` when another scheme is used. Raises `AuthenticationFailed`
+    for invalid keys.
+    """
+    key = parse_device_key_header(get_authorization_header(request))
+    if key is None:
+        return None
+    device_key = await sync_to_async(verify_device_key)(key)
+    if device_key is None:
+        raise exceptions.AuthenticationFailed("Invalid device key.")
+    return device_key
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAuthenticatedView(View):
+    # Methods which only need the id of the user, and can authenticate
+    # it from the token claims with `STATELESS_INGEST` or with a device
+    # key.
+    ingest_methods = ()
+
+    async def dispatch(self, request, *args, **kwargs):
+        ingest = request.method.lower() in self.ingest_methods
+        stateless = (
+            ingest and get_jwt_authentication_settings()['STATELESS_INGEST'])
+        try:
+            request.auth = None
+            if ingest:
+                request.auth = await authenticate_device(request)
+            if request.auth is not None:
+                request.user = DeviceUser(request.auth)
+            else:
+                request.user = await authenticate(request, stateless)
+        except exceptions.AuthenticationFailed as exc:
+            detail = exc.detail
+            if isinstance(detail, dict):
+                detail = detail.get('detail', detail)
+            return JsonResponse({"detail": detail}, status=401)
+        if request.user is None:
+            return JsonResponse({
+                "detail": "Authentication credentials were not provided."},
+                status=401)
+        return await super().dispatch(request, *args, **kwargs)
+
+
+def unsupported_list_params(params) -> list:
+    """
+    Return the parameters of `params` selecting list modes of
+    `/api/measurements/` which the async list does not have.
+    """
+    unsupported = []
+    if 'downsample' in params:
+        unsupported.append('downsample')
+    if params.get('pagination') == 'keyset':
+        unsupported.append('pagination')
+    if params.get('format', 'json') != 'json':
+        unsupported.append('format')
+    return unsupported
+
+
+async def count_rows(queryset, count_strategy):
+    """
+    Return the number of rows of `queryset` and whether it is `exact`,
+    `capped` or `estimated`, like `CountStrategyPaginator` does.
+    """
+    count_limit = CustomPageNumberPagination.count_limit
+    if count_strategy == 'exact':
+        return await queryset.acount(), 'exact'
+    count = await queryset[:count_limit + 1].acount()
+    if count <= count_limit:
+        return count, 'exact'
+    if count_strategy == 'capped':
+        return count_limit, 'capped'
+    return max(await aestimate_count(queryset), count_limit), 'estimated'
+
+
+class AsyncMeasurementView(AsyncAuthenticatedView):
+    # The user, the count, the planner estimate of counts over the
+    # limit, and the page.
+    query_budgets = {'get': 4, 'post': 3}
+    ingest_methods = ('post',)
+    # Like `MeasurementViewSet`.
+    count_strategy = 'estimated'
+
+    async def get(self, request):
+        """
+        Accepts the filters, `count`, `page` and `page_size` parameters
+        of the page number pagination of `/api/measurements/`, and
+        returns the same results.
+        """
+        unsupported = unsupported_list_params(request.GET)
+        if unsupported:
+            return error_response(
+                f"{', '.join(unsupported)} is not supported by the async "
+                f"list, use /api/measurements/.", 400)
+
+        queryset = Measurement.objects.filter(
+            system__owner=request.user).order_by('id')
+        if 'system' in request.GET:
+            system_id = parse_system_id(request.GET['system'])
+            if system_id is None:
+                return error_response(
+                    "system must be an integer.", 400)
+            queryset = queryset.filter(system_id=system_id)
+
+        # The system was filtered above, without looking it up.
+        params = request.GET.copy()
+        params.pop('system', None)
+        filterset = MeasurementFilter(params, queryset=queryset)
+        if not filterset.is_valid():
+            return JsonResponse(filterset.errors, status=400)
+
+        try:
+            page_size = _positive_int(
+                request.GET['page_size'], strict=True,
+                cutoff=CustomPageNumberPagination.max_page_size)
+        except (KeyError, ValueError):
+            page_size = PAGE_SIZE
+        count_strategy = request.GET.get('count')
+        if count_strategy not in COUNT_STRATEGIES:
+            count_strategy = self.count_strategy
+
+        count, count_type = await count_rows(filterset.qs, count_strategy)
+        num_pages = max(math.ceil(count / page_size), 1)
+        page = request.GET.get('page', 1)
+        if page in CustomPageNumberPagination.last_page_strings:
+            page = num_pages
+        try:
+            page = int(page)
+        except ValueError:
+            page = 0
+        # Pages past an inexact count are read until they are empty.
+        if page < 1 or (count_type == 'exact' and page > num_pages):
+            return JsonResponse({"detail": "Invalid page."}, status=404)
+
+        offset = (page - 1) * page_size
+        rows = [
+            row async for row in measurement_values(filterset.qs)[
+                offset:offset + page_size + (count_type != 'exact')]]
+        if count_type == 'exact':
+            has_next = page < num_pages
+        else:
+            has_next = len(rows) > page_size
+            rows = rows[:page_size]
+
+        url = request.build_absolute_uri()
+        next_url = None
+        if has_next:
+            next_url = replace_query_param(url, 'page', page + 1)
+        previous_url = None
+        if page == 2:
+            previous_url = remove_query_param(url, 'page')
+        elif page > 2:
+            previous_url = replace_query_param(url, 'page', page - 1)
+
+        return JsonResponse({
+            "count": count,
+            "count_type": count_type,
+            "next": next_url,
+            "previous": previous_url,
+            "results": represent_measurements(rows)})
+
+    async def post(self, request):
+        try:
+            row = json.loads(request.body)
+        except ValueError:
+            return error_response("Invalid JSON.", 400)
+
+        system_id = parse_system_id(
+            row.get('system') if isinstance(row, dict) else None)
+        if isinstance(request.auth, DeviceKey):
+            # A device key can only write to its own system.
+            owned = system_id == request.auth.system_id
+        else:
+            owned = system_id is not None and await (
+                HydroponicSystem.objects.filter(
+                    id=system_id, owner_id=request.user.pk).aexists())
+        owned_system_ids = {system_id} if owned else set()
+
+        try:
+            measurement = clean_measurement(row, owned_system_ids)
+        except ValidationError as error:
+            return JsonResponse(error.message_dict, status=400)
+
+        inserted = await sync_to_async(save_measurements)([measurement])
+        if inserted:
+            measurement = inserted[0]
+        else:
+            measurement = await Measurement.objects.filter(
+                system_id=measurement.system_id,
+                idempotency_key=measurement.idempotency_key).order_by(
+                    'id').afirst()
+
+        return JsonResponse(
+            MeasurementSerializer(measurement).data, status=201)
+
+
+class AsyncLastMeasurementsView(AsyncAuthenticatedView):
+    # The user, the measurements, and the system when there are none.
+    query_budgets = {'get': 3}
+
+    async def get(self, request):
+        system_name = request.GET.get('system_name')
+        try:
+            num_measurements = int(request.GET.get('num_measurements', 10))
+        except ValueError:
+            return error_response(
+                "num_measurements must be an integer.", 400)
+
+        queryset = measurement_values(Measurement.objects.filter(
+            system__name=system_name,
+            system__owner=request.user).order_by(
+                '-timestamp', '-id'))[:max(num_measurements, 0)]
+        results = represent_measurements([row async for row in queryset])
+
+        if not results and not await HydroponicSystem.objects.filter(
+                name=system_name, owner=request.user).aexists():
+            return error_response(
+                "System not found or you do not have permission.", 404)
+        return JsonResponse(results, safe=False)
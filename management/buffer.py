@@ -0,0 +1,266 @@
+"""
+Write-behind buffering of created measurements.
+
+When enabled with the `MEASUREMENT_WRITE_BEHIND` setting, validated
+measurements are acknowledged right away and queued in a bounded
+in-process buffer. A background thread writes them in batches with
+PostgreSQL `COPY FROM STDIN` once `BATCH_SIZE` readings are queued or
+at the latest every `MAX_LAG` seconds.
+
+Durability: readings which are queued but not yet written are lost if
+the process dies. `MAX_LAG` bounds that window, and with
+`FLUSH_ON_SHUTDOWN` the buffer is drained when the interpreter exits
+normally. When the buffer is full, `put` waits up to `PUT_TIMEOUT`
+seconds and then raises `BufferFull`, so that clients can back off.
+
+A batch failing on a lost connection or another transient database
+error is retried up to `MAX_RETRIES` times, waiting `RETRY_BACKOFF`
+seconds, doubled after every attempt. A batch violating a constraint,
+e.g. because a system was deleted while its readings were queued, or
+holding invalid data, is written one reading at a time, so only the
+offending readings are dropped. A batch failing with any other error is
+dropped. Dropped readings are logged and counted in `stats`, and the
+flusher keeps running.
+"""
+import atexit
+import csv
+import io
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.db import (
+    DataError,
+    IntegrityError,
+    InterfaceError,
+    OperationalError,
+    connection,
+    transaction)
+from .models import Measurement
+from .response_cache import invalidate
+from .state import (
+    INSERT_COLUMNS,
+    RETURNING_COLUMNS,
+    insert_measurements_sql)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    'ENABLED': False,
+    'MAX_SIZE': 10000,
+    'BATCH_SIZE': 1000,
+    'MAX_LAG': 1.0,
+    'PUT_TIMEOUT': 0.0,
+    'FLUSH_ON_SHUTDOWN': True,
+    'MAX_RETRIES': 3,
+    'RETRY_BACKOFF': 0.5,
+}
+
+
+class BufferFull(Exception):
+    pass
+
+
+def get_write_behind_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'MEASUREMENT_WRITE_BEHIND', {})}
+
+
+def copy_measurements(measurements) -> None:
+    """
+    Write unsaved measurements with a single `COPY FROM STDIN` into a
+    staging table, and move them into the measurement table with the
+    statement which also updates the current state of their systems.
+    Duplicate idempotency keys are skipped.
+    """
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for measurement in measurements:
+        writer.writerow([
+            measurement.system_id,
+            measurement.ph,
+            measurement.temperature,
+            measurement.tds,
+            measurement.timestamp.isoformat(),
+            measurement.idempotency_key])
+    data.seek(0)
+
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    columns = ', '.join(quote_name(column) for column in INSERT_COLUMNS)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE measurement_staging '
+            f'ON COMMIT DROP AS SELECT {columns} FROM {table} '
+            f'WITH NO DATA')
+        cursor.copy_expert(
+            f'COPY measurement_staging ({columns}) '
+            f'FROM STDIN WITH (FORMAT csv)',
+            data)
+        cursor.execute(insert_measurements_sql(
+            f'SELECT {columns} FROM measurement_staging'))
+        system_index = RETURNING_COLUMNS.index('system_id')
+        invalidate(row[system_index] for row in cursor.fetchall())
+        cursor.execute('DROP TABLE measurement_staging')
+
+
+class MeasurementBuffer:
+    def __init__(
+            self,
+            max_size: int = DEFAULT_SETTINGS['MAX_SIZE'],
+            batch_size: int = DEFAULT_SETTINGS['BATCH_SIZE'],
+            max_lag: float = DEFAULT_SETTINGS['MAX_LAG'],
+            put_timeout: float = DEFAULT_SETTINGS['PUT_TIMEOUT'],
+            flush_on_shutdown: bool = DEFAULT_SETTINGS['FLUSH_ON_SHUTDOWN'],
+            max_retries: int = DEFAULT_SETTINGS['MAX_RETRIES'],
+            retry_backoff: float = DEFAULT_SETTINGS['RETRY_BACKOFF']):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.max_lag = max_lag
+        self.put_timeout = put_timeout
+        self.flush_on_shutdown = flush_on_shutdown
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'written': 0,
+            'retried': 0,
+            'dropped': 0}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def put(self, measurement: Measurement) -> None:
+        try:
+            self.queue.put(measurement, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            raise BufferFull()
+        self.stats['accepted'] += 1
+        if self.queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """
+        Write all queued measurements in the calling thread and return
+        how many were written.
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return written
+                count = self.write(batch)
+                self.stats['written'] += count
+                self.stats['dropped'] += len(batch) - count
+                written += count
+
+    def write(self, batch, split: bool = True) -> int:
+        """
+        Write a batch, retrying transient errors, and return how many
+        measurements were written. When the batch holds invalid
+        readings, it is written one reading at a time if `split`, and
+        dropped otherwise.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                copy_measurements(batch)
+                return len(batch)
+            except (IntegrityError, DataError):
+                if split and len(batch) > 1:
+                    return self.write_each(batch)
+                logger.exception(
+                    "Dropped %d buffered measurements of system %s.",
+                    len(batch), ', '.join(sorted({
+                        str(measurement.system_id)
+                        for measurement in batch})))
+                return 0
+            except (OperationalError, InterfaceError):
+                if attempt == self.max_retries:
+                    logger.exception(
+                        "Dropped %d buffered measurements after %d "
+                        "attempts.", len(batch), attempt + 1)
+                    return 0
+                logger.warning(
+                    "Writing %d buffered measurements failed, retrying.",
+                    len(batch), exc_info=True)
+                self.stats['retried'] += 1
+                # Reconnect when the connection was lost, unless the
+                # caller holds a transaction open on it.
+                if not connection.in_atomic_block:
+                    connection.close_if_unusable_or_obsolete()
+                time.sleep(self.retry_backoff * 2 ** attempt)
+            except Exception:
+                logger.exception(
+                    "Dropped %d buffered measurements.", len(batch))
+                return 0
+
+    def write_each(self, batch) -> int:
+        return sum(
+            self.write([measurement], split=False) for measurement in batch)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run,
+            name='measurement-write-behind',
+            daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.flush_on_shutdown:
+            self.flush()
+        logger.info("Measurement buffer stopped: %s", self.stats)
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.max_lag)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing the measurement buffer failed.")
+            finally:
+                connection.close_if_unusable_or_obsolete()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_measurement_buffer():
+    """
+    Return the process wide buffer, starting its flusher on first use,
+    or `None` when write-behind mode is disabled.
+    """
+    global _buffer
+    config = get_write_behind_settings()
+    if not config['ENABLED']:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = MeasurementBuffer(
+                max_size=config['MAX_SIZE'],
+                batch_size=config['BATCH_SIZE'],
+                max_lag=config['MAX_LAG'],
+                put_timeout=config['PUT_TIMEOUT'],
+                flush_on_shutdown=config['FLUSH_ON_SHUTDOWN'],
+                max_retries=config['MAX_RETRIES'],
+                retry_backoff=config['RETRY_BACKOFF'])
+            _buffer.start()
+    return _buffer
@@ -0,0 +1,92 @@
+"""
+Conditional GET of the measurement and hydroponic system endpoints.
+
+Responses carry an `ETag` derived from one aggregate query over the
+systems they depend on: their ids, when they were last updated, and the
+change counter and time of their current state, which every write of
+their readings updates, see `management.state`. Requests whose
+`If-None-Match` or `If-Modified-Since` header still matches are answered
+with 304 Not Modified before the response is built, serialized or
+rendered.
+
+Only responses about a single object also carry a `Last-Modified`
+header. The time the systems last changed does not move forward when one
+of them is deleted, so for responses listing several systems it could
+answer `If-Modified-Since` with 304 although the list changed. Without
+`Last-Modified` those are always answered in full, unless their `ETag`
+is sent back.
+"""
+import functools
+import hashlib
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import CharField, Max, Value
+from django.db.models.functions import MD5, Cast, Coalesce, Concat
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from .models import HydroponicSystem
+
+
+def get_validators(user, system_ids=None):
+    """
+    Return a fingerprint of the systems of `user`, or of those among
+    `system_ids`, and of their readings, and when they last changed.
+    """
+    systems = HydroponicSystem.objects.filter(owner=user)
+    if system_ids is not None:
+        systems = systems.filter(pk__in=system_ids)
+    state = systems.aggregate(
+        digest=MD5(StringAgg(
+            Concat(
+                Cast('pk', CharField()),
+                Value(':'),
+                Cast(Coalesce('current_state__version', 0), CharField())),
+            ',',
+            ordering='pk')),
+        updated_at=Max('updated_at'),
+        changed_at=Max('current_state__changed_at'))
+    last_modified = max(
+        (value for value in (state['updated_at'], state['changed_at'])
+         if value is not None),
+        default=None)
+    return (state['digest'], state['updated_at']), last_modified
+
+
+def conditional_response(scope=None, last_modified=True):
+    """
+    Answer conditional requests to a read-only view method with 304 Not
+    Modified when nothing it depends on changed. `scope`, when given, is
+    called with the request and returns the ids of the systems the
+    response depends on, or `None` for all systems of the user.
+    `last_modified` is false for responses listing several systems,
+    which are validated with their `ETag` only.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            fingerprint, modified_at = get_validators(
+                request.user,
+                scope(request) if scope is not None else None)
+            etag = quote_etag(hashlib.sha256(repr((
+                request.build_absolute_uri(),
+                request.accepted_media_type,
+                request.user.pk,
+                fingerprint,
+            )).encode()).hexdigest()[:32])
+            modified_at = (
+                int(modified_at.timestamp())
+                if last_modified and modified_at is not None else None)
+
+            response = get_conditional_response(
+                request._request, etag=etag, last_modified=modified_at)
+            if response is None:
+                response = method(view, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response['ETag'] = etag
+            if modified_at is not None:
+                response['Last-Modified'] = http_date(modified_at)
+            # Responses depend on the user, and must be revalidated.
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
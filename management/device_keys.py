@@ -0,0 +1,163 @@
+"""
+Long-lived API keys of sensors.
+
+A device key belongs to one hydroponic system and can only be used to
+send measurements of that system through the ingest actions, see
+`DeviceKeyScope`. Keys look like `hyd_<prefix>_<secret>`. The prefix
+identifies the key and is stored in clear, the secret only as an
+HMAC-SHA256 keyed with `SECRET_KEY`. Unlike passwords, secrets are long
+and random, so a fast keyed hash is enough; it is compared in constant
+time.
+
+Sensors send their key as `Authorization: Device <key>`, so they need
+neither the token endpoint nor password hashing. Keys are resolved
+through an in-process cache like the users of JWTs are, see
+`hydroponics.authentication`: a deleted key is rejected right away by
+the process which deleted it, and by other processes once their entry
+expires after `CACHE_TIMEOUT` seconds.
+"""
+import hmac
+import secrets
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.crypto import salted_hmac
+from rest_framework import authentication, exceptions, permissions
+from hydroponics.authentication import ExpiringLRUCache
+from .models import DeviceKey
+
+DEFAULT_SETTINGS = {
+    'CACHE_TIMEOUT': 60,
+    'CACHE_MAX_SIZE': 10000,
+}
+
+KEYWORD = 'Device'
+KEY_PREFIX = 'hyd'
+PREFIX_BYTES = 6
+SECRET_BYTES = 32
+
+
+def get_device_key_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'DEVICE_KEYS', {})}
+
+
+def get_device_key_cache_limits():
+    config = get_device_key_settings()
+    return config['CACHE_TIMEOUT'], config['CACHE_MAX_SIZE']
+
+
+device_key_cache = ExpiringLRUCache(get_device_key_cache_limits)
+
+
+@receiver(post_save, sender=DeviceKey)
+@receiver(post_delete, sender=DeviceKey)
+def evict_changed_device_key(sender, instance, **kwargs):
+    device_key_cache.evict(instance.prefix)
+
+
+def hash_secret(secret: str) -> str:
+    return salted_hmac(
+        'management.device_keys', secret, algorithm='sha256').hexdigest()
+
+
+def create_device_key(system, name: str) -> tuple:
+    """
+    Create a device key of `system`. Returns the `DeviceKey` and the key
+    itself, which is not stored and cannot be shown again.
+    """
+    prefix = secrets.token_hex(PREFIX_BYTES)
+    secret = secrets.token_urlsafe(SECRET_BYTES)
+    device_key = DeviceKey.objects.create(
+        system=system, name=name, prefix=prefix,
+        key_hash=hash_secret(secret))
+    return device_key, f'{KEY_PREFIX}_{prefix}_{secret}'
+
+
+def load_device_key(prefix: str):
+    return DeviceKey.objects.select_related('system').filter(
+        prefix=prefix).first()
+
+
+def verify_device_key(key: str):
+    """
+    Return the `DeviceKey` of `key`, with its system, or `None` when the
+    key is not valid.
+    """
+    scheme, _, rest = key.partition('_')
+    prefix, _, secret = rest.partition('_')
+    key_hash = hash_secret(secret)
+    if scheme != KEY_PREFIX or not prefix or not secret:
+        return None
+    device_key = device_key_cache.get_or_load(prefix, load_device_key)
+    if device_key is None or not hmac.compare_digest(
+            device_key.key_hash, key_hash):
+        return None
+    return device_key
+
+
+class DeviceUser:
+    """
+    User of a request authenticated with a device key: the owner of the
+    key's system, known by id only.
+    """
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, device_key: DeviceKey):
+        self.device_key = device_key
+        self.pk = self.id = device_key.system.owner_id
+
+    def __str__(self):
+        return f"Device key {self.device_key.prefix}"
+
+
+def parse_device_key_header(header: bytes):
+    """
+    Return the key of an `Authorization: Device <key>` header, or `None`
+    when the header uses another scheme.
+    """
+    parts = header.split()
+    if not parts or parts[0].lower() != KEYWORD.lower().encode():
+        return None
+    if len(parts) != 2:
+        raise exceptions.AuthenticationFailed(
+            "Invalid device key header.")
+    try:
+        return parts[1].decode()
+    except UnicodeError:
+        raise exceptions.AuthenticationFailed(
+            "Invalid device key header.")
+
+
+class DeviceKeyAuthentication(authentication.BaseAuthentication):
+    def authenticate(self, request):
+        key = parse_device_key_header(
+            authentication.get_authorization_header(request))
+        if key is None:
+            return None
+        device_key = verify_device_key(key)
+        if device_key is None:
+            raise exceptions.AuthenticationFailed("Invalid device key.")
+        return DeviceUser(device_key), device_key
+
+    def authenticate_header(self, request):
+        return KEYWORD
+
+
+class DeviceKeyScope(permissions.BasePermission):
+    """
+    Restricts requests authenticated with a device key to the actions in
+    the `device_key_actions` of the view.
+    """
+
+    def has_permission(self, request, view):
+        if not isinstance(request.auth, DeviceKey):
+            return True
+        return getattr(view, 'action', None) in getattr(
+            view, 'device_key_actions', ())
@@ -0,0 +1,67 @@
+"""
+Largest-Triangle-Three-Buckets (LTTB) downsampling of measurement series
+for charts, after Sveinn Steinarsson, "Downsampling Time Series for Visual
+Representation" (2013).
+
+The first and last points are kept and the rest are split into equal
+buckets. From each bucket the point forming the largest triangle with
+the point selected from the previous bucket and the average of the next
+bucket is kept. Spikes therefore survive, which averaging would flatten.
+"""
+import numpy as np
+from .models import METRIC_FIELDS
+
+MIN_DOWNSAMPLE = 3
+
+
+def lttb(x, y, threshold: int):
+    """
+    Return the indices of at most `threshold` points of the series
+    `x`, `y`, which must be ordered by `x`.
+    """
+    size = len(x)
+    if threshold >= size or threshold < MIN_DOWNSAMPLE:
+        return np.arange(size)
+    # Bucket edges of the points between the first and the last one,
+    # followed by the bucket of the last point.
+    edges = np.append(
+        np.linspace(1, size - 1, threshold - 1).astype(np.intp), size)
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, size - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end, next_end = edges[bucket:bucket + 3]
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(areas.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_measurements(queryset, threshold: int) -> dict:
+    """
+    Return at most `threshold` points per metric of the measurements in
+    `queryset`, read with a single query. Null values are left out of
+    the series of their metric.
+    """
+    rows = list(queryset.order_by('timestamp', 'id').values_list(
+        'timestamp', *METRIC_FIELDS))
+    timestamps = [row[0] for row in rows]
+    x = np.array([timestamp.timestamp() for timestamp in timestamps])
+    values = np.array(
+        [row[1:] for row in rows], dtype=float).reshape(
+            len(rows), len(METRIC_FIELDS))
+
+    series = {}
+    for column, metric in enumerate(METRIC_FIELDS):
+        present = np.flatnonzero(~np.isnan(values[:, column]))
+        indices = present[
+            lttb(x[present], values[present, column], threshold)]
+        series[metric] = [
+            {'timestamp': timestamps[index],
+             'value': float(values[index, column])}
+            for index in indices]
+    return series
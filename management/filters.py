@@ -1,7 +1,41 @@
+from datetime import timedelta
 import django_filters
+from django import forms
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from .aggregates import parse_interval
 from .models import HydroponicSystem, Measurement
 
 
+class IntervalField(forms.CharField):
+    default_error_messages = {
+        'invalid': 'Enter an interval such as 15m, 24h or 7d.'}
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if value in self.empty_values:
+            return None
+        seconds = parse_interval(value)
+        if seconds is None:
+            raise ValidationError(
+                self.error_messages['invalid'], code='invalid')
+        return timedelta(seconds=seconds)
+
+
+class SinceFilter(django_filters.Filter):
+    """
+    Selects the values within an interval before now, e.g. `24h`.
+    """
+
+    field_class = IntervalField
+
+    def filter(self, qs, value):
+        if value is None:
+            return qs
+        return qs.filter(**{
+            f'{self.field_name}__gte': timezone.now() - value})
+
+
 class HydroponicSystemFilter(django_filters.FilterSet):
     created_at = django_filters.DateFromToRangeFilter()
     updated_at = django_filters.DateFromToRangeFilter()
@@ -16,7 +50,8 @@ class HydroponicSystemFilter(django_filters.FilterSet):
 class MeasurementFilter(django_filters.FilterSet):
     """
     Filter class which provides (min/max) range filters for:
-    pH, temperature, and TDS values.
+    pH, temperature, TDS values and timestamps, and a relative
+    timestamp filter, `since`, such as `since=24h`.
     """
 
     ph_min = django_filters.NumberFilter(
@@ -34,6 +69,12 @@ class MeasurementFilter(django_filters.FilterSet):
     tds_max = django_filters.NumberFilter(
         field_name='tds', lookup_expr='lte')
 
+    timestamp_min = django_filters.IsoDateTimeFilter(
+        field_name='timestamp', lookup_expr='gte')
+    timestamp_max = django_filters.IsoDateTimeFilter(
+        field_name='timestamp', lookup_expr='lt')
+    since = SinceFilter(field_name='timestamp')
+
     class Meta:
         model = Measurement
         fields = [
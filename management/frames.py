@@ -0,0 +1,156 @@
+"""
+Compact binary wire format for measurements.
+
+A body is a sequence of fixed size little-endian frames:
+
+    uint64   system id
+    int64    timestamp in milliseconds since the Unix epoch,
+             0 means the time the server received the frame
+    float32  pH
+    float32  temperature
+    float32  TDS
+
+Null metrics are sent as NaN. A frame takes 28 bytes, compared to about
+70 bytes for the same reading as JSON.
+"""
+import math
+import struct
+from datetime import datetime, timezone as dt_timezone
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from .ingest import METRIC_FIELDS, clean_metric
+from .models import Measurement
+
+MEASUREMENT_FRAME = struct.Struct('<Qqfff')
+MEASUREMENT_FRAME_MEDIA_TYPE = (
+    'application/vnd.hydroponics.measurement-frames')
+
+
+class MeasurementFrames:
+    """
+    Decoded request body. Frames are unpacked lazily from the raw bytes,
+    so a batch is never turned into a list of dicts.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // MEASUREMENT_FRAME.size
+
+    def __iter__(self):
+        return MEASUREMENT_FRAME.iter_unpack(self.data)
+
+    def system_ids(self) -> set:
+        return {frame[0] for frame in self}
+
+
+def clean_frame(frame, owned_system_ids) -> Measurement:
+    """
+    Build an unsaved `Measurement` from an unpacked frame, raising
+    `ValidationError` with per-field messages when the frame is invalid.
+    """
+    system_id, timestamp, *metrics = frame
+    errors = {}
+    if system_id not in owned_system_ids:
+        errors['system'] = ['Hydroponic system does not exist.']
+
+    values = {}
+    for name, value in zip(METRIC_FIELDS, metrics):
+        # Drop the noise digits of the float32 encoding, so that 6.7
+        # is stored as 6.7 and not as 6.699999809265137.
+        value = None if math.isnan(value) else float(f'{value:.7g}')
+        try:
+            values[name] = clean_metric(name, value)
+        except ValidationError as error:
+            errors[name] = error.messages
+
+    if timestamp:
+        try:
+            values['timestamp'] = datetime.fromtimestamp(
+                timestamp / 1000, tz=dt_timezone.utc)
+            Measurement._meta.get_field(
+                'timestamp').run_validators(values['timestamp'])
+        except (OverflowError, OSError, ValueError):
+            errors['timestamp'] = ['Timestamp is out of range.']
+        except ValidationError as error:
+            errors['timestamp'] = error.messages
+    else:
+        values['timestamp'] = timezone.now()
+
+    if errors:
+        raise ValidationError(errors)
+    return Measurement(system_id=system_id, **values)
+
+
+class MeasurementFrameParser(BaseParser):
+    media_type = MEASUREMENT_FRAME_MEDIA_TYPE
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        data = stream.read() if stream is not None else b''
+        if len(data) % MEASUREMENT_FRAME.size:
+            raise ParseError(
+                f'Body length must be a multiple of '
+                f'{MEASUREMENT_FRAME.size} bytes.')
+        return MeasurementFrames(data)
+
+
+def is_measurement_row(row) -> bool:
+    """
+    Whether `row` is a represented measurement, as opposed to e.g. an
+    aggregate bucket or the measurements of a system grouped together.
+    """
+    return (
+        isinstance(row, dict)
+        and isinstance(row.get('system'), int)
+        and row.get('timestamp') is not None
+        and all(
+            name in row and (
+                row[name] is None
+                or isinstance(row[name], (int, float))
+                and not isinstance(row[name], bool))
+            for name in METRIC_FIELDS))
+
+
+class MeasurementFrameRenderer(BaseRenderer):
+    """
+    Renders measurements, lists of measurements and paginated pages of
+    measurements as frames. Any other payload, such as an error, an
+    aggregate or a downsampled series, is rendered as JSON.
+    """
+
+    media_type = MEASUREMENT_FRAME_MEDIA_TYPE
+    format = 'frames'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data
+        if isinstance(data, dict):
+            rows = data.get('results', [data])
+        if not isinstance(rows, list) or not all(
+                is_measurement_row(row) for row in rows):
+            response = (renderer_context or {}).get('response')
+            if response is not None:
+                response['Content-Type'] = JSONRenderer.media_type
+            return JSONRenderer().render(data)
+
+        return b''.join(
+            MEASUREMENT_FRAME.pack(
+                row['system'],
+                self.timestamp_millis(row.get('timestamp')),
+                *(math.nan if row.get(name) is None else row[name]
+                  for name in METRIC_FIELDS))
+            for row in rows)
+
+    @staticmethod
+    def timestamp_millis(value) -> int:
+        if isinstance(value, str):
+            value = parse_datetime(value)
+        if value is None:
+            return 0
+        return int(value.timestamp() * 1000)
@@ -0,0 +1,184 @@
+"""
+Streaming ingestion of measurements.
+
+Request bodies are read line by line from the request stream, rows are
+validated with the validators declared on the `Measurement` model and
+written with `save_measurements`, one transaction per chunk.
+"""
+import codecs
+import csv
+import json
+from itertools import islice
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import METRIC_FIELDS, Measurement
+from .state import save_measurements
+from .utils import OwnedSystemCache, parse_system_id
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/jsonl')
+CSV_CONTENT_TYPES = ('text/csv',)
+
+INGEST_CHUNK_SIZE = 1000
+MAX_INGEST_CHUNK_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+
+
+def iter_ndjson_rows(stream):
+    """
+    Yield `(line_number, row)` pairs from a newline-delimited JSON stream.
+    Lines which cannot be decoded are yielded as `None` rows.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+
+def iter_csv_rows(stream):
+    """
+    Yield `(line_number, row)` pairs from a CSV stream whose first line
+    is a header naming the columns (system, ph, temperature, tds and
+    optionally timestamp and idempotency_key).
+    """
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+    try:
+        for row in reader:
+            yield reader.line_num, row
+    except (csv.Error, UnicodeDecodeError):
+        yield reader.line_num, None
+
+
+def parse_timestamp(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        value = parse_datetime(value)
+    except ValueError:
+        return None
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def clean_metric(name, value):
+    """
+    Convert a raw value of the metric field `name` to a float and run the
+    field's range validator. Empty values are stored as null.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValidationError('A valid number is required.')
+    Measurement._meta.get_field(name).run_validators(value)
+    return value
+
+
+def clean_measurement(row, owned_system_ids) -> Measurement:
+    """
+    Build an unsaved `Measurement` from a raw row, raising
+    `ValidationError` with per-field messages when the row is invalid.
+    """
+    if not isinstance(row, dict):
+        raise ValidationError(
+            {'non_field_errors': ['Invalid row.']})
+
+    errors = {}
+    system_id = parse_system_id(row.get('system'))
+    if system_id is None:
+        errors['system'] = ['A valid integer is required.']
+    elif system_id not in owned_system_ids:
+        errors['system'] = ['Hydroponic system does not exist.']
+
+    values = {}
+    for name in METRIC_FIELDS:
+        try:
+            values[name] = clean_metric(name, row.get(name))
+        except ValidationError as error:
+            errors[name] = error.messages
+
+    timestamp = row.get('timestamp')
+    if timestamp is None or timestamp == '':
+        values['timestamp'] = timezone.now()
+    else:
+        timestamp = parse_timestamp(timestamp)
+        if timestamp is None:
+            errors['timestamp'] = [
+                'Timestamp must be an ISO 8601 date and time.']
+        else:
+            try:
+                Measurement._meta.get_field(
+                    'timestamp').run_validators(timestamp)
+                values['timestamp'] = timestamp
+            except ValidationError as error:
+                errors['timestamp'] = error.messages
+
+    idempotency_key = row.get('idempotency_key')
+    if idempotency_key is None or idempotency_key == '':
+        values['idempotency_key'] = None
+    elif not isinstance(idempotency_key, str):
+        errors['idempotency_key'] = ['Not a valid string.']
+    else:
+        try:
+            Measurement._meta.get_field(
+                'idempotency_key').run_validators(idempotency_key)
+            values['idempotency_key'] = idempotency_key
+        except ValidationError as error:
+            errors['idempotency_key'] = error.messages
+
+    if errors:
+        raise ValidationError(errors)
+    return Measurement(system_id=system_id, **values)
+
+
+def ingest_rows(
+        owned_systems: OwnedSystemCache,
+        rows,
+        chunk_size: int = INGEST_CHUNK_SIZE) -> dict:
+    """
+    Validate and store `(line_number, row)` pairs in chunks of
+    `chunk_size` rows. Each chunk is committed on its own, so rows from
+    chunks which were already written are kept if a later row fails.
+    Ownership is checked once per distinct system, and rows whose
+    idempotency key is already stored are skipped.
+    """
+    summary = {
+        'accepted': 0,
+        'rejected': 0,
+        'chunks': 0,
+        'errors': []}
+
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        owned_system_ids = owned_systems.owned_ids(
+            row.get('system') for _, row in chunk if isinstance(row, dict))
+        measurements = []
+        for line_number, row in chunk:
+            try:
+                measurements.append(
+                    clean_measurement(row, owned_system_ids))
+            except ValidationError as error:
+                summary['rejected'] += 1
+                if len(summary['errors']) < MAX_REPORTED_ERRORS:
+                    summary['errors'].append({
+                        'line': line_number,
+                        'errors': error.message_dict})
+
+        if measurements:
+            with transaction.atomic():
+                save_measurements(measurements)
+            summary['accepted'] += len(measurements)
+            summary['chunks'] += 1
+
+    return summary
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from management.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the measurements and rollups which are older than the "
+        "retention of their system, in batches committed one by one. "
+        "Run it periodically; an interrupted run resumes where it "
+        "stopped when run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            help="Rows deleted per transaction, the BATCH_SIZE of the "
+                 "MEASUREMENT_RETENTION setting when omitted.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        self.verbosity = options['verbosity']
+        self.rates = {}
+        deleted = apply_retention(
+            options['batch_size'], progress=self.report_progress)
+        for tier, count in deleted.items():
+            elapsed, rate = self.rates.get(tier, (0, 0))
+            self.stdout.write(
+                f"{tier}: deleted {count} rows in {elapsed:.1f}s "
+                f"({rate:.0f} rows/s).")
+
+    def report_progress(self, tier, count, elapsed):
+        rate = count / elapsed if elapsed > 0 else 0
+        self.rates[tier] = (elapsed, rate)
+        if self.verbosity > 1:
+            self.stdout.write(
+                f"{tier}: {count} rows deleted ({rate:.0f} rows/s).")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from management.device_keys import create_device_key
+from management.models import HydroponicSystem
+
+
+class Command(BaseCommand):
+    help = (
+        "Create a device key for a hydroponic system and print it. The "
+        "key cannot be shown again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('system', type=int, help="Id of the system.")
+        parser.add_argument('name', help="Name of the device.")
+
+    def handle(self, *args, **options):
+        try:
+            system = HydroponicSystem.objects.get(pk=options['system'])
+        except HydroponicSystem.DoesNotExist:
+            raise CommandError(f"System {options['system']} does not exist.")
+        device_key, key = create_device_key(system, options['name'])
+        self.stdout.write(key)
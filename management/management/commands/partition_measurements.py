@@ -0,0 +1,89 @@
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from management.partitions import (
+    add_months,
+    convert_to_partitioned,
+    create_partitions,
+    detach_partitions,
+    is_partitioned,
+    list_partitions,
+    month_start)
+
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').replace(
+            tzinfo=timezone.utc)
+    except ValueError:
+        raise CommandError(f"{value} is not a month such as 2024-05.")
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage the monthly partitions of the measurement table: convert "
+        "the table to a partitioned one, create the partitions of the "
+        "coming months, list the partitions, or detach old ones.")
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        for name, help_text in (
+                ('convert', "Convert the measurement table to a table "
+                            "partitioned by month. Locks the table while "
+                            "the readings are copied."),
+                ('create', "Create the partitions of the current and the "
+                           "coming months. Run it regularly, e.g. daily.")):
+            subparser = subparsers.add_parser(name, help=help_text)
+            subparser.add_argument(
+                '--months', type=int, default=3,
+                help="Number of months ahead to create partitions for.")
+        subparsers.add_parser('list', help="List the partitions.")
+        detach = subparsers.add_parser(
+            'detach',
+            help="Detach the partitions of the months before a month. "
+                 "Their readings are removed from the measurements and "
+                 "the reading counts, rollups are kept.")
+        detach.add_argument(
+            '--before', type=parse_month, required=True,
+            help="First month to keep, e.g. 2024-05.")
+        detach.add_argument(
+            '--drop', action='store_true',
+            help="Drop the detached partitions.")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action != 'convert' and not is_partitioned():
+            raise CommandError(
+                "The measurement table is not partitioned, run "
+                "partition_measurements convert first.")
+        getattr(self, f'handle_{action}')(options)
+
+    def handle_convert(self, options):
+        if is_partitioned():
+            self.stdout.write("The measurement table is already partitioned.")
+            return
+        with transaction.atomic():
+            copied = convert_to_partitioned(options['months'])
+        self.stdout.write(
+            f"Converted the measurement table, copied {copied} readings.")
+
+    def handle_create(self, options):
+        now = datetime.now(timezone.utc)
+        with transaction.atomic():
+            created = create_partitions(
+                now, add_months(month_start(now), options['months']))
+        for name in created:
+            self.stdout.write(f"Created {name}.")
+        self.stdout.write(f"Created {len(created)} partitions.")
+
+    def handle_list(self, options):
+        for name, bounds, rows in list_partitions():
+            self.stdout.write(f"{name}\t{bounds}\t~{rows} rows")
+
+    def handle_detach(self, options):
+        with transaction.atomic():
+            detached = detach_partitions(options['before'], options['drop'])
+        verb = "Dropped" if options['drop'] else "Detached"
+        for name in detached:
+            self.stdout.write(f"{verb} {name}.")
+        self.stdout.write(f"{verb} {len(detached)} partitions.")
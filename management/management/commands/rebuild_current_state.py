@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from management.state import rebuild_current_state
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the current state of hydroponic systems from their "
+        "stored measurements, e.g. after measurements were imported "
+        "without going through the API.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'system_ids', nargs='*', type=int,
+            help="Systems to rebuild, all systems when omitted.")
+
+    def handle(self, *args, **options):
+        written = rebuild_current_state(options['system_ids'] or None)
+        self.stdout.write(f"Rebuilt the current state of {written} systems.")
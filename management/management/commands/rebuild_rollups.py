@@ -0,0 +1,74 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, Min
+from management.ingest import parse_timestamp
+from management.models import Measurement
+from management.rollups import rebuild_rollups, truncate
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill or rebuild the hourly and daily measurement rollups "
+        "of a time range from the stored measurements. The range is "
+        "rebuilt one chunk of days at a time, each in its own "
+        "transaction.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            help="ISO 8601 start of the range, the first measurement "
+                 "when omitted.")
+        parser.add_argument(
+            '--end',
+            help="ISO 8601 end of the range (exclusive), the last "
+                 "measurement when omitted.")
+        parser.add_argument(
+            '--system', type=int, action='append', dest='system_ids',
+            help="System to rebuild, can be repeated. All systems when "
+                 "omitted.")
+        parser.add_argument(
+            '--chunk-days', type=int, default=1,
+            help="Number of days rebuilt per transaction.")
+
+    def handle(self, *args, **options):
+        if options['chunk_days'] < 1:
+            raise CommandError("--chunk-days must be at least 1.")
+        start, end = self.get_range(options)
+        if start is None:
+            self.stdout.write("No measurements to roll up.")
+            return
+
+        written = 0
+        chunk = timedelta(days=options['chunk_days'])
+        chunk_start = truncate(start, 'day')
+        while chunk_start < end:
+            chunk_end = min(chunk_start + chunk, end)
+            with transaction.atomic():
+                written += rebuild_rollups(
+                    chunk_start, chunk_end, options['system_ids'])
+            chunk_start = chunk_end
+        self.stdout.write(f"Wrote {written} rollup rows.")
+
+    def get_range(self, options):
+        bounds = {}
+        for name in ('start', 'end'):
+            if options[name] is None:
+                continue
+            bounds[name] = parse_timestamp(options[name])
+            if bounds[name] is None:
+                raise CommandError(
+                    f"--{name} must be an ISO 8601 date and time.")
+        if len(bounds) < 2:
+            measurements = Measurement.objects.all()
+            if options['system_ids']:
+                measurements = measurements.filter(
+                    system_id__in=options['system_ids'])
+            extent = measurements.aggregate(
+                first=Min('timestamp'), last=Max('timestamp'))
+            if extent['first'] is None:
+                return None, None
+            bounds.setdefault('start', extent['first'])
+            bounds.setdefault(
+                'end', extent['last'] + timedelta(microseconds=1))
+        return bounds['start'], bounds['end']
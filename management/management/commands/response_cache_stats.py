@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from management.response_cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the hits, misses and hit ratio of the response cache and "
+        "the time saved by hits, counted by all processes sharing the "
+        "cache.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help="Reset the counters after showing them.")
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        self.stdout.write(
+            f"hits: {stats['hits']}, misses: {stats['misses']}, "
+            f"hit ratio: {stats['hit_ratio']:.1%}, "
+            f"saved: {stats['saved_ms'] / 1000:.1f}s")
+        if options['reset']:
+            reset_stats()
@@ -1,10 +1,15 @@
+from datetime import timedelta
+from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 PH_RANGE = (0, 14)
 TEMP_RANGE = (0, 100)
 TDS_RANGE = (0, 2000)
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+METRIC_FIELDS = ('ph', 'temperature', 'tds')
 
 
 def validate_ph_range(value):
@@ -30,6 +35,12 @@ def validate_range(value, value_range):
              f'range (from {min_value} to {max_value}).'))
 
 
+def validate_timestamp(value):
+    if value > timezone.now() + MAX_CLOCK_SKEW:
+        raise ValidationError(
+            f'Timestamp {value.isoformat()} is in the future.')
+
+
 class HydroponicSystem(models.Model):
     owner = models.ForeignKey(
         User,
@@ -58,8 +69,171 @@ class Measurement(models.Model):
     tds = models.FloatField(
         validators=[validate_tds_range],
         null=True, blank=True)  # Total Dissolved Solids
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(
+        default=timezone.now,
+        validators=[validate_timestamp])
+    # Client supplied key which makes retried uploads idempotent. Once
+    # the table is partitioned, only for retries which repeat the
+    # timestamp, see `management.partitions`.
+    idempotency_key = models.CharField(
+        max_length=64,
+        null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['system', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='unique_measurement_idempotency_key')]
+        indexes = [
+            # Latest measurements of a system.
+            models.Index(
+                fields=['system', '-timestamp'],
+                name='measurement_system_latest'),
+            # Time ranges over all systems. Readings are appended in
+            # roughly timestamp order, so a block range index stays
+            # small and selective.
+            BrinIndex(
+                fields=['timestamp'],
+                name='measurement_timestamp_brin')]
 
     def __str__(self):
         formatted_timestamp = self.timestamp.strftime("%Y-%m-%d %H:%M:%S")
         return f"Measurement for {self.system.name} at {formatted_timestamp}"
+
+
+class SystemCurrentState(models.Model):
+    """
+    Latest reading of a hydroponic system, maintained on ingest so that
+    dashboards do not have to scan the measurements of each system.
+    """
+
+    system = models.OneToOneField(
+        HydroponicSystem,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='current_state')
+    ph = models.FloatField(null=True, blank=True)
+    temperature = models.FloatField(null=True, blank=True)
+    tds = models.FloatField(null=True, blank=True)
+    # Timestamp of the latest reading.
+    timestamp = models.DateTimeField(null=True, blank=True)
+    reading_count = models.PositiveBigIntegerField(default=0)
+    # When a reading of the system was last stored.
+    last_seen = models.DateTimeField(null=True, blank=True)
+    # Incremented, and `changed_at` set, whenever a reading of the
+    # system is stored, changed or deleted. Used as the validator of
+    # conditional requests, see `management.conditional`.
+    version = models.PositiveBigIntegerField(default=0)
+    changed_at = models.DateTimeField(null=True, blank=True)
+    # Readings older than this were deleted by retention, so the rollups
+    # of their buckets are no longer rebuilt, see `management.rollups`.
+    compacted_before = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Current state of {self.system.name}"
+
+
+class MeasurementRollup(models.Model):
+    """
+    Aggregates of the measurements of a system within one time bucket.
+    Sums and sums of squares are kept instead of averages, so that
+    rollups can be updated incrementally and combined into larger
+    buckets. Buckets are aligned in UTC.
+    """
+
+    bucket_unit = None
+
+    system = models.ForeignKey(
+        HydroponicSystem,
+        on_delete=models.CASCADE,
+        related_name='+')
+    bucket = models.DateTimeField()
+    count = models.PositiveBigIntegerField(default=0)
+    ph_count = models.PositiveBigIntegerField(default=0)
+    ph_sum = models.FloatField(default=0)
+    ph_sum_squares = models.FloatField(default=0)
+    ph_min = models.FloatField(null=True, blank=True)
+    ph_max = models.FloatField(null=True, blank=True)
+    temperature_count = models.PositiveBigIntegerField(default=0)
+    temperature_sum = models.FloatField(default=0)
+    temperature_sum_squares = models.FloatField(default=0)
+    temperature_min = models.FloatField(null=True, blank=True)
+    temperature_max = models.FloatField(null=True, blank=True)
+    tds_count = models.PositiveBigIntegerField(default=0)
+    tds_sum = models.FloatField(default=0)
+    tds_sum_squares = models.FloatField(default=0)
+    tds_min = models.FloatField(null=True, blank=True)
+    tds_max = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        formatted_bucket = self.bucket.strftime("%Y-%m-%d %H:%M")
+        return (f"{self.bucket_unit.capitalize()} rollup for "
+                f"{self.system.name} at {formatted_bucket}")
+
+
+class HourlyMeasurementRollup(MeasurementRollup):
+    bucket_unit = 'hour'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['system', 'bucket'],
+                name='unique_hourly_measurement_rollup')]
+
+
+class DailyMeasurementRollup(MeasurementRollup):
+    bucket_unit = 'day'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['system', 'bucket'],
+                name='unique_daily_measurement_rollup')]
+
+
+class RetentionPolicy(models.Model):
+    """
+    How many days the measurements and rollups of a system are kept,
+    replacing the `MEASUREMENT_RETENTION` setting for that system. Empty
+    values keep the data forever. See `management.retention`.
+    """
+
+    system = models.OneToOneField(
+        HydroponicSystem,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='retention_policy')
+    raw_days = models.PositiveIntegerField(null=True, blank=True)
+    hourly_days = models.PositiveIntegerField(null=True, blank=True)
+    daily_days = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'retention policies'
+
+    def __str__(self):
+        return f"Retention policy of {self.system.name}"
+
+
+class DeviceKey(models.Model):
+    """
+    Long-lived API key of a sensor, which can only send measurements of
+    its system. Only a keyed hash of the secret part is stored, see
+    `management.device_keys`.
+    """
+
+    system = models.ForeignKey(
+        HydroponicSystem,
+        on_delete=models.CASCADE,
+        related_name='device_keys')
+    name = models.CharField(max_length=255)
+    # Public part of the key, by which it is looked up.
+    prefix = models.CharField(max_length=16, unique=True)
+    key_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.prefix})"
@@ -0,0 +1,219 @@
+"""
+Monthly range partitioning of the measurement table on `timestamp`.
+
+Django creates the table unpartitioned; `convert_to_partitioned` turns
+it into a partitioned table with one partition per UTC month and a
+default partition for readings outside of them. Queries with a time
+range then only scan the partitions of that range, and removing a month
+of readings is a matter of detaching its partition.
+
+PostgreSQL requires unique indexes of a partitioned table to include the
+partition key, so the primary key becomes `(id, timestamp)` and
+idempotency keys are unique per system and timestamp. Retried uploads
+are only recognized when they repeat the timestamp of the reading.
+"""
+import re
+from datetime import datetime, timezone
+from django.db import connection, models
+from .models import Measurement
+from .state import subtract_reading_counts
+
+PARTITION_NAME_RE = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def month_start(value: datetime) -> datetime:
+    """
+    Return the start of the UTC month containing `value`.
+    """
+    return value.astimezone(timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f'{Measurement._meta.db_table}_p{month:%Y_%m}'
+
+
+def default_partition_name() -> str:
+    return f'{Measurement._meta.db_table}_default'
+
+
+def is_partitioned() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)',
+            [Measurement._meta.db_table])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions() -> list:
+    """
+    Return the name, bounds and estimated number of rows of every
+    partition, ordered by name.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT partition.relname, '
+            'pg_get_expr(partition.relpartbound, partition.oid), '
+            'greatest(partition.reltuples, 0)::bigint '
+            'FROM pg_inherits '
+            'JOIN pg_class partition ON partition.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(%s) '
+            'ORDER BY partition.relname',
+            [Measurement._meta.db_table])
+        return cursor.fetchall()
+
+
+def create_partition(month: datetime) -> bool:
+    """
+    Create the partition of `month` unless it exists, moving its readings
+    out of the default partition. Returns whether it was created.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    name = partition_name(month)
+    bounds = [month, add_months(month, 1)]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [name])
+        if cursor.fetchone()[0]:
+            return False
+        # The default partition must not hold rows of a new partition, so
+        # they are moved into the new table before it is attached.
+        cursor.execute(
+            f'CREATE TABLE {quote_name(name)} '
+            f'(LIKE {table} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS ('
+            f'DELETE FROM {quote_name(default_partition_name())} '
+            f'WHERE {quote_name("timestamp")} >= %s '
+            f'AND {quote_name("timestamp")} < %s RETURNING *) '
+            f'INSERT INTO {quote_name(name)} SELECT * FROM moved',
+            bounds)
+        cursor.execute(
+            f'ALTER TABLE {table} ATTACH PARTITION {quote_name(name)} '
+            f'FOR VALUES FROM (%s) TO (%s)',
+            bounds)
+    return True
+
+
+def create_partitions(start: datetime, end: datetime) -> list:
+    """
+    Create the missing partitions of the months from the one containing
+    `start` to the one containing `end`. Returns the created names.
+    """
+    created = []
+    month = month_start(start)
+    while month <= end:
+        if create_partition(month):
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def convert_to_partitioned(months_ahead: int) -> int:
+    """
+    Replace the unpartitioned measurement table by a partitioned one with
+    the same columns, indexes and foreign keys, partitions for every
+    month with readings up to `months_ahead` months from now, and a
+    default partition. The readings are copied, so the table is locked
+    for the duration; run it inside a transaction. Returns the number of
+    copied readings.
+    """
+    quote_name = connection.ops.quote_name
+    name = Measurement._meta.db_table
+    table = quote_name(name)
+    staging = quote_name(f'{name}_partitioned')
+    legacy = quote_name(f'{name}_unpartitioned')
+    timestamp = quote_name('timestamp')
+    with connection.cursor() as cursor:
+        # Deferred foreign key checks of the transaction would keep the
+        # old table from being dropped.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(
+            'SELECT indexdef FROM pg_indexes '
+            'WHERE schemaname = current_schema() AND tablename = %s '
+            'AND indexdef NOT LIKE %s',
+            [name, 'CREATE UNIQUE INDEX%'])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            'SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint '
+            'WHERE conrelid = to_regclass(%s) AND contype = %s',
+            [name, 'f'])
+        foreign_keys = cursor.fetchall()
+        cursor.execute(f'SELECT min({timestamp}) FROM {table}')
+        first = cursor.fetchone()[0]
+
+        cursor.execute(
+            f'CREATE TABLE {staging} '
+            f'(LIKE {table} INCLUDING DEFAULTS INCLUDING IDENTITY) '
+            f'PARTITION BY RANGE ({timestamp})')
+        cursor.execute(
+            f'CREATE TABLE {quote_name(default_partition_name())} '
+            f'PARTITION OF {staging} DEFAULT')
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+        cursor.execute(f'ALTER TABLE {staging} RENAME TO {table}')
+        now = datetime.now(timezone.utc)
+        create_partitions(first or now, add_months(now, months_ahead))
+        cursor.execute(
+            f'INSERT INTO {table} SELECT * FROM {legacy}')
+        copied = cursor.rowcount
+        cursor.execute(
+            f'SELECT setval(pg_get_serial_sequence(%s, %s), '
+            f'coalesce(max(id), 0) + 1, false) FROM {table}',
+            [name, 'id'])
+        cursor.execute(f'DROP TABLE {legacy}')
+
+        cursor.execute(
+            f'ALTER TABLE {table} ADD PRIMARY KEY (id, {timestamp})')
+        for index in indexes:
+            cursor.execute(index)
+        for constraint_name, definition in foreign_keys:
+            cursor.execute(
+                f'ALTER TABLE {table} ADD CONSTRAINT '
+                f'{quote_name(constraint_name)} {definition}')
+    with connection.schema_editor() as editor:
+        for constraint in Measurement._meta.constraints:
+            if isinstance(constraint, models.UniqueConstraint):
+                constraint = models.UniqueConstraint(
+                    fields=[*constraint.fields, 'timestamp'],
+                    condition=constraint.condition,
+                    name=constraint.name)
+            editor.add_constraint(Measurement, constraint)
+    return copied
+
+
+def detach_partitions(before: datetime, drop: bool = False) -> list:
+    """
+    Detach, and optionally drop, the monthly partitions which end before
+    `before`. Their readings are subtracted from the reading counts of
+    the current state; rollups are kept. Returns the detached names.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    detached = []
+    for name, _bounds, _rows in list_partitions():
+        match = PARTITION_NAME_RE.search(name)
+        if match is None:
+            continue
+        month = datetime(
+            int(match.group(1)), int(match.group(2)), 1,
+            tzinfo=timezone.utc)
+        if add_months(month, 1) > before:
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT system_id, count(*) FROM {quote_name(name)} '
+                f'GROUP BY system_id')
+            subtract_reading_counts(dict(cursor.fetchall()))
+            cursor.execute(
+                f'ALTER TABLE {table} DETACH PARTITION {quote_name(name)}')
+            if drop:
+                cursor.execute(f'DROP TABLE {quote_name(name)}')
+        detached.append(name)
+    return detached
@@ -0,0 +1,277 @@
+"""
+Caching of the responses of read endpoints polled by dashboards.
+
+Responses are cached per user, under a key which also contains the
+version of every hydroponic system they depend on: the systems given in
+the request, or all systems of the user. Every write of measurements
+bumps the versions of their systems once its transaction commits, see
+`management.state`, and writes of systems bump the version of their
+owner, which covers the list of systems of the user. Cached responses
+of older versions are never read again and expire after `TIMEOUT`
+seconds, so a response is never served after a write it does not
+reflect.
+
+Versions live in the cache configured by the `RESPONSE_CACHE` setting,
+which must be shared by all processes serving the API, e.g. memcached
+or Redis; the local-memory backend is only correct with one process,
+and `check_shared_cache` rejects it with the production profile.
+When a response is missing, the first request computes it while
+concurrent requests for the same key wait up to `LOCK_WAIT` seconds for
+it instead of all running the same queries.
+
+Hits, misses and the time saved by hits are counted in the cache, see
+`get_stats`, and responses carry an `X-Cache` header.
+"""
+import functools
+import hashlib
+import time
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+from .models import HydroponicSystem
+
+DEFAULT_SETTINGS = {
+    'ENABLED': False,
+    'CACHE': 'default',
+    'TIMEOUT': 60,
+    'LOCK_TIMEOUT': 10,
+    'LOCK_WAIT': 5.0,
+}
+
+KEY_PREFIX = 'response-cache'
+GLOBAL_VERSION_KEY = f'{KEY_PREFIX}:version'
+STATS = ('hits', 'misses', 'saved_ms')
+LOCK_POLL_INTERVAL = 0.05
+# Backends which keep their entries in the memory of each process.
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache')
+
+
+def get_response_cache_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'RESPONSE_CACHE', {})}
+
+
+def get_cache():
+    return caches[get_response_cache_settings()['CACHE']]
+
+
+def check_shared_cache(app_configs, **kwargs):
+    config = get_response_cache_settings()
+    if not config['ENABLED'] or not getattr(settings, 'PRODUCTION', False):
+        return []
+    backend = settings.CACHES.get(config['CACHE'], {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_BACKENDS:
+        return []
+    return [checks.Error(
+        f"The response cache uses the process-local cache "
+        f"'{config['CACHE']}' ({backend}).",
+        hint="Workers would serve stale responses after writes made "
+             "by other workers. Set CACHE_BACKEND and CACHE_LOCATION "
+             "to a shared cache, e.g. Redis.",
+        id='management.E001')]
+
+
+def owner_version_key(owner_id) -> str:
+    return f'{KEY_PREFIX}:owner:{owner_id}'
+
+
+def system_version_key(system_id) -> str:
+    return f'{KEY_PREFIX}:system:{system_id}'
+
+
+def new_version() -> int:
+    # Versions start from the clock, so that a version key which was
+    # evicted does not start again from a version already used.
+    return time.time_ns()
+
+
+def increment(cache, key: str, delta: int = 1) -> None:
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            cache.incr(key, delta)
+
+
+def bump_versions(keys) -> None:
+    cache = get_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, new_version(), None)
+
+
+def get_versions(cache, keys) -> list:
+    """
+    Return the current versions of `keys`, creating missing ones.
+    """
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, new_version(), None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key) for key in keys]
+
+
+def invalidate(system_ids=(), owner_ids=()) -> None:
+    """
+    Bump the versions of the given systems and owners when the current
+    transaction commits, or right away outside of a transaction.
+    """
+    if not get_response_cache_settings()['ENABLED']:
+        return
+    keys = (
+        [system_version_key(system_id) for system_id in set(system_ids)]
+        + [owner_version_key(owner_id) for owner_id in set(owner_ids)])
+    if keys:
+        transaction.on_commit(functools.partial(bump_versions, keys))
+
+
+def invalidate_all() -> None:
+    """
+    Invalidate the cached responses of all users, e.g. after data was
+    changed without going through the API.
+    """
+    if get_response_cache_settings()['ENABLED']:
+        transaction.on_commit(functools.partial(
+            bump_versions, [GLOBAL_VERSION_KEY]))
+
+
+def owned_system_ids(cache, user, owner_version) -> list:
+    key = f'{KEY_PREFIX}:systems:{user.pk}:{owner_version}'
+    system_ids = cache.get(key)
+    if system_ids is None:
+        system_ids = list(HydroponicSystem.objects.filter(
+            owner=user).order_by('pk').values_list('pk', flat=True))
+        cache.set(key, system_ids, get_response_cache_settings()['TIMEOUT'])
+    return system_ids
+
+
+def response_key(cache, request, system_ids=None) -> str:
+    """
+    Return the cache key of the response to `request`, which depends on
+    the systems `system_ids` or, when `None`, on all systems of the
+    user.
+    """
+    user = request.user
+    owner_version, global_version = get_versions(
+        cache, [owner_version_key(user.pk), GLOBAL_VERSION_KEY])
+    if system_ids is None:
+        system_ids = owned_system_ids(cache, user, owner_version)
+    system_ids = sorted(set(system_ids))
+    versions = get_versions(
+        cache, [system_version_key(system_id) for system_id in system_ids])
+    digest = hashlib.sha256(repr((
+        request.path,
+        sorted(request.query_params.lists()),
+        request.accepted_media_type,
+        global_version,
+        owner_version,
+        list(zip(system_ids, versions)),
+    )).encode()).hexdigest()
+    return f'{KEY_PREFIX}:response:{user.pk}:{digest}'
+
+
+def fetch(cache, key: str, compute):
+    """
+    Return the value cached under `key` and whether it was a hit. On a
+    miss, `compute` returns the value to cache and the seconds it took,
+    or `None` when the value must not be cached. While one caller
+    computes a value, other callers wait up to `LOCK_WAIT` seconds for
+    it before computing it themselves, or until the lock is released
+    without a value, e.g. because the response was an error.
+    """
+    config = get_response_cache_settings()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, True
+
+    lock_key = f'{key}:lock'
+    locked = cache.add(lock_key, True, config['LOCK_TIMEOUT'])
+    if not locked:
+        deadline = time.monotonic() + config['LOCK_WAIT']
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            values = cache.get_many([key, lock_key])
+            if key in values:
+                return values[key], True
+            if lock_key not in values:
+                break
+    try:
+        computed = compute()
+        if computed is not None:
+            cache.set(key, computed, config['TIMEOUT'])
+        return computed, False
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+def cached_response(scope=None):
+    """
+    Cache the successful responses of a read-only view method. `scope`,
+    when given, is called with the request and returns the ids of the
+    systems the response depends on, or `None` for all systems of the
+    user.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if not get_response_cache_settings()['ENABLED']:
+                return method(view, request, *args, **kwargs)
+            cache = get_cache()
+            started = time.monotonic()
+            response = None
+
+            def compute():
+                nonlocal response
+                response = method(view, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return None
+                return response.data, time.monotonic() - started
+
+            key = response_key(
+                cache, request,
+                scope(request) if scope is not None else None)
+            cached, hit = fetch(cache, key, compute)
+            if hit:
+                data, elapsed = cached
+                saved = elapsed - (time.monotonic() - started)
+                increment(cache, f'{KEY_PREFIX}:stats:hits')
+                increment(
+                    cache, f'{KEY_PREFIX}:stats:saved_ms',
+                    max(0, round(saved * 1000)))
+                response = Response(data)
+            else:
+                increment(cache, f'{KEY_PREFIX}:stats:misses')
+            response['X-Cache'] = 'HIT' if hit else 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def get_stats() -> dict:
+    """
+    Return the hits, misses, hit ratio and milliseconds saved by hits of
+    all processes sharing the cache.
+    """
+    cache = get_cache()
+    values = cache.get_many([f'{KEY_PREFIX}:stats:{name}' for name in STATS])
+    stats = {
+        name: values.get(f'{KEY_PREFIX}:stats:{name}', 0)
+        for name in STATS}
+    requests = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / requests if requests else 0.0
+    return stats
+
+
+def reset_stats() -> None:
+    get_cache().delete_many(
+        [f'{KEY_PREFIX}:stats:{name}' for name in STATS])
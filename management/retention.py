@@ -0,0 +1,125 @@
+"""
+Retention of measurements and of their hourly and daily rollups.
+
+Readings are added to the rollups when they are stored, see
+`management.state`, so compacting old readings only needs to delete
+them: the rollups keep their averages, ranges and counts, and are no
+longer rebuilt before the cutoff of the deleted readings. Each tier is
+kept for the number of days of the `MEASUREMENT_RETENTION` setting, or
+of the system's `RetentionPolicy` when it has one.
+
+Rows are deleted in batches of `BATCH_SIZE`, each in its own short
+transaction, so writers are never blocked for long and an interrupted
+run is resumed by running it again. Cutoffs are aligned to UTC days,
+so the rollup buckets of the readings which are kept stay complete and
+can still be rebuilt from them.
+"""
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import (
+    DailyMeasurementRollup,
+    HourlyMeasurementRollup,
+    Measurement,
+    RetentionPolicy)
+from .rollups import truncate
+from .state import mark_compacted, subtract_reading_counts
+
+DEFAULT_SETTINGS = {
+    'RAW_DAYS': None,
+    'HOURLY_DAYS': None,
+    'DAILY_DAYS': None,
+    'BATCH_SIZE': 10000,
+}
+
+# Name, model and time column of every tier, finest first.
+TIERS = (
+    ('raw', Measurement, 'timestamp'),
+    ('hourly', HourlyMeasurementRollup, 'bucket'),
+    ('daily', DailyMeasurementRollup, 'bucket'))
+
+
+def get_retention_settings() -> dict:
+    return {
+        **DEFAULT_SETTINGS,
+        **getattr(settings, 'MEASUREMENT_RETENTION', {})}
+
+
+def retention_scopes(tier: str, now=None) -> list:
+    """
+    Return the cutoff, SQL condition on `system_id` and its parameters
+    of every group of systems sharing the retention of `tier`. Data
+    older than the cutoff is expired.
+    """
+    now = now or timezone.now()
+    default_days = get_retention_settings()[f'{tier.upper()}_DAYS']
+    policies = dict(RetentionPolicy.objects.values_list(
+        'system_id', f'{tier}_days'))
+
+    systems_by_days = defaultdict(list)
+    for system_id, days in policies.items():
+        if days is not None:
+            systems_by_days[days].append(system_id)
+    scopes = [
+        (days, 'system_id = ANY(%s)', [system_ids])
+        for days, system_ids in sorted(systems_by_days.items())]
+    if default_days is not None:
+        scopes.append((
+            default_days, 'NOT (system_id = ANY(%s))', [list(policies)]))
+    return [
+        (truncate(now - timedelta(days=days), 'day'), condition, params)
+        for days, condition, params in scopes]
+
+
+def delete_expired_batch(model, column, cutoff, condition, params,
+                         batch_size) -> int:
+    """
+    Delete up to `batch_size` rows of `model` older than `cutoff` from
+    the systems matching `condition`. Deleted measurements are
+    subtracted from the reading counts. Returns the number of deleted
+    rows.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(model._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'WITH removed AS ('
+            f'DELETE FROM {table} WHERE id IN ('
+            f'SELECT id FROM {table} '
+            f'WHERE {condition} AND {quote_name(column)} < %s LIMIT %s) '
+            f'RETURNING system_id) '
+            f'SELECT system_id, count(*) FROM removed GROUP BY system_id',
+            [*params, cutoff, batch_size])
+        counts = dict(cursor.fetchall())
+        if model is Measurement:
+            subtract_reading_counts(counts)
+            mark_compacted(counts, cutoff)
+    return sum(counts.values())
+
+
+def apply_retention(batch_size=None, now=None, progress=None) -> dict:
+    """
+    Delete the expired rows of every tier. `progress`, when given, is
+    called with the tier name, the rows deleted so far and the elapsed
+    seconds after every batch. Returns the number of deleted rows per
+    tier.
+    """
+    batch_size = batch_size or get_retention_settings()['BATCH_SIZE']
+    deleted = {}
+    for tier, model, column in TIERS:
+        deleted[tier] = 0
+        started = time.monotonic()
+        for cutoff, condition, params in retention_scopes(tier, now):
+            while True:
+                count = delete_expired_batch(
+                    model, column, cutoff, condition, params, batch_size)
+                deleted[tier] += count
+                if progress is not None:
+                    progress(tier, deleted[tier],
+                             time.monotonic() - started)
+                if count < batch_size:
+                    break
+    return deleted
@@ -0,0 +1,201 @@
+"""
+Hourly and daily rollups of measurements.
+
+New measurements are added to the rollups of their buckets by the
+statement which inserts them, see `management.state`. A changed
+measurement is added to the rollups of the buckets it is in with
+`add_to_rollups`, and its previous values are subtracted from those it
+was in with `remove_from_rollups`. Only a bucket whose minimum or
+maximum was a removed value is rebuilt from the stored measurements.
+`rebuild_rollups` does that for any time range and backs the
+`rebuild_rollups` management command.
+
+Buckets older than the readings retention deleted from a system, its
+`compacted_before`, are never rebuilt: the rollups are all that is left
+of them, see `management.retention`.
+"""
+from datetime import datetime, timedelta, timezone
+from django.db import connection
+from .models import (
+    METRIC_FIELDS,
+    DailyMeasurementRollup,
+    HourlyMeasurementRollup,
+    Measurement,
+    SystemCurrentState)
+
+ROLLUP_MODELS = (HourlyMeasurementRollup, DailyMeasurementRollup)
+BUCKET_SIZES = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+METRIC_ROLLUP_COLUMNS = ('count', 'sum', 'sum_squares', 'min', 'max')
+ROLLUP_COLUMNS = ('count',) + tuple(
+    f'{metric}_{name}'
+    for metric in METRIC_FIELDS
+    for name in METRIC_ROLLUP_COLUMNS)
+
+
+def truncate(value: datetime, unit: str) -> datetime:
+    """
+    Return the start of the UTC bucket of `unit` containing `value`.
+    """
+    value = value.astimezone(timezone.utc).replace(
+        minute=0, second=0, microsecond=0)
+    if unit == 'day':
+        value = value.replace(hour=0)
+    return value
+
+
+def rollup_select_sql(unit: str, source: str, where: str = '') -> str:
+    """
+    Return a `SELECT` of the system, bucket and `ROLLUP_COLUMNS` of the
+    measurements in `source`, grouped by system and bucket of `unit`.
+    """
+    timestamp = connection.ops.quote_name('timestamp')
+    aggregates = []
+    for metric in METRIC_FIELDS:
+        aggregates += [
+            f'count({metric})',
+            f'COALESCE(sum({metric}), 0)',
+            f'COALESCE(sum({metric} * {metric}), 0)',
+            f'min({metric})',
+            f'max({metric})']
+    return (
+        f"SELECT system_id, "
+        f"date_trunc('{unit}', {timestamp} AT TIME ZONE 'UTC') "
+        f"AT TIME ZONE 'UTC', count(*), {', '.join(aggregates)} "
+        f"FROM {source} {where} "
+        f"GROUP BY 1, 2 ORDER BY 1, 2")
+
+
+def add_to_rollup_sql(model, source: str, where: str = '') -> str:
+    """
+    Return a statement which adds the measurements in `source` to the
+    rollups of `model`. Concurrent writers serialize on the rollup rows,
+    and every column is merged, so their order does not matter.
+    """
+    merges = []
+    for column in ROLLUP_COLUMNS:
+        if column.endswith('_min'):
+            merges.append(f'{column} = LEAST(rollup.{column}, '
+                          f'EXCLUDED.{column})')
+        elif column.endswith('_max'):
+            merges.append(f'{column} = GREATEST(rollup.{column}, '
+                          f'EXCLUDED.{column})')
+        else:
+            merges.append(f'{column} = rollup.{column} + EXCLUDED.{column}')
+    return (
+        f'INSERT INTO {connection.ops.quote_name(model._meta.db_table)} '
+        f'AS rollup (system_id, bucket, {", ".join(ROLLUP_COLUMNS)}) '
+        f'{rollup_select_sql(model.bucket_unit, source, where)} '
+        f'ON CONFLICT (system_id, bucket) DO UPDATE SET {", ".join(merges)}')
+
+
+def rebuild_rollups(
+        start=None, end=None, system_ids=None, models=ROLLUP_MODELS) -> int:
+    """
+    Recompute the rollups of the buckets overlapping `[start, end)` from
+    the stored measurements, for the given systems or all of them. Either
+    bound may be omitted. Buckets of compacted readings are left as they
+    are. Returns the number of rollup rows written.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    state_table = quote_name(SystemCurrentState._meta.db_table)
+    timestamp = quote_name('timestamp')
+    written = 0
+    with connection.cursor() as cursor:
+        for model in models:
+            unit = model.bucket_unit
+            conditions, params = [], []
+            if start is not None:
+                conditions.append('{column} >= %s')
+                params.append(truncate(start, unit))
+            if end is not None:
+                conditions.append('{column} < %s')
+                params.append(truncate(
+                    end - timedelta(microseconds=1), unit)
+                    + BUCKET_SIZES[unit])
+            if system_ids is not None:
+                conditions.append('system_id = ANY(%s)')
+                params.append(list(system_ids))
+            conditions.append(
+                f'NOT EXISTS (SELECT 1 FROM {state_table} AS compacted '
+                f'WHERE compacted.system_id = {{table}}.system_id '
+                f'AND {{column}} < compacted.compacted_before)')
+            where = 'WHERE ' + ' AND '.join(conditions)
+
+            rollup_table = quote_name(model._meta.db_table)
+            cursor.execute(
+                f'DELETE FROM {rollup_table} ' + where.format(
+                    table=rollup_table, column=f'{rollup_table}.bucket'),
+                params)
+            select = rollup_select_sql(unit, table, where.format(
+                table=table, column=f'{table}.{timestamp}'))
+            updates = ', '.join(
+                f'{column} = EXCLUDED.{column}' for column in ROLLUP_COLUMNS)
+            cursor.execute(
+                f'INSERT INTO {rollup_table} '
+                f'(system_id, bucket, {", ".join(ROLLUP_COLUMNS)}) {select} '
+                f'ON CONFLICT (system_id, bucket) DO UPDATE SET {updates}',
+                params)
+            written += cursor.rowcount
+    return written
+
+
+def add_to_rollups(measurement) -> None:
+    """
+    Add a stored measurement to the rollups of its buckets, after it was
+    changed.
+    """
+    quote_name = connection.ops.quote_name
+    where = f'WHERE id = %s AND {quote_name("timestamp")} = %s'
+    with connection.cursor() as cursor:
+        for model in ROLLUP_MODELS:
+            cursor.execute(
+                add_to_rollup_sql(
+                    model, quote_name(Measurement._meta.db_table), where),
+                [measurement.pk, measurement.timestamp])
+
+
+def remove_from_rollups(measurement) -> None:
+    """
+    Subtract the values of a measurement which was changed or deleted
+    from the rollups of its buckets. A bucket left empty, or whose
+    minimum or maximum was one of the values, is rebuilt, unless it is
+    older than the compacted readings of the system. Call it inside the
+    transaction of the change, after the changed measurement was added
+    to its rollups.
+    """
+    quote_name = connection.ops.quote_name
+    updates, params = ['count = count - 1'], []
+    for metric in METRIC_FIELDS:
+        value = getattr(measurement, metric)
+        updates += [
+            f'{metric}_count = {metric}_count - %s',
+            f'{metric}_sum = {metric}_sum - %s',
+            f'{metric}_sum_squares = {metric}_sum_squares - %s']
+        params += [
+            int(value is not None), value or 0, (value or 0) ** 2]
+    returning = ', '.join(
+        f'{metric}_{name}'
+        for metric in METRIC_FIELDS for name in ('min', 'max'))
+
+    with connection.cursor() as cursor:
+        for model in ROLLUP_MODELS:
+            bucket = truncate(measurement.timestamp, model.bucket_unit)
+            cursor.execute(
+                f'UPDATE {quote_name(model._meta.db_table)} '
+                f'SET {", ".join(updates)} '
+                f'WHERE system_id = %s AND bucket = %s '
+                f'RETURNING count, {returning}',
+                params + [measurement.system_id, bucket])
+            row = cursor.fetchone()
+            if row is None:
+                continue
+            count, *extremes = row
+            values = [
+                getattr(measurement, metric) for metric in METRIC_FIELDS]
+            if count == 0 or any(
+                    value is not None and value in extremes[2 * i:2 * i + 2]
+                    for i, value in enumerate(values)):
+                rebuild_rollups(
+                    bucket, bucket + timedelta(microseconds=1),
+                    [measurement.system_id], models=[model])
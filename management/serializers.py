@@ -1,11 +1,53 @@
-from rest_framework import serializers
-from .models import HydroponicSystem, Measurement
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .models import (
+    DeviceKey,
+    HydroponicSystem,
+    Measurement,
+    SystemCurrentState)
+from .state import save_measurements
+from .utils import get_owned_systems, parse_system_id
+
+MAX_BULK_MEASUREMENTS = 10000
+
+
+class SystemCurrentStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SystemCurrentState
+        fields = [
+            'ph',
+            'temperature',
+            'tds',
+            'timestamp',
+            'reading_count',
+            'last_seen']
+
+
+class RecentMeasurementSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Measurement
+        fields = [
+            'id',
+            'ph',
+            'temperature',
+            'tds',
+            'timestamp']
 
 
 class HydroponicSystemSerializer(serializers.ModelSerializer):
+    """
+    `recent_measurements` is rendered from the attribute of the same name
+    set by a prefetch, and omitted when the systems were loaded without.
+    """
+
     owner = serializers.SerializerMethodField()
     created_at = serializers.DateTimeField(read_only=True)
     updated_at = serializers.DateTimeField(read_only=True)
+    current_state = SystemCurrentStateSerializer(read_only=True)
+    recent_measurements = RecentMeasurementSerializer(
+        many=True, read_only=True)
 
     class Meta:
         model = HydroponicSystem
@@ -15,16 +57,57 @@ class HydroponicSystemSerializer(serializers.ModelSerializer):
             'name',
             'description',
             'created_at',
-            'updated_at']
+            'updated_at',
+            'current_state',
+            'recent_measurements']
 
     def get_owner(self, obj):
         return obj.owner.username
 
+    def create(self, validated_data):
+        instance = super().create(validated_data)
+        # A new system has no readings yet, so rendering it does not
+        # have to look up its current state.
+        HydroponicSystem.current_state.related.set_cached_value(
+            instance, None)
+        instance.recent_measurements = []
+        return instance
+
+
+class DeviceKeySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeviceKey
+        fields = [
+            'id',
+            'name',
+            'prefix',
+            'created_at']
+        read_only_fields = ['prefix', 'created_at']
+
+
+class OwnedSystemField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key field which only accepts systems owned by the requesting
+    user. Systems are resolved through the per-request `OwnedSystemCache`,
+    so the ownership check and the lookup are one scoped query.
+    """
+
+    def get_queryset(self):
+        return HydroponicSystem.objects.filter(
+            owner_id=self.context['request'].user.pk)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool) or parse_system_id(data) is None:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        system = get_owned_systems(self.context['request']).get(data)
+        if system is None:
+            self.fail('does_not_exist', pk_value=data)
+        return system
+
 
 class MeasurementSerializer(serializers.ModelSerializer):
-    system = serializers.PrimaryKeyRelatedField(
+    system = OwnedSystemField(
         queryset=HydroponicSystem.objects.all())
-    timestamp = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = Measurement
@@ -34,12 +117,109 @@ class MeasurementSerializer(serializers.ModelSerializer):
             'ph',
             'temperature',
             'tds',
-            'timestamp']
+            'timestamp',
+            'idempotency_key']
+        # Duplicate idempotency keys are not an error,
+        # retries resolve to the measurement stored first.
+        validators = []
+
+    def create(self, validated_data):
+        measurement = Measurement(**validated_data)
+        inserted = save_measurements([measurement])
+        if inserted:
+            measurement.pk = inserted[0].pk
+            measurement._state.adding = False
+            return measurement
+        # A partitioned table can hold the key once per timestamp.
+        return Measurement.objects.filter(
+            system=validated_data['system'],
+            idempotency_key=validated_data['idempotency_key']).order_by(
+                'id').first()
+
+    def update(self, instance, validated_data):
+        validated_data.pop('idempotency_key', None)
+        return super().update(instance, validated_data)
+
+
+# Columns read by the read-only fast path, in the order of the fields of
+# `MeasurementSerializer`.
+MEASUREMENT_VALUES = (
+    'id',
+    'system_id',
+    'ph',
+    'temperature',
+    'tds',
+    'timestamp',
+    'idempotency_key')
+
+
+def measurement_values(queryset):
+    """
+    Return `queryset` as dicts of the columns of `MEASUREMENT_VALUES`,
+    to be represented with `represent_measurements`.
+    """
+    return queryset.values(*MEASUREMENT_VALUES)
+
+
+def represent_measurements(rows) -> list:
+    """
+    Represent rows of `measurement_values` exactly like
+    `MeasurementSerializer(many=True).data` would represent the same
+    measurements, without building model instances or serializer fields
+    for every row. Used by read-only responses with many measurements.
+    """
+    if api_settings.DATETIME_FORMAT == ISO_8601 and settings.USE_TZ:
+        current_timezone = timezone.get_current_timezone()
+
+        def format_timestamp(value):
+            value = value.astimezone(current_timezone).isoformat()
+            if value.endswith('+00:00'):
+                value = value[:-6] + 'Z'
+            return value
+    else:
+        format_timestamp = serializers.DateTimeField().to_representation
+
+    return [
+        {'id': row['id'],
+         'system': row['system_id'],
+         'ph': row['ph'],
+         'temperature': row['temperature'],
+         'tds': row['tds'],
+         'timestamp': format_timestamp(row['timestamp']),
+         'idempotency_key': row['idempotency_key']}
+        for row in rows]
+
+
+class MeasurementBulkListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        return save_measurements(
+            [Measurement(**item) for item in validated_data])
+
+
+class MeasurementBulkSerializer(serializers.ModelSerializer):
+    """
+    Serializer for batches of measurements. Ownership of the systems
+    is resolved once per batch and passed in the `owned_system_ids`
+    context, and rows are written with `save_measurements`, which skips
+    measurements whose idempotency key is already stored.
+    """
+
+    system = serializers.IntegerField(source='system_id')
+
+    class Meta:
+        model = Measurement
+        fields = [
+            'system',
+            'ph',
+            'temperature',
+            'tds',
+            'timestamp',
+            'idempotency_key']
+        list_serializer_class = MeasurementBulkListSerializer
+        validators = []
 
     def validate_system(self, value):
-        try:
-            HydroponicSystem.objects.get(pk=value.pk)
-        except HydroponicSystem.DoesNotExist:
+        if value not in self.context['owned_system_ids']:
             raise serializers.ValidationError(
                 "Hydroponic system does not exist.")
         return value
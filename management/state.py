@@ -0,0 +1,212 @@
+"""
+Maintenance of the denormalized `SystemCurrentState` table.
+
+New measurements are inserted with one statement which also upserts the
+current state of their systems and adds them to their rollups, see
+`management.rollups`, so both are always written in the same
+transaction as the readings. Concurrent writers serialize on the
+state row of each system, and a reading only replaces the latest values
+when it is not older than them, so the order in which writers commit
+does not matter. Only inserted rows are counted, so retried uploads
+whose idempotency key is already stored do not inflate `reading_count`.
+Every change of the readings of a system also invalidates its cached
+responses, see `management.response_cache`.
+"""
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Greatest, Now
+from .models import Measurement, SystemCurrentState
+from .response_cache import invalidate, invalidate_all
+from .rollups import ROLLUP_MODELS, add_to_rollup_sql
+
+INSERT_COLUMNS = (
+    'system_id',
+    'ph',
+    'temperature',
+    'tds',
+    'timestamp',
+    'idempotency_key')
+RETURNING_COLUMNS = ('id',) + INSERT_COLUMNS
+STATE_VALUE_COLUMNS = ('ph', 'temperature', 'tds', 'timestamp')
+
+# Keeps the parameters of one statement below the PostgreSQL limit.
+SAVE_BATCH_SIZE = 5000
+
+
+def insert_measurements_sql(source: str) -> str:
+    """
+    Return a statement which inserts the rows of `source`, a `VALUES`
+    list or a `SELECT` of the `INSERT_COLUMNS`, skips rows whose
+    idempotency key is already stored, folds the inserted rows into the
+    current state and rollups of their systems and returns the inserted
+    rows.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    state_table = quote_name(SystemCurrentState._meta.db_table)
+    columns = ', '.join(quote_name(column) for column in INSERT_COLUMNS)
+    returning = ', '.join(
+        quote_name(column) for column in RETURNING_COLUMNS)
+    values = ', '.join(quote_name(column) for column in STATE_VALUE_COLUMNS)
+    timestamp = quote_name('timestamp')
+    newer = (
+        f'state.{timestamp} IS NULL '
+        f'OR EXCLUDED.{timestamp} >= state.{timestamp}')
+    updates = ', '.join(
+        f'{quote_name(column)} = CASE WHEN {newer} '
+        f'THEN EXCLUDED.{quote_name(column)} '
+        f'ELSE state.{quote_name(column)} END'
+        for column in STATE_VALUE_COLUMNS)
+    statements = [
+        f'inserted AS ('
+        f'INSERT INTO {table} ({columns}) {source} '
+        f'ON CONFLICT DO NOTHING RETURNING {returning})',
+        f'latest AS ('
+        f'SELECT DISTINCT ON (system_id) system_id, {values}, '
+        f'count(*) OVER (PARTITION BY system_id) AS reading_count '
+        f'FROM inserted '
+        f'ORDER BY system_id, {timestamp} DESC, id DESC)',
+        f'upserted AS ('
+        f'INSERT INTO {state_table} AS state '
+        f'(system_id, {values}, reading_count, last_seen, version, '
+        f'changed_at) '
+        f'SELECT system_id, {values}, reading_count, now(), 1, now() '
+        f'FROM latest '
+        f'ON CONFLICT (system_id) DO UPDATE SET {updates}, '
+        f'reading_count = state.reading_count + EXCLUDED.reading_count, '
+        f'last_seen = GREATEST(state.last_seen, EXCLUDED.last_seen), '
+        f'version = state.version + 1, changed_at = EXCLUDED.changed_at)']
+    statements += [
+        f'{model.bucket_unit}_rollup AS ('
+        f'{add_to_rollup_sql(model, "inserted")})'
+        for model in ROLLUP_MODELS]
+    return f'WITH {", ".join(statements)} SELECT {returning} FROM inserted'
+
+
+def save_measurements(measurements, batch_size=SAVE_BATCH_SIZE) -> list:
+    """
+    Insert unsaved measurements and update the current state of their
+    systems with one statement per `batch_size` measurements. Returns
+    the inserted measurements; measurements whose idempotency key was
+    already stored are skipped. Wrap the call in a transaction when the
+    batches should be committed together.
+    """
+    placeholders = '(' + ', '.join(['%s'] * len(INSERT_COLUMNS)) + ')'
+    inserted = []
+    with connection.cursor() as cursor:
+        for start in range(0, len(measurements), batch_size):
+            batch = measurements[start:start + batch_size]
+            cursor.execute(
+                insert_measurements_sql(
+                    'VALUES ' + ', '.join([placeholders] * len(batch))),
+                [getattr(measurement, column)
+                 for measurement in batch
+                 for column in INSERT_COLUMNS])
+            inserted.extend(
+                Measurement.from_db(connection.alias, RETURNING_COLUMNS, row)
+                for row in cursor.fetchall())
+    invalidate(measurement.system_id for measurement in inserted)
+    return inserted
+
+
+def refresh_current_state(system_id, count_delta: int = 0) -> None:
+    """
+    Recompute the latest values of a system from its stored measurements
+    after one of them was changed or deleted, and add `count_delta` to
+    its reading count. Must be called inside a transaction: the state
+    row is locked first, so that the recomputation sees every reading
+    committed by concurrent writers. Systems without a state row yet
+    are rebuilt from their measurements.
+    """
+    invalidate([system_id])
+    state = SystemCurrentState.objects.filter(system_id=system_id)
+    if not list(state.select_for_update().values_list('pk', flat=True)):
+        rebuild_current_state([system_id])
+        return
+    latest = Measurement.objects.filter(
+        system_id=OuterRef('system_id')).order_by('-timestamp', '-id')
+    state.update(
+        **{column: Subquery(latest.values(column)[:1])
+           for column in STATE_VALUE_COLUMNS},
+        reading_count=Greatest(F('reading_count') + count_delta, 0),
+        version=F('version') + 1,
+        changed_at=Now())
+
+
+def subtract_reading_counts(counts) -> None:
+    """
+    Subtract the numbers of measurements removed in bulk, a mapping of
+    system ids to counts, from the reading counts of their systems. The
+    latest values are kept.
+    """
+    if not counts:
+        return
+    invalidate(counts)
+    state_table = connection.ops.quote_name(
+        SystemCurrentState._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {state_table} AS state SET reading_count = '
+            f'GREATEST(state.reading_count - removed.reading_count, 0), '
+            f'version = state.version + 1, changed_at = now() '
+            f'FROM unnest(%s::bigint[], %s::bigint[]) '
+            f'AS removed(system_id, reading_count) '
+            f'WHERE state.system_id = removed.system_id',
+            [list(counts), list(counts.values())])
+
+
+def mark_compacted(system_ids, cutoff) -> None:
+    """
+    Record that the readings of `system_ids` older than `cutoff` were
+    deleted by retention.
+    """
+    if not system_ids:
+        return
+    state_table = connection.ops.quote_name(
+        SystemCurrentState._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {state_table} AS state '
+            f'(system_id, reading_count, version, compacted_before) '
+            f'SELECT unnest(%s::bigint[]), 0, 0, %s '
+            f'ON CONFLICT (system_id) DO UPDATE SET compacted_before = '
+            f'GREATEST(state.compacted_before, EXCLUDED.compacted_before)',
+            [list(system_ids), cutoff])
+
+
+def rebuild_current_state(system_ids=None) -> int:
+    """
+    Recompute the current state of the given systems, or of all systems,
+    from their stored measurements. Returns the number of state rows
+    written.
+    """
+    quote_name = connection.ops.quote_name
+    table = quote_name(Measurement._meta.db_table)
+    state_table = quote_name(SystemCurrentState._meta.db_table)
+    values = ', '.join(quote_name(column) for column in STATE_VALUE_COLUMNS)
+    timestamp = quote_name('timestamp')
+    updates = ', '.join(
+        f'{column} = EXCLUDED.{column}'
+        for column in (
+            [quote_name(column) for column in STATE_VALUE_COLUMNS]
+            + ['reading_count']))
+    where, params = '', []
+    if system_ids is not None:
+        where, params = 'WHERE system_id = ANY(%s)', [list(system_ids)]
+        invalidate(system_ids)
+    else:
+        invalidate_all()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {state_table} '
+            f'(system_id, {values}, reading_count, last_seen, version, '
+            f'changed_at) '
+            f'SELECT DISTINCT ON (system_id) system_id, {values}, '
+            f'count(*) OVER (PARTITION BY system_id), {timestamp}, 1, now() '
+            f'FROM {table} {where} '
+            f'ORDER BY system_id, {timestamp} DESC, id DESC '
+            f'ON CONFLICT (system_id) DO UPDATE SET {updates}, '
+            f'version = {state_table}.version + 1, '
+            f'changed_at = EXCLUDED.changed_at',
+            params)
+        return cursor.rowcount
@@ -0,0 +1,207 @@
+from datetime import datetime, timezone
+from unittest import mock
+from rest_framework import status
+from django.contrib.auth.models import User
+from hydroponics.pagination import CustomPageNumberPagination
+from ..models import HydroponicSystem, Measurement
+from .utils import APITestCase, generate_jwt_token
+
+
+class BaseTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        cls.other_user = User.objects.create_user(
+            username='other_user', password='other_password')
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.other_system = HydroponicSystem.objects.create(
+            owner=cls.other_user, name='Other', description='Other')
+
+    def setUp(self):
+        self.tokens = generate_jwt_token(
+            self.client, 'test_user', 'test_password')
+        self.access_token = self.tokens['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+
+class AsyncMeasurementCreateTestCase(BaseTestCase):
+    url = '/api/async/measurements/'
+
+    def test_create_measurement(self):
+        data = {
+            'system': self.system.id,
+            'ph': 6.5,
+            'temperature': 25.5,
+            'tds': 800}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        measurement = Measurement.objects.get()
+        self.assertEqual(response.json()['id'], measurement.id)
+        self.assertEqual(response.json()['system'], self.system.id)
+        self.assertEqual(measurement.ph, 6.5)
+
+    def test_create_measurement_idempotent(self):
+        data = {
+            'system': self.system.id,
+            'ph': 6.5,
+            'idempotency_key': 'k1'}
+        first = self.client.post(self.url, data, format='json')
+        second = self.client.post(self.url, data, format='json')
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(Measurement.objects.count(), 1)
+
+    def test_create_measurement_invalid(self):
+        data = {'system': self.system.id, 'ph': 20}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('ph', response.json())
+
+    def test_create_measurement_not_owner(self):
+        data = {'system': self.other_system.id, 'ph': 6.5}
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_create_measurement_unauthenticated(self):
+        self.client.credentials()
+        response = self.client.post(
+            self.url, {'system': self.system.id}, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_create_measurement_invalid_token(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + 'invalid_token')
+        response = self.client.post(
+            self.url, {'system': self.system.id}, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(
+            response.json()['detail'],
+            'Given token not valid for any token type')
+
+
+class AsyncMeasurementListTestCase(BaseTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Measurement.objects.bulk_create([
+            Measurement(system=cls.system, ph=6.0 + index / 10)
+            for index in range(12)])
+        Measurement.objects.create(system=cls.other_system, ph=7.0)
+
+    def test_list_matches_sync_endpoint(self):
+        async_data = self.client.get(
+            '/api/async/measurements/?page_size=5').json()
+        sync_data = self.client.get(
+            '/api/measurements/?page_size=5').json()
+        self.assertEqual(async_data['count'], 12)
+        self.assertEqual(async_data['results'], sync_data['results'])
+        self.assertIsNotNone(async_data['next'])
+        self.assertIsNone(async_data['previous'])
+
+    def test_list_last_page(self):
+        data = self.client.get(
+            '/api/async/measurements/?page_size=5&page=3').json()
+        self.assertEqual(len(data['results']), 2)
+        self.assertIsNone(data['next'])
+        self.assertIsNotNone(data['previous'])
+
+    def test_list_parameters_match_sync_endpoint(self):
+        for query in (
+                'ph_min=6.5&ph_max=7.0',
+                'temperature_min=20',
+                f'system={self.system.id}&tds_max=1000',
+                'timestamp_min=2000-01-01T00:00:00Z&since=1h',
+                'since=24h&page_size=3&page=2',
+                'ordering=-ph&page_size=4',
+                'count=capped&page=last&page_size=5',
+                'count=exact&page_size=abc',
+                'ph_min=abc',
+                'page=5'):
+            with self.subTest(query=query):
+                async_response = self.client.get(
+                    f'/api/async/measurements/?{query}')
+                sync_response = self.client.get(
+                    f'/api/measurements/?{query}')
+                self.assertEqual(
+                    async_response.status_code, sync_response.status_code)
+                async_data = async_response.json()
+                sync_data = sync_response.json()
+                for data in (async_data, sync_data):
+                    if isinstance(data, dict):
+                        for key in ('next', 'previous'):
+                            if data.get(key):
+                                data[key] = data[key].replace('/async', '')
+                self.assertEqual(async_data, sync_data)
+
+    def test_list_inexact_counts_match_sync_endpoint(self):
+        with mock.patch.object(
+                CustomPageNumberPagination, 'count_limit', 5):
+            for query in (
+                    'count=capped&page_size=4',
+                    'count=capped&page=3&page_size=5',
+                    'count=estimated&page=2&page_size=5',
+                    'count=capped&page=4&page_size=5'):
+                with self.subTest(query=query):
+                    async_response = self.client.get(
+                        f'/api/async/measurements/?{query}')
+                    sync_response = self.client.get(
+                        f'/api/measurements/?{query}')
+                    self.assertEqual(
+                        async_response.status_code,
+                        sync_response.status_code)
+                    async_data = async_response.json()
+                    sync_data = sync_response.json()
+                    for key in ('next', 'previous'):
+                        if async_data.get(key):
+                            async_data[key] = async_data[key].replace(
+                                '/async', '')
+                    self.assertEqual(async_data, sync_data)
+
+    def test_list_rejects_unsupported_parameters(self):
+        for query in (
+                f'system={self.system.id}&downsample=100',
+                'pagination=keyset',
+                'format=frames'):
+            with self.subTest(query=query):
+                response = self.client.get(
+                    f'/api/async/measurements/?{query}')
+                self.assertEqual(
+                    response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('not supported', response.json()['error'])
+
+    def test_last_measurements(self):
+        response = self.client.get(
+            '/api/async/measurements/last-measurements/'
+            '?system_name=Sys1&num_measurements=3')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [row['ph'] for row in response.json()], [7.1, 7.0, 6.9])
+
+    def test_last_measurements_with_equal_timestamps(self):
+        # Later than the other measurements.
+        timestamp = datetime(2100, 1, 1, tzinfo=timezone.utc)
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=self.system, ph=5.0 + index / 10, timestamp=timestamp)
+            for index in range(3)])
+        params = '?system_name=Sys1&num_measurements=2'
+        async_data = self.client.get(
+            f'/api/async/measurements/last-measurements/{params}').json()
+        sync_data = self.client.get(
+            f'/api/measurements/last-measurements/{params}').json()
+        self.assertEqual([row['ph'] for row in async_data], [5.2, 5.1])
+        self.assertEqual(async_data, sync_data)
+
+    def test_last_measurements_not_owner(self):
+        response = self.client.get(
+            '/api/async/measurements/last-measurements/'
+            '?system_name=Other')
+        self.assertEqual(
+            response.status_code, status.HTTP_404_NOT_FOUND)
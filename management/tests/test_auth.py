@@ -1,6 +1,18 @@
-from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from io import StringIO
 from django.contrib.auth.models import User
-from .utils import generate_jwt_token
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from hydroponics.authentication import (
+    CachedJWTAuthentication,
+    ExpiringLRUCache,
+    get_user_cache_limits,
+    user_cache)
+from ..device_keys import create_device_key
+from ..models import DeviceKey, HydroponicSystem, Measurement
+from .utils import APITestCase, generate_jwt_token
 
 
 class GenerateJWTTokenTestCase(APITestCase):
@@ -30,3 +42,256 @@ class GenerateJWTTokenTestCase(APITestCase):
         tokens = generate_jwt_token(
             self.client, 'test_user', 'wrong_password')
         self.assertIsNone(tokens)
+
+
+class CachedJWTAuthenticationTestCase(APITestCase):
+    url = '/api/hydroponic-systems/'
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        self.system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys1')
+        self.access_token = generate_jwt_token(
+            self.client, 'test_user', 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def count_user_queries(self, method='get', url=None, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(
+                url or self.url, data, format='json')
+        return response, sum(
+            'FROM "auth_user"' in query['sql']
+            and 'JOIN "auth_user"' not in query['sql']
+            for query in queries.captured_queries)
+
+    def test_user_is_looked_up_once(self):
+        self.assertEqual(self.count_user_queries()[1], 1)
+        response, user_queries = self.count_user_queries()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(user_queries, 0)
+
+    def test_requests_get_their_own_user_instance(self):
+        self.count_user_queries()
+        first = CachedJWTAuthentication().get_user(
+            AccessToken(self.access_token))
+        second = CachedJWTAuthentication().get_user(
+            AccessToken(self.access_token))
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+
+    def test_deactivated_user_is_rejected(self):
+        self.count_user_queries()
+        self.user.is_active = False
+        self.user.save()
+        response, user_queries = self.count_user_queries()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(user_queries, 1)
+
+    def test_deleted_user_is_rejected(self):
+        self.count_user_queries()
+        self.user.delete()
+        self.assertEqual(self.count_user_queries()[0].status_code, 401)
+
+    def test_changed_user_is_reloaded(self):
+        self.count_user_queries()
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        # Changes which bypass the signals are seen once the entry
+        # expires.
+        self.assertEqual(self.count_user_queries()[0].status_code, 200)
+        with override_settings(JWT_AUTHENTICATION={'USER_CACHE_TIMEOUT': 0}):
+            self.assertEqual(self.count_user_queries()[0].status_code, 401)
+
+    def test_cache_is_bounded(self):
+        cache = ExpiringLRUCache(get_user_cache_limits)
+        with override_settings(JWT_AUTHENTICATION={'USER_CACHE_MAX_SIZE': 2}):
+            for user_id in range(3):
+                cache.put(user_id, User(pk=user_id), cache.generation)
+            self.assertIsNone(cache.get(0))
+            cache.get(1)
+            cache.put(3, User(pk=3), cache.generation)
+            self.assertIsNone(cache.get(2))
+            self.assertEqual(cache.get(1).pk, 1)
+            self.assertEqual(cache.get(3).pk, 3)
+
+    def test_user_loaded_before_an_eviction_is_not_stored(self):
+        cache = ExpiringLRUCache(get_user_cache_limits)
+        generation = cache.generation
+        cache.evict(self.user.pk)
+        cache.put(self.user.pk, self.user, generation)
+        self.assertIsNone(cache.get(self.user.pk))
+
+    def test_async_views_use_the_cache(self):
+        url = '/api/async/measurements/'
+        self.assertEqual(self.count_user_queries(url=url)[1], 1)
+        self.assertEqual(self.count_user_queries(url=url)[1], 0)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(
+            self.count_user_queries(url=url)[0].status_code, 401)
+
+    @override_settings(JWT_AUTHENTICATION={'STATELESS_INGEST': True})
+    def test_stateless_ingest(self):
+        for method, url, data in (
+                ('post', '/api/measurements/',
+                 {'system': self.system.id, 'ph': 6.5}),
+                ('post', '/api/measurements/bulk/',
+                 [{'system': self.system.id, 'ph': 6.5}]),
+                ('post', '/api/async/measurements/',
+                 {'system': self.system.id, 'ph': 6.5})):
+            with self.subTest(url=url):
+                user_cache.clear()
+                response, user_queries = self.count_user_queries(
+                    method, url, data)
+                self.assertEqual(response.status_code, 201, response.content)
+                self.assertEqual(user_queries, 0)
+        self.assertEqual(Measurement.objects.count(), 3)
+
+    @override_settings(JWT_AUTHENTICATION={'STATELESS_INGEST': True})
+    def test_stateless_ingest_checks_ownership(self):
+        other_user = User.objects.create_user(
+            username='other_user', password='test_password')
+        other_system = HydroponicSystem.objects.create(
+            owner=other_user, name='Other')
+        response = self.client.post(
+            '/api/measurements/', {'system': other_system.id, 'ph': 6.5},
+            format='json')
+        self.assertEqual(response.status_code, 400)
+        # Reads still resolve the user.
+        self.assertEqual(self.count_user_queries()[1], 1)
+
+
+class DeviceKeyTestCase(APITestCase):
+    url = '/api/measurements/'
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        self.system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys1')
+        self.other_system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys2')
+        self.device_key, self.key = create_device_key(self.system, 'probe')
+        self.client.credentials(HTTP_AUTHORIZATION='Device ' + self.key)
+
+    def login(self):
+        access_token = generate_jwt_token(
+            self.client, 'test_user', 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + access_token)
+
+    def post(self, url, data):
+        return self.client.post(url, data, format='json')
+
+    def test_manage_keys(self):
+        self.login()
+        keys_url = f'/api/hydroponic-systems/{self.system.id}/device-keys/'
+        response = self.post(keys_url, {'name': 'sensor'})
+        self.assertEqual(response.status_code, 201, response.content)
+        key = response.json()['key']
+        prefix = response.json()['prefix']
+        self.assertTrue(key.startswith(f'hyd_{prefix}_'))
+        self.assertNotIn(key, DeviceKey.objects.get(
+            prefix=prefix).key_hash)
+
+        response = self.client.get(keys_url)
+        self.assertEqual(
+            [row['name'] for row in response.json()], ['probe', 'sensor'])
+        self.assertNotIn('key', response.json()[0])
+
+        response = self.client.delete(
+            f'{keys_url}{response.json()[1]["id"]}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.delete(
+            f'{keys_url}{self.device_key.id + 100}/').status_code, 404)
+
+    def test_other_users_cannot_manage_keys(self):
+        User.objects.create_user(
+            username='other_user', password='test_password')
+        access_token = generate_jwt_token(
+            self.client, 'other_user', 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + access_token)
+        response = self.client.get(
+            f'/api/hydroponic-systems/{self.system.id}/device-keys/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_ingest(self):
+        for method, url, data in (
+                ('post', self.url, {'system': self.system.id, 'ph': 6.5}),
+                ('post', f'{self.url}bulk/',
+                 [{'system': self.system.id, 'ph': 6.5}]),
+                ('post', '/api/async/measurements/',
+                 {'system': self.system.id, 'ph': 6.5})):
+            with self.subTest(url=url):
+                with CaptureQueriesContext(connection) as queries:
+                    response = getattr(self.client, method)(
+                        url, data, format='json')
+                self.assertEqual(response.status_code, 201, response.content)
+                self.assertFalse(any(
+                    'FROM "auth_user"' in query['sql']
+                    for query in queries.captured_queries))
+        response = self.client.generic(
+            'POST', f'{self.url}stream/',
+            f'{{"system": {self.system.id}, "ph": 6.5}}'.encode(),
+            content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(Measurement.objects.count(), 4)
+
+    def test_key_lookup_is_cached(self):
+        self.post(self.url, {'system': self.system.id, 'ph': 6.5})
+        with CaptureQueriesContext(connection) as queries:
+            self.post(self.url, {'system': self.system.id, 'ph': 6.5})
+        self.assertFalse(any(
+            'management_devicekey' in query['sql']
+            for query in queries.captured_queries))
+
+    def test_keys_are_scoped_to_their_system(self):
+        for url, data in (
+                (self.url, {'system': self.other_system.id, 'ph': 6.5}),
+                ('/api/async/measurements/',
+                 {'system': self.other_system.id, 'ph': 6.5})):
+            with self.subTest(url=url):
+                self.assertEqual(self.post(url, data).status_code, 400)
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_keys_cannot_read(self):
+        for url in (
+                self.url,
+                f'{self.url}last-measurements/',
+                '/api/hydroponic-systems/',
+                f'/api/hydroponic-systems/{self.system.id}/device-keys/',
+                '/api/async/measurements/'):
+            with self.subTest(url=url):
+                self.assertIn(
+                    self.client.get(url).status_code, (401, 403))
+
+    def test_invalid_keys_are_rejected(self):
+        prefix = self.device_key.prefix
+        for key in (
+                f'hyd_{prefix}_wrong',
+                f'hyd_{prefix}',
+                'hyd_unknown_secret',
+                'malformed'):
+            self.client.credentials(HTTP_AUTHORIZATION='Device ' + key)
+            for url in (self.url, '/api/async/measurements/'):
+                with self.subTest(key=key, url=url):
+                    response = self.post(
+                        url, {'system': self.system.id, 'ph': 6.5})
+                    self.assertEqual(response.status_code, 401)
+
+    def test_revoked_key_is_rejected(self):
+        self.post(self.url, {'system': self.system.id, 'ph': 6.5})
+        self.device_key.delete()
+        response = self.post(self.url, {'system': self.system.id, 'ph': 6.5})
+        self.assertEqual(response.status_code, 401)
+
+    def test_create_device_key_command(self):
+        out = StringIO()
+        call_command(
+            'create_device_key', str(self.system.id), 'probe', stdout=out)
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Device ' + out.getvalue().strip())
+        response = self.post(self.url, {'system': self.system.id, 'ph': 6.5})
+        self.assertEqual(response.status_code, 201, response.content)
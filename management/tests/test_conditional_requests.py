@@ -0,0 +1,168 @@
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.http import http_date
+from ..models import HydroponicSystem, Measurement, SystemCurrentState
+from ..state import rebuild_current_state
+from .utils import APITestCase, generate_jwt_token
+
+
+class ConditionalRequestTestCase(APITestCase):
+    url = '/api/measurements/'
+    systems_url = '/api/hydroponic-systems/'
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        User.objects.create_user(
+            username='other_user', password='test_password')
+        self.system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys1')
+        self.other_system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys2')
+        self.login('test_user')
+        for system in (self.system, self.other_system):
+            self.post_measurement(system)
+
+    def login(self, username):
+        access_token = generate_jwt_token(
+            self.client, username, 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + access_token)
+
+    def post_measurement(self, system, **data):
+        response = self.client.post(
+            self.url, {'system': system.id, 'ph': 6.5, **data},
+            format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+
+    def get_etag(self, url, params=None):
+        response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response['ETag']
+
+    def assertNotModified(self, url, etag, params=None):
+        response = self.client.get(
+            url, params or {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_validators(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertNotIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(
+            f'{self.url}{Measurement.objects.first().id}/')
+        last_modified = max(
+            [state.changed_at for state in SystemCurrentState.objects.all()]
+            + [system.updated_at for system in HydroponicSystem.objects.all()])
+        self.assertEqual(
+            response['Last-Modified'],
+            http_date(int(last_modified.timestamp())))
+
+    def test_unchanged_data_is_not_modified(self):
+        for url, params in (
+                (self.url, {}),
+                (f'{self.url}{Measurement.objects.first().id}/', {}),
+                (f'{self.url}last-measurements/', {'system_name': 'Sys1'}),
+                (f'{self.url}last-measurements-by-system/',
+                 {'system': self.system.id}),
+                (f'{self.url}aggregate/', {'bucket': 'hour'}),
+                (self.systems_url, {}),
+                (f'{self.systems_url}{self.system.id}/', {})):
+            with self.subTest(url=url):
+                self.assertNotModified(
+                    url, self.get_etag(url, params), params)
+
+    def test_not_modified_skips_building_the_response(self):
+        etag = self.get_etag(self.url)
+        # the validators
+        with self.assertNumQueries(1):
+            self.assertNotModified(self.url, etag)
+
+    def test_if_modified_since(self):
+        url = f'{self.systems_url}{self.system.id}/'
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=http_date(
+                (timezone.now() + timedelta(minutes=1)).timestamp()))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=http_date(
+                (timezone.now() - timedelta(minutes=1)).timestamp()))
+        self.assertEqual(response.status_code, 200)
+
+    def test_lists_ignore_if_modified_since(self):
+        # Deleting a system changes the lists, but not the time the
+        # remaining systems last changed.
+        self.client.delete(f'{self.systems_url}{self.other_system.id}/')
+        since = http_date((timezone.now() + timedelta(minutes=1)).timestamp())
+        for url, params in (
+                (self.url, {}),
+                (f'{self.url}last-measurements-by-system/',
+                 {'system': self.system.id}),
+                (f'{self.url}aggregate/', {'bucket': 'hour'}),
+                (self.systems_url, {})):
+            with self.subTest(url=url):
+                response = self.client.get(
+                    url, params, HTTP_IF_MODIFIED_SINCE=since)
+                self.assertEqual(response.status_code, 200)
+
+    def test_etag_depends_on_parameters_and_user(self):
+        etag = self.get_etag(self.url)
+        self.assertNotEqual(etag, self.get_etag(self.url, {'page_size': 1}))
+        self.login('other_user')
+        self.assertNotEqual(etag, self.get_etag(self.url))
+
+    def test_measurement_writes_change_the_etag(self):
+        etag = self.get_etag(self.url)
+        self.post_measurement(self.system, ph=7.0)
+        changed = self.get_etag(self.url)
+        self.assertNotEqual(etag, changed)
+
+        measurement = Measurement.objects.filter(system=self.system).first()
+        detail_url = f'{self.url}{measurement.id}/'
+        self.client.patch(detail_url, {'ph': 5.0}, format='json')
+        updated = self.get_etag(self.url)
+        self.assertNotEqual(changed, updated)
+        self.client.delete(detail_url)
+        self.assertNotEqual(updated, self.get_etag(self.url))
+
+    def test_retried_upload_keeps_the_etag(self):
+        self.post_measurement(self.system, idempotency_key='reading-1')
+        etag = self.get_etag(self.url)
+        self.post_measurement(self.system, idempotency_key='reading-1')
+        self.assertNotModified(self.url, etag)
+
+    def test_write_to_another_system_keeps_scoped_etag(self):
+        params = {'system': self.system.id}
+        etag = self.get_etag(self.url, params)
+        self.post_measurement(self.other_system)
+        self.assertNotModified(self.url, etag, params)
+
+    def test_system_writes_change_the_etag(self):
+        etag = self.get_etag(self.systems_url)
+        self.client.patch(
+            f'{self.systems_url}{self.system.id}/', {'name': 'Renamed'},
+            format='json')
+        renamed = self.get_etag(self.systems_url)
+        self.assertNotEqual(etag, renamed)
+        self.client.delete(f'{self.systems_url}{self.other_system.id}/')
+        self.assertNotEqual(renamed, self.get_etag(self.systems_url))
+
+    def test_error_responses_have_no_etag(self):
+        response = self.client.get(
+            f'{self.url}last-measurements/', {'system_name': 'Missing'})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response)
+
+    def test_state_version_counts_changes(self):
+        state = SystemCurrentState.objects.get(system=self.system)
+        self.assertEqual(state.version, 1)
+        self.post_measurement(self.system)
+        rebuild_current_state([self.system.id])
+        state.refresh_from_db()
+        self.assertEqual(state.version, 3)
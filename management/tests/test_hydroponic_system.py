@@ -1,7 +1,8 @@
-from rest_framework.test import APITestCase
+from datetime import timedelta
 from django.contrib.auth.models import User
-from ..models import HydroponicSystem
-from .utils import generate_jwt_token
+from django.utils import timezone
+from ..models import HydroponicSystem, Measurement
+from .utils import APITestCase, generate_jwt_token
 
 
 class BaseTestCase(APITestCase):
@@ -267,3 +268,100 @@ class HydroponicSystemListDisplayTestCase(BaseTestCase):
         self.assertEqual(
             response.data['detail'],
             'Given token not valid for any token type')
+
+
+class HydroponicSystemWriteQueryCountTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.system = HydroponicSystem.objects.create(
+            owner=self.user, name='Test System',
+            description='Test Description')
+
+    def test_create_query_count(self):
+        # user lookup, INSERT
+        with self.assertNumQueries(2):
+            response = self.client.post(
+                '/api/hydroponic-systems/',
+                {'name': 'New System'},
+                format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_update_query_count(self):
+        # user lookup, scoped system lookup,
+        # prefetch of the recent measurements, UPDATE
+        with self.assertNumQueries(4):
+            response = self.client.patch(
+                f'/api/hydroponic-systems/{self.system.id}/',
+                {'name': 'Renamed'},
+                format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['owner'], self.user.username)
+
+    def test_delete_query_count(self):
+        # user lookup, scoped system lookup,
+        # SELECT of the device keys, which evict themselves from the
+        # cache of their lookups,
+        # DELETE of the measurements, the current state, the hourly and
+        # daily rollups, the retention policy and the system
+        with self.assertNumQueries(9):
+            response = self.client.delete(
+                f'/api/hydroponic-systems/{self.system.id}/')
+        self.assertEqual(response.status_code, 204)
+
+
+class HydroponicSystemRecentMeasurementsTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        start = timezone.now() - timedelta(hours=1)
+        self.systems = [
+            HydroponicSystem.objects.create(
+                owner=self.user, name=f'System {index}')
+            for index in range(10)]
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=system, ph=index % 14,
+                timestamp=start + timedelta(minutes=index))
+            for system in self.systems[:5]
+            for index in range(15)])
+
+    def test_list_includes_recent_measurements(self):
+        # user lookup, validators, count, page of systems, one
+        # prefetch query for the recent measurements of the whole page
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/hydroponic-systems/')
+        self.assertEqual(response.status_code, 200)
+        systems = response.json()['results']
+        self.assertEqual(len(systems), 10)
+        for system in systems[:5]:
+            self.assertEqual(
+                [row['ph'] for row in system['recent_measurements']],
+                [index % 14 for index in range(14, 4, -1)])
+        for system in systems[5:]:
+            self.assertEqual(system['recent_measurements'], [])
+
+    def test_detail_with_custom_count(self):
+        response = self.client.get(
+            f'/api/hydroponic-systems/{self.systems[0].id}/',
+            {'recent_measurements': 3})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row['ph'] for row in response.json()['recent_measurements']],
+            [0, 13, 12])
+
+    def test_recent_measurements_can_be_disabled(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                '/api/hydroponic-systems/', {'recent_measurements': 0})
+        self.assertNotIn(
+            'recent_measurements', response.json()['results'][0])
+
+    def test_invalid_count(self):
+        response = self.client.get(
+            '/api/hydroponic-systems/', {'recent_measurements': 'x'})
+        self.assertEqual(response.status_code, 400)
@@ -1,8 +1,32 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.renderers import JSONRenderer
 from django.contrib.auth.models import User
-from ..models import HydroponicSystem, Measurement
-from .utils import generate_jwt_token
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.utils import timezone
+from hydroponics.pagination import (
+    CustomPageNumberPagination,
+    estimate_count)
+from ..models import (
+    DailyMeasurementRollup,
+    HydroponicSystem,
+    Measurement,
+    SystemCurrentState)
+from ..partitions import (
+    create_partition,
+    is_partitioned,
+    list_partitions,
+    month_start,
+    partition_name)
+from ..serializers import (
+    MeasurementSerializer,
+    measurement_values,
+    represent_measurements)
+from ..state import save_measurements
+from .utils import APITestCase, generate_jwt_token
 
 
 class BaseTestCase(APITestCase):
@@ -284,6 +308,56 @@ class MeasurementDisplayTestCase(BaseTestCase):
             response.status_code, status.HTTP_401_UNAUTHORIZED)
 
 
+class MeasurementLeanRepresentationTestCase(BaseTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=cls.system, ph=6.5, temperature=25.25, tds=800,
+                timestamp=datetime(
+                    2024, 5, 1, 12, 30, 15, 123456,
+                    tzinfo=dt_timezone.utc),
+                idempotency_key='reading-1'),
+            Measurement(
+                system=cls.system, ph=None, temperature=None, tds=None,
+                timestamp=datetime(2024, 5, 1, 13, tzinfo=dt_timezone.utc)),
+        ])
+
+    def assertSameJSON(self):
+        queryset = Measurement.objects.order_by('id')
+        self.assertEqual(
+            JSONRenderer().render(
+                represent_measurements(measurement_values(queryset))),
+            JSONRenderer().render(
+                MeasurementSerializer(queryset, many=True).data))
+
+    def test_same_json_as_serializer(self):
+        self.assertSameJSON()
+
+    def test_same_json_as_serializer_in_other_time_zone(self):
+        with timezone.override('Europe/Warsaw'):
+            self.assertSameJSON()
+
+    def test_list_and_last_measurements(self):
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        expected = MeasurementSerializer(
+            Measurement.objects.order_by('id'), many=True).data
+        response = self.client.get('/api/measurements/')
+        self.assertEqual(response.json()['results'], expected)
+        response = self.client.get(
+            '/api/measurements/', {'pagination': 'keyset', 'page_size': 1})
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(response.json()['results'], expected[1:])
+        response = self.client.get(
+            '/api/measurements/last-measurements/',
+            {'system_name': 'Sys1'})
+        self.assertEqual(response.json(), expected[::-1])
+
+
 class MeasurementPaginationTestCase(BaseTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -425,6 +499,158 @@ class MeasurementPaginationTestCase(BaseTestCase):
         self.assertIsNotNone(data['previous'])
 
 
+class MeasurementCountStrategyTestCase(BaseTestCase):
+    url = '/api/measurements/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        Measurement.objects.bulk_create([
+            Measurement(system=cls.system, ph=7.0) for _ in range(12)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        patcher = mock.patch.object(
+            CustomPageNumberPagination, 'count_limit', 5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_exact_count(self):
+        response = self.client.get(self.url, {'count': 'exact'})
+        data = response.json()
+        self.assertEqual(data['count'], 12)
+        self.assertEqual(data['count_type'], 'exact')
+
+    def test_count_under_limit_is_exact(self):
+        response = self.client.get(
+            self.url, {'count': 'capped', 'ph': 6.0})
+        data = response.json()
+        self.assertEqual(data['count'], 0)
+        self.assertEqual(data['count_type'], 'exact')
+
+    def test_capped_count(self):
+        response = self.client.get(
+            self.url, {'count': 'capped', 'page_size': 4, 'page': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(data['count_type'], 'capped')
+        # Pages past the capped count are still served.
+        self.assertEqual(len(data['results']), 4)
+        self.assertIsNone(data['next'])
+        self.assertIsNotNone(data['previous'])
+
+    def test_estimated_count_is_the_default(self):
+        with mock.patch(
+                'hydroponics.pagination.estimate_count', return_value=11):
+            response = self.client.get(self.url, {'page_size': 4})
+        data = response.json()
+        self.assertEqual(data['count'], 11)
+        self.assertEqual(data['count_type'], 'estimated')
+        self.assertIsNotNone(data['next'])
+
+    def test_estimate_comes_from_the_planner(self):
+        estimate = estimate_count(Measurement.objects.all())
+        self.assertIsInstance(estimate, int)
+        self.assertGreater(estimate, 0)
+
+    def test_systems_support_count_strategies(self):
+        for index in range(6):
+            HydroponicSystem.objects.create(
+                owner=self.user, name=f'Extra {index}')
+        response = self.client.get(
+            '/api/hydroponic-systems/', {'count': 'capped'})
+        data = response.json()
+        self.assertEqual(
+            (data['count'], data['count_type']), (5, 'capped'))
+
+
+class MeasurementKeysetPaginationTestCase(BaseTestCase):
+    url = '/api/measurements/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        start = timezone.now() - timedelta(hours=1)
+        # Pairs of rows share a timestamp and every third pH is null,
+        # so pages are split inside ties and inside the nulls.
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=cls.system,
+                ph=None if index % 3 == 0 else index % 5,
+                timestamp=start + timedelta(minutes=index // 2))
+            for index in range(25)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def walk(self, ordering, url=None, link='next'):
+        url = url or (
+            f'{self.url}?pagination=keyset&page_size=4&ordering={ordering}')
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.json()
+            pages.append(data)
+            url = data[link]
+        return pages
+
+    def test_pages_follow_ordering_with_id_tie_breaker(self):
+        for ordering, key in (
+                ('-timestamp', lambda row: (
+                    row['timestamp'], row['id'])),
+                ('ph', lambda row: (
+                    row['ph'] is None, row['ph'] or 0, row['id'])),
+                ('id', lambda row: row['id'])):
+            pages = self.walk(ordering)
+            rows = [row for page in pages for row in page['results']]
+            self.assertEqual(len(rows), 25)
+            self.assertEqual(len(pages), 7)
+            expected = sorted(
+                rows, key=key, reverse=ordering.startswith('-'))
+            self.assertEqual(
+                [row['id'] for row in rows],
+                [row['id'] for row in expected])
+
+    def test_previous_links_return_the_same_pages(self):
+        pages = self.walk('-ph')
+        previous_pages = self.walk(
+            '-ph', url=pages[-1]['previous'], link='previous')
+        self.assertEqual(
+            [page['results'] for page in previous_pages],
+            [page['results'] for page in reversed(pages[:-1])])
+
+    def test_inserts_do_not_shift_pages(self):
+        response = self.client.get(
+            f'{self.url}?pagination=keyset&page_size=10&ordering=id')
+        first_page = response.json()
+        Measurement.objects.create(system=self.system, ph=7)
+        response = self.client.get(first_page['next'])
+        self.assertEqual(
+            response.json()['results'][0]['id'],
+            first_page['results'][-1]['id'] + 1)
+
+    def test_deep_page_costs_the_same_as_first_page(self):
+        pages = self.walk('-timestamp')
+        # validators and the page itself, no count
+        with self.assertNumQueries(2):
+            self.client.get(pages[-2]['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(
+            f'{self.url}?pagination=keyset&cursor=abc')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
 class MeasurementFilterByPHTestCase(BaseTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -482,6 +708,218 @@ class MeasurementFilterByPHTestCase(BaseTestCase):
         self.assertEqual(len(data['results']), 0)
 
 
+class MeasurementFilterByTimestampTestCase(BaseTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        now = timezone.now()
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=cls.system, ph=6.5,
+                timestamp=now - timedelta(hours=hours))
+            for hours in (1, 12, 23, 25, 48, 24 * 8)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_filter_since(self):
+        for since, count in (('24h', 3), ('2d', 4), ('7d', 5), ('90m', 1)):
+            response = self.client.get(
+                '/api/measurements/', {'since': since})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.json()['count'], count)
+
+    def test_filter_since_with_range(self):
+        timestamp_max = (timezone.now() - timedelta(hours=2)).isoformat()
+        response = self.client.get('/api/measurements/', {
+            'since': '24h', 'timestamp_max': timestamp_max})
+        self.assertEqual(response.json()['count'], 2)
+
+    def test_invalid_since(self):
+        for since in ('24', 'yesterday', '0h', '400d'):
+            response = self.client.get(
+                '/api/measurements/', {'since': since})
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('since', response.json())
+
+
+class MeasurementTimestampIndexTestCase(BaseTestCase):
+    """
+    Checks the indexes used by time range queries. The table holds ten
+    days of readings of a few systems, far too few for the planner to
+    prefer an index on its own, so sequential scans are disabled.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        system_ids = [
+            HydroponicSystem.objects.create(
+                owner=cls.user, name=f'Sys{index}').id
+            for index in range(4)]
+        cls.system_id = system_ids[0]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO management_measurement '
+                '(system_id, ph, "timestamp") '
+                'SELECT system_id, 6.5, now() - minutes * interval \'1m\' '
+                'FROM generate_series(%s, 0, -10) AS minutes, '
+                'unnest(%s) AS system_id',
+                [10 * 24 * 60, system_ids])
+            cursor.execute('ANALYZE management_measurement')
+
+    def explain(self, **filters):
+        with connection.cursor() as cursor:
+            # Reverted with the transaction of the test.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return Measurement.objects.filter(**filters).explain()
+
+    def test_range_over_all_systems_uses_brin_index(self):
+        plan = self.explain(
+            timestamp__gte=timezone.now() - timedelta(hours=1))
+        self.assertIn('measurement_timestamp_brin', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_range_of_one_system_uses_btree_index(self):
+        plan = self.explain(
+            system_id=self.system_id,
+            timestamp__gte=timezone.now() - timedelta(hours=1))
+        self.assertIn('measurement_system_latest', plan)
+        self.assertNotIn('Seq Scan', plan)
+
+
+class MeasurementPartitionTestCase(BaseTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.measurements = save_measurements([
+            Measurement(
+                system=cls.system, ph=6.5, idempotency_key=f'{month}-{day}',
+                timestamp=datetime(2024, month, day, tzinfo=dt_timezone.utc))
+            for month in (3, 4, 5)
+            for day in (1, 31 if month != 4 else 30)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def convert(self):
+        call_command(
+            'partition_measurements', 'convert', '--months', '1',
+            stdout=StringIO())
+
+    def test_convert_keeps_readings_and_prunes_partitions(self):
+        self.convert()
+        self.assertTrue(is_partitioned())
+        names = [name for name, _bounds, _rows in list_partitions()]
+        month = timezone.now().astimezone(dt_timezone.utc)
+        self.assertEqual(names[:4], [
+            'management_measurement_default',
+            'management_measurement_p2024_03',
+            'management_measurement_p2024_04',
+            'management_measurement_p2024_05'])
+        self.assertIn(partition_name(month_start(month)), names)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT indexname FROM pg_indexes '
+                'WHERE tablename = %s', ['management_measurement'])
+            indexes = {row[0] for row in cursor.fetchall()}
+        self.assertTrue({
+            'management_measurement_pkey',
+            'measurement_system_latest',
+            'measurement_timestamp_brin',
+            'unique_measurement_idempotency_key'} <= indexes)
+        self.assertEqual(
+            sorted(Measurement.objects.values_list('id', flat=True)),
+            sorted(measurement.id for measurement in self.measurements))
+
+        plan = Measurement.objects.filter(
+            timestamp__gte=datetime(2024, 4, 2, tzinfo=dt_timezone.utc),
+            timestamp__lt=datetime(2024, 4, 3, tzinfo=dt_timezone.utc),
+        ).explain()
+        self.assertIn('management_measurement_p2024_04', plan)
+        self.assertNotIn('management_measurement_p2024_03', plan)
+
+    def test_ingest_into_partitioned_table(self):
+        self.convert()
+        row = {
+            'system': self.system.id,
+            'ph': 7.0,
+            'timestamp': '2024-04-15T12:00:00Z',
+            'idempotency_key': 'retried'}
+        for _ in range(2):
+            response = self.client.post(
+                '/api/measurements/', row, format='json')
+            self.assertEqual(
+                response.status_code, status.HTTP_201_CREATED)
+        self.assertGreater(
+            response.json()['id'],
+            max(measurement.id for measurement in self.measurements))
+        self.assertEqual(Measurement.objects.count(), 7)
+        self.assertEqual(
+            self.system.current_state.reading_count, 7)
+
+    def test_retry_after_a_duplicate_key(self):
+        self.convert()
+        row = {'system': self.system.id, 'ph': 7.0, 'idempotency_key': 'k'}
+        # Without a client timestamp, retries are stored again.
+        first = self.client.post('/api/measurements/', row, format='json')
+        row['timestamp'] = '2024-04-15T12:00:00Z'
+        for url in ('/api/measurements/', '/api/measurements/',
+                    '/api/async/measurements/'):
+            response = self.client.post(url, row, format='json')
+            self.assertEqual(
+                response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['id'], first.json()['id'])
+        self.assertEqual(
+            Measurement.objects.filter(idempotency_key='k').count(), 2)
+
+    def test_create_partition_moves_rows_from_default(self):
+        self.convert()
+        save_measurements([Measurement(
+            system=self.system, ph=6.5,
+            timestamp=datetime(2023, 1, 5, tzinfo=dt_timezone.utc))])
+        month = datetime(2023, 1, 1, tzinfo=dt_timezone.utc)
+        self.assertTrue(create_partition(month))
+        self.assertFalse(create_partition(month))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT count(*) FROM management_measurement_p2023_01')
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute(
+                'SELECT count(*) FROM management_measurement_default')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_detach_old_partitions(self):
+        self.convert()
+        out = StringIO()
+        call_command(
+            'partition_measurements', 'detach', '--before', '2024-05',
+            '--drop', stdout=out)
+        self.assertIn('Dropped 2 partitions.', out.getvalue())
+        self.assertEqual(Measurement.objects.count(), 2)
+        state = SystemCurrentState.objects.get(system=self.system)
+        self.assertEqual(state.reading_count, 2)
+        self.assertEqual(
+            DailyMeasurementRollup.objects.filter(
+                bucket__month=3).count(), 2)
+
+    def test_actions_require_a_partitioned_table(self):
+        with self.assertRaises(CommandError):
+            call_command('partition_measurements', 'list')
+        with self.assertRaises(CommandError):
+            call_command(
+                'partition_measurements', 'detach', '--before', 'May')
+
+
 class MeasurementFilterByTemperatureTestCase(BaseTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -683,3 +1121,334 @@ class MeasurementLastMeasurementsTestCase(BaseTestCase):
                 result['temperature'],
                 expected_measurements[i]['temperature'])
             self.assertEqual(result['tds'], expected_measurements[i]['tds'])
+
+
+class MeasurementLastMeasurementsBySystemTestCase(BaseTestCase):
+    url = '/api/measurements/last-measurements-by-system/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        other_user = User.objects.create_user(
+            username='other_user', password='other_password')
+        cls.systems = [
+            HydroponicSystem.objects.create(
+                owner=cls.user, name=f'Sys{index}')
+            for index in range(3)]
+        cls.other_system = HydroponicSystem.objects.create(
+            owner=other_user, name='Sys0')
+        start = timezone.now() - timedelta(hours=1)
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=system, ph=index,
+                timestamp=start + timedelta(minutes=index))
+            for system in cls.systems[:2] + [cls.other_system]
+            for index in range(5)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_last_measurements_of_many_systems(self):
+        # user lookup, validators, one windowed query for all systems
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                self.url, {
+                    'system': f'{self.systems[0].id},{self.systems[2].id}',
+                    'system_name': 'Sys1',
+                    'num_measurements': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(
+            [group['system'] for group in data],
+            [self.systems[0].id, self.systems[1].id])
+        for group in data:
+            self.assertEqual(
+                [row['ph'] for row in group['measurements']],
+                [4, 3, 2])
+            self.assertTrue(all(
+                row['system'] == group['system']
+                for row in group['measurements']))
+
+    def test_other_users_systems_are_omitted(self):
+        response = self.client.get(
+            self.url, {'system': self.other_system.id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), [])
+
+    def test_invalid_parameters(self):
+        for params in (
+                {},
+                {'system': 'abc'},
+                {'system': self.systems[0].id, 'num_measurements': 0},
+                {'system': self.systems[0].id, 'num_measurements': 'x'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MeasurementAggregateTestCase(BaseTestCase):
+    url = '/api/measurements/aggregate/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.start = datetime(2024, 5, 6, tzinfo=dt_timezone.utc)
+        # One week of readings every 10 minutes, pH cycling 6.0 to 7.0
+        # within each hour. They are saved like ingested readings, so the
+        # rollups are filled too.
+        save_measurements([
+            Measurement(
+                system=cls.system,
+                ph=6.0 + 0.2 * (index % 6),
+                temperature=25.0,
+                tds=None,
+                timestamp=cls.start + timedelta(minutes=10 * index))
+            for index in range(7 * 24 * 6)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_week_at_hourly_resolution(self):
+        # user lookup, validators, validation of the system filter,
+        # one aggregate query
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {
+                'bucket': 'hour',
+                'system': self.system.id,
+                'timestamp_min': '2024-05-06T00:00:00Z',
+                'timestamp_max': '2024-05-13T00:00:00Z'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(len(data), 168)
+        first = data[0]
+        self.assertEqual(first['system'], self.system.id)
+        self.assertEqual(first['bucket'], '2024-05-06T00:00:00Z')
+        self.assertEqual(first['ph']['count'], 6)
+        self.assertAlmostEqual(first['ph']['min'], 6.0)
+        self.assertAlmostEqual(first['ph']['max'], 7.0)
+        self.assertAlmostEqual(first['ph']['avg'], 6.5)
+        self.assertAlmostEqual(first['ph']['stddev'], 0.374165738677)
+        self.assertEqual(first['temperature']['stddev'], 0)
+        self.assertEqual(first['tds']['count'], 0)
+        self.assertIsNone(first['tds']['avg'])
+
+    def test_day_and_custom_interval_buckets(self):
+        response = self.client.get(self.url, {'bucket': 'day'})
+        self.assertEqual(len(response.json()), 7)
+        response = self.client.get(self.url, {
+            'bucket': '15m',
+            'timestamp_max': '2024-05-06T01:00:00Z'})
+        data = response.json()
+        self.assertEqual(
+            [row['bucket'][11:16] for row in data],
+            ['00:00', '00:15', '00:30', '00:45'])
+        self.assertEqual(
+            [row['ph']['count'] for row in data], [2, 1, 2, 1])
+
+    def test_filters_are_applied(self):
+        response = self.client.get(self.url, {
+            'bucket': 'day', 'ph_min': 6.9})
+        self.assertEqual(
+            [row['ph']['count'] for row in response.json()], [24] * 7)
+
+    def test_invalid_bucket(self):
+        for bucket in ('week', '0m', '15x'):
+            response = self.client.get(self.url, {'bucket': bucket})
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_too_many_buckets(self):
+        response = self.client.get(self.url, {'bucket': 'minute'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with mock.patch('management.views.MAX_AGGREGATE_BUCKETS', 100):
+            response = self.client.get(self.url, {'bucket': 'minute'})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MeasurementDownsampleTestCase(BaseTestCase):
+    url = '/api/measurements/'
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.start = datetime(2024, 5, 6, tzinfo=dt_timezone.utc)
+        # A slow pH ramp with a single spike, temperature never sent.
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=cls.system,
+                ph=9.5 if index == 613 else 6.0 + index / 1000,
+                temperature=None,
+                tds=800,
+                timestamp=cls.start + timedelta(minutes=index))
+            for index in range(1000)])
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+    def test_downsample_keeps_spikes_and_edges(self):
+        # user lookup, validators, validation of the system filter,
+        # one query for all the metrics
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url, {
+                'system': self.system.id, 'downsample': 20})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['system'], self.system.id)
+        self.assertEqual(len(data['ph']), 20)
+        self.assertEqual(data['ph'][0]['timestamp'], '2024-05-06T00:00:00Z')
+        self.assertEqual(data['ph'][-1]['timestamp'], '2024-05-06T16:39:00Z')
+        self.assertIn(
+            {'timestamp': '2024-05-06T10:13:00Z', 'value': 9.5}, data['ph'])
+        self.assertEqual(data['temperature'], [])
+        self.assertEqual(len(data['tds']), 20)
+        timestamps = [point['timestamp'] for point in data['ph']]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_downsample_with_range_filter(self):
+        response = self.client.get(self.url, {
+            'system': self.system.id,
+            'downsample': 50,
+            'timestamp_max': '2024-05-06T00:10:00Z'})
+        self.assertEqual(len(response.json()['ph']), 10)
+
+    def test_downsample_requires_a_system(self):
+        response = self.client.get(self.url, {'downsample': 20})
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_downsample(self):
+        for value in ('two', '2', '10001'):
+            response = self.client.get(self.url, {
+                'system': self.system.id, 'downsample': value})
+            self.assertEqual(
+                response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MeasurementWriteQueryCountTestCase(BaseTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_user = User.objects.create_user(
+            username='other_user', password='other_password')
+        cls.system = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.other_system = HydroponicSystem.objects.create(
+            owner=cls.other_user, name='Other', description='Other')
+
+    def setUp(self):
+        super().setUp()
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        # The lowest and highest readings are stored around the measurement
+        # changed by the tests, so its rollups are updated incrementally.
+        _, self.measurement, _ = save_measurements([
+            Measurement(
+                system=self.system, ph=ph, temperature=temperature,
+                tds=tds)
+            for ph, temperature, tds in (
+                (6.0, 20.0, 500), (7.0, 25.0, 800), (8.0, 30.0, 1000))])
+
+    def test_create_query_count(self):
+        # user lookup, scoped system lookup,
+        # INSERT together with the current state upsert
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                '/api/measurements/',
+                {'system': self.system.id, 'ph': 6.5},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_update_query_count(self):
+        # user lookup, scoped measurement and system lookup, UPDATE,
+        # current state lock and refresh, addition to and subtraction
+        # from the hourly and daily rollup, savepoint pair
+        with self.assertNumQueries(11):
+            response = self.client.put(
+                f'/api/measurements/{self.measurement.id}/',
+                {'system': self.system.id, 'ph': 6.8},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_partial_update_query_count(self):
+        with self.assertNumQueries(11):
+            response = self.client.patch(
+                f'/api/measurements/{self.measurement.id}/',
+                {'ph': 6.8},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_delete_query_count(self):
+        # user lookup, scoped measurement lookup, DELETE,
+        # current state lock and refresh, subtraction from the hourly
+        # and daily rollup, savepoint pair
+        with self.assertNumQueries(9):
+            response = self.client.delete(
+                f'/api/measurements/{self.measurement.id}/')
+        self.assertEqual(
+            response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_create_for_other_users_system(self):
+        response = self.client.post(
+            '/api/measurements/',
+            {'system': self.other_system.id, 'ph': 6.5},
+            format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('system', response.json())
+        self.assertFalse(
+            Measurement.objects.filter(system=self.other_system).exists())
+
+    def test_move_to_other_users_system(self):
+        response = self.client.patch(
+            f'/api/measurements/{self.measurement.id}/',
+            {'system': self.other_system.id},
+            format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.measurement.refresh_from_db()
+        self.assertEqual(self.measurement.system, self.system)
+
+    def test_update_other_users_measurement(self):
+        measurement = Measurement.objects.create(
+            system=self.other_system, ph=7.0)
+        response = self.client.patch(
+            f'/api/measurements/{measurement.id}/',
+            {'ph': 6.8},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class MeasurementAdminTestCase(APITestCase):
+    def setUp(self):
+        admin = User.objects.create_superuser(
+            username='admin', password='admin_password')
+        system = HydroponicSystem.objects.create(owner=admin, name='Sys1')
+        self.measurement, = save_measurements(
+            [Measurement(system=system, ph=6.5)])
+        self.client.force_login(admin)
+
+    def test_measurements_are_read_only(self):
+        url = '/admin/management/measurement/'
+        self.assertEqual(
+            self.client.get(f'{url}{self.measurement.id}/change/')
+            .status_code, status.HTTP_200_OK)
+        for path in ('add/', f'{self.measurement.id}/delete/'):
+            with self.subTest(path=path):
+                self.assertEqual(
+                    self.client.get(url + path).status_code,
+                    status.HTTP_403_FORBIDDEN)
+        self.client.post(
+            f'{url}{self.measurement.id}/change/', {'ph': 7.0})
+        self.measurement.refresh_from_db()
+        self.assertEqual(self.measurement.ph, 6.5)
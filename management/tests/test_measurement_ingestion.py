@@ -0,0 +1,964 @@
+import io
+import json
+import math
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from rest_framework import status
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+from django.db.models import Count
+from django.test import override_settings
+from django.utils.timezone import override as timezone_override
+from ..buffer import BufferFull, MeasurementBuffer, copy_measurements
+from ..frames import MEASUREMENT_FRAME, MEASUREMENT_FRAME_MEDIA_TYPE
+from ..models import (
+    DailyMeasurementRollup,
+    HourlyMeasurementRollup,
+    HydroponicSystem,
+    Measurement,
+    RetentionPolicy,
+    SystemCurrentState)
+from ..state import save_measurements
+from .utils import APITestCase, generate_jwt_token
+
+
+class BaseTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        cls.other_user = User.objects.create_user(
+            username='other_user', password='other_password')
+        cls.system1 = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys1', description='System 1')
+        cls.system2 = HydroponicSystem.objects.create(
+            owner=cls.user, name='Sys2', description='System 2')
+        cls.other_system = HydroponicSystem.objects.create(
+            owner=cls.other_user, name='Other', description='Other')
+
+    def setUp(self):
+        self.tokens = generate_jwt_token(
+            self.client, 'test_user', 'test_password')
+        self.access_token = self.tokens['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+
+
+class MeasurementBulkCreateTestCase(BaseTestCase):
+    url = '/api/measurements/bulk/'
+
+    def test_bulk_create_measurements(self):
+        data = [
+            {'system': system.id, 'ph': 6.5, 'temperature': 25.5, 'tds': 800}
+            for system in (self.system1, self.system2)
+            for _ in range(50)]
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {'accepted': 100})
+        self.assertEqual(
+            Measurement.objects.filter(system=self.system1).count(), 50)
+        self.assertEqual(
+            Measurement.objects.filter(system=self.system2).count(), 50)
+
+    def test_bulk_create_query_count(self):
+        data = [
+            {'system': system.id, 'ph': 6.5, 'temperature': 25.5, 'tds': 800}
+            for system in (self.system1, self.system2)
+            for _ in range(200)]
+        # user lookup, one ownership query, one INSERT together with
+        # the current state upsert (plus the savepoint pair of the
+        # atomic block)
+        with self.assertNumQueries(5):
+            response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_bulk_create_reports_row_errors(self):
+        data = [
+            {'system': self.system1.id, 'ph': 6.5, 'temperature': 25.5},
+            {'system': self.system1.id, 'ph': 15, 'temperature': 25.5},
+            {'system': self.other_system.id, 'ph': 6.5},
+            {'system': 'abc', 'ph': 6.5}]
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()['errors']
+        self.assertEqual([error['index'] for error in errors], [1, 2, 3])
+        self.assertIn('ph', errors[0]['errors'])
+        self.assertEqual(
+            errors[1]['errors']['system'],
+            ['Hydroponic system does not exist.'])
+        self.assertIn('system', errors[2]['errors'])
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_bulk_create_requires_list(self):
+        response = self.client.post(
+            self.url, {'system': self.system1.id, 'ph': 6.5}, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_bulk_create_unauthenticated(self):
+        self.client.credentials()
+        response = self.client.post(
+            self.url, [{'system': self.system1.id, 'ph': 6.5}],
+            format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class MeasurementStreamTestCase(BaseTestCase):
+    url = '/api/measurements/stream/'
+
+    def post_stream(self, body, content_type, url=None):
+        return self.client.generic(
+            'POST', url or self.url, body.encode('utf-8'),
+            content_type=content_type)
+
+    def test_stream_ndjson(self):
+        body = '\n'.join(
+            json.dumps({
+                'system': self.system1.id,
+                'ph': 6.5,
+                'temperature': 25.5,
+                'tds': 800})
+            for _ in range(25))
+        response = self.post_stream(
+            body, 'application/x-ndjson', self.url + '?chunk_size=10')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['accepted'], 25)
+        self.assertEqual(data['rejected'], 0)
+        self.assertEqual(data['chunks'], 3)
+        self.assertEqual(
+            Measurement.objects.filter(system=self.system1).count(), 25)
+
+    def test_stream_csv(self):
+        body = (
+            'system,ph,temperature,tds\n'
+            f'{self.system1.id},6.5,25.5,800\n'
+            f'{self.system2.id},7.0,,850\n')
+        response = self.post_stream(body, 'text/csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['accepted'], 2)
+        measurement = Measurement.objects.get(system=self.system2)
+        self.assertIsNone(measurement.temperature)
+        self.assertEqual(measurement.tds, 850)
+
+    def test_stream_reports_invalid_lines(self):
+        body = '\n'.join([
+            json.dumps({'system': self.system1.id, 'ph': 6.5}),
+            json.dumps({'system': self.system1.id, 'ph': 20}),
+            'not json',
+            json.dumps({'system': self.other_system.id, 'ph': 6.5}),
+            json.dumps({'system': self.system1.id, 'tds': 'abc'})])
+        response = self.post_stream(body, 'application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['accepted'], 1)
+        self.assertEqual(data['rejected'], 4)
+        self.assertEqual(
+            [error['line'] for error in data['errors']], [2, 3, 4, 5])
+        self.assertIn('ph', data['errors'][0]['errors'])
+        self.assertIn('system', data['errors'][2]['errors'])
+        self.assertIn('tds', data['errors'][3]['errors'])
+
+    def test_stream_ownership_checked_once_per_system(self):
+        body = '\n'.join(
+            json.dumps({'system': system.id, 'ph': 6.5})
+            for system in (self.system1, self.system2)
+            for _ in range(100))
+        # user lookup, one ownership query, one INSERT
+        # (plus the savepoint pair of the atomic block)
+        with self.assertNumQueries(5):
+            response = self.post_stream(body, 'application/x-ndjson')
+        self.assertEqual(response.json()['accepted'], 200)
+
+    def test_stream_unsupported_content_type(self):
+        response = self.post_stream('{}', 'application/xml')
+        self.assertEqual(
+            response.status_code,
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+
+class MeasurementIdempotencyTestCase(BaseTestCase):
+
+    def test_create_with_client_timestamp(self):
+        data = {
+            'system': self.system1.id,
+            'ph': 6.5,
+            'timestamp': '2024-05-01T12:00:00Z'}
+        response = self.client.post(
+            '/api/measurements/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.json()['timestamp'], '2024-05-01T12:00:00Z')
+
+    def test_create_with_future_timestamp(self):
+        data = {
+            'system': self.system1.id,
+            'ph': 6.5,
+            'timestamp': '2999-01-01T00:00:00Z'}
+        response = self.client.post(
+            '/api/measurements/', data, format='json')
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('timestamp', response.json())
+
+    def test_retried_create_is_idempotent(self):
+        data = {
+            'system': self.system1.id,
+            'ph': 6.5,
+            'timestamp': '2024-05-01T12:00:00Z',
+            'idempotency_key': 'gateway-1:42'}
+        first = self.client.post(
+            '/api/measurements/', data, format='json')
+        second = self.client.post(
+            '/api/measurements/', data, format='json')
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(Measurement.objects.count(), 1)
+
+    def test_same_key_on_different_systems(self):
+        for system in (self.system1, self.system2):
+            self.client.post(
+                '/api/measurements/',
+                {'system': system.id, 'ph': 6.5, 'idempotency_key': 'k1'},
+                format='json')
+        self.assertEqual(Measurement.objects.count(), 2)
+
+    def test_retried_bulk_create_is_idempotent(self):
+        data = [
+            {'system': self.system1.id, 'ph': 6.5,
+             'idempotency_key': f'k{index}'}
+            for index in range(10)]
+        data.append(dict(data[0]))
+        for _ in range(2):
+            response = self.client.post(
+                '/api/measurements/bulk/', data, format='json')
+            self.assertEqual(
+                response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Measurement.objects.count(), 10)
+
+    def test_retried_stream_is_idempotent(self):
+        body = '\n'.join(
+            json.dumps({
+                'system': self.system1.id,
+                'ph': 6.5,
+                'timestamp': f'2024-05-01T12:00:{index:02d}Z',
+                'idempotency_key': f'k{index}'})
+            for index in range(10))
+        for _ in range(2):
+            response = self.client.generic(
+                'POST', '/api/measurements/stream/', body.encode('utf-8'),
+                content_type='application/x-ndjson')
+            self.assertEqual(response.json()['rejected'], 0)
+        self.assertEqual(Measurement.objects.count(), 10)
+        self.assertEqual(
+            Measurement.objects.order_by('timestamp').first().timestamp
+            .isoformat(), '2024-05-01T12:00:00+00:00')
+
+
+class MeasurementWriteBehindTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buffer = MeasurementBuffer(max_size=3, batch_size=2)
+        patcher = mock.patch(
+            'management.views.get_measurement_buffer',
+            return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_measurement(self, **data):
+        return self.client.post(
+            '/api/measurements/',
+            {'system': self.system1.id, 'ph': 6.5, **data},
+            format='json')
+
+    def test_create_is_acknowledged_before_write(self):
+        response = self.post_measurement()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(response.json()['id'])
+        self.assertFalse(Measurement.objects.exists())
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Measurement.objects.get().ph, 6.5)
+
+    def test_invalid_measurement_is_not_queued(self):
+        response = self.post_measurement(ph=20)
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.buffer.queue.qsize(), 0)
+
+    def test_full_buffer_applies_backpressure(self):
+        for _ in range(3):
+            self.post_measurement()
+        response = self.post_measurement()
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.buffer.stats['rejected'], 1)
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(Measurement.objects.count(), 3)
+
+    def test_flush_skips_duplicate_idempotency_keys(self):
+        for _ in range(2):
+            self.post_measurement(
+                idempotency_key='k1', timestamp='2024-05-01T12:00:00Z')
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.stats['dropped'], 0)
+        measurement = Measurement.objects.get()
+        self.assertEqual(
+            measurement.timestamp,
+            datetime(2024, 5, 1, 12, tzinfo=timezone.utc))
+
+    def failing_copy(self, error, fails=lambda measurements: True):
+        """
+        Patch the writes of the buffer to raise `error` for the batches
+        `fails` returns true for, and to write the others.
+        """
+        def copy(measurements):
+            if fails(measurements):
+                raise error
+            copy_measurements(measurements)
+        return mock.patch(
+            'management.buffer.copy_measurements', side_effect=copy)
+
+    def test_integrity_error_drops_only_offending_readings(self):
+        self.buffer.put(Measurement(system=self.system1, ph=6.5))
+        self.buffer.put(Measurement(system=self.system2, ph=6.5))
+        deleted = self.failing_copy(
+            IntegrityError('violates foreign key constraint'),
+            lambda measurements: any(
+                measurement.system_id == self.system2.id
+                for measurement in measurements))
+        with deleted, self.assertLogs('management.buffer') as logs:
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Measurement.objects.get().system, self.system1)
+        self.assertEqual(self.buffer.stats['dropped'], 1)
+        self.assertIn(f'system {self.system2.id}', logs.output[0])
+
+    @mock.patch('management.buffer.time.sleep')
+    def test_transient_error_is_retried(self, sleep):
+        self.buffer.put(Measurement(system=self.system1, ph=6.5))
+        # Only the first attempt fails.
+        failures = iter([True])
+        lost = self.failing_copy(
+            OperationalError('server closed the connection'),
+            lambda measurements: next(failures, False))
+        with lost, self.assertLogs('management.buffer', 'WARNING'):
+            self.assertEqual(self.buffer.flush(), 1)
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual(self.buffer.stats['retried'], 1)
+        self.assertEqual(self.buffer.stats['dropped'], 0)
+        self.assertEqual(Measurement.objects.count(), 1)
+
+    @mock.patch('management.buffer.time.sleep')
+    def test_batch_is_dropped_after_the_last_retry(self, sleep):
+        buffer = MeasurementBuffer(max_retries=2, retry_backoff=1.0)
+        buffer.put(Measurement(system=self.system1, ph=6.5))
+        down = self.failing_copy(OperationalError('database is down'))
+        with down, self.assertLogs('management.buffer', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(
+            [call.args for call in sleep.call_args_list], [(1.0,), (2.0,)])
+        self.assertEqual(buffer.stats['dropped'], 1)
+        self.assertFalse(Measurement.objects.exists())
+
+    @mock.patch('management.buffer.time.sleep')
+    def test_transient_error_of_a_single_reading_is_retried(self, sleep):
+        self.buffer.put(Measurement(system=self.system1, ph=6.5))
+        self.buffer.put(Measurement(system=self.system2, ph=6.5))
+        # The batch holds an invalid reading, and the connection is lost
+        # while the readings are written one at a time.
+        errors = iter([IntegrityError('violates check constraint'),
+                       OperationalError('server closed the connection')])
+
+        def copy(measurements):
+            error = next(errors, None)
+            if error is not None:
+                raise error
+            copy_measurements(measurements)
+        flaky = mock.patch(
+            'management.buffer.copy_measurements', side_effect=copy)
+        with flaky, self.assertLogs('management.buffer', 'WARNING'):
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.buffer.stats['retried'], 1)
+        self.assertEqual(Measurement.objects.count(), 2)
+
+    def test_unexpected_error_drops_only_its_batch(self):
+        self.buffer.put(Measurement(system=self.system1, ph=6.5))
+        failures = iter([True])
+        broken = self.failing_copy(
+            RuntimeError('unexpected'),
+            lambda measurements: next(failures, False))
+        with broken, self.assertLogs('management.buffer', 'ERROR'):
+            self.assertEqual(self.buffer.flush(), 0)
+            self.buffer.put(Measurement(system=self.system1, ph=7.0))
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(self.buffer.stats['dropped'], 1)
+        self.assertEqual(Measurement.objects.get().ph, 7.0)
+
+    @mock.patch('management.buffer.connection.close_if_unusable_or_obsolete')
+    def test_flusher_keeps_running_after_an_error(self, close):
+        waits = []
+
+        def wait(timeout):
+            waits.append(timeout)
+            if len(waits) == 2:
+                self.buffer._stopped.set()
+        self.buffer.put(Measurement(system=self.system1, ph=6.5))
+        # The first flush fails outside of the writes.
+        flush = self.buffer.flush
+        errors = iter([RuntimeError('unexpected')])
+
+        def failing_flush():
+            error = next(errors, None)
+            if error is not None:
+                raise error
+            return flush()
+        with mock.patch.object(
+                self.buffer, 'flush', side_effect=failing_flush), \
+                mock.patch.object(
+                    self.buffer._wakeup, 'wait', side_effect=wait), \
+                self.assertLogs('management.buffer', 'ERROR'):
+            self.buffer._run()
+        self.assertEqual(len(waits), 2)
+        self.assertEqual(Measurement.objects.count(), 1)
+
+    def test_put_raises_when_full(self):
+        buffer = MeasurementBuffer(max_size=1)
+        buffer.put(Measurement(system=self.system1, ph=6.5))
+        with self.assertRaises(BufferFull):
+            buffer.put(Measurement(system=self.system1, ph=6.5))
+
+
+class MeasurementFramesTestCase(BaseTestCase):
+
+    def post_frames(self, frames):
+        body = b''.join(MEASUREMENT_FRAME.pack(*frame) for frame in frames)
+        return self.client.generic(
+            'POST', '/api/measurements/bulk/', body,
+            content_type=MEASUREMENT_FRAME_MEDIA_TYPE)
+
+    def test_bulk_create_from_frames(self):
+        response = self.post_frames([
+            (self.system1.id, 1714564800000, 6.7, 25.5, 800),
+            (self.system2.id, 0, 7.0, math.nan, 850)])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {'accepted': 2})
+        first = Measurement.objects.get(system=self.system1)
+        self.assertEqual(first.ph, 6.7)
+        self.assertEqual(
+            first.timestamp,
+            datetime(2024, 5, 1, 12, tzinfo=timezone.utc))
+        second = Measurement.objects.get(system=self.system2)
+        self.assertIsNone(second.temperature)
+
+    def test_bulk_create_from_frames_reports_row_errors(self):
+        response = self.post_frames([
+            (self.system1.id, 0, 6.5, 25.5, 800),
+            (self.other_system.id, 0, 6.5, 25.5, 800),
+            (self.system1.id, 0, 6.5, 25.5, 5000)])
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()['errors']
+        self.assertEqual([error['index'] for error in errors], [1, 2])
+        self.assertIn('tds', errors[1]['errors'])
+        self.assertFalse(Measurement.objects.exists())
+
+    def test_truncated_frames(self):
+        response = self.client.generic(
+            'POST', '/api/measurements/bulk/', b'\x00' * 30,
+            content_type=MEASUREMENT_FRAME_MEDIA_TYPE)
+        self.assertEqual(
+            response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_rendered_as_frames(self):
+        Measurement.objects.create(
+            system=self.system1, ph=6.5, temperature=None, tds=800,
+            timestamp=datetime(2024, 5, 1, 12, tzinfo=timezone.utc))
+        response = self.client.get(
+            '/api/measurements/', HTTP_ACCEPT=MEASUREMENT_FRAME_MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response['Content-Type'], MEASUREMENT_FRAME_MEDIA_TYPE)
+        frames = list(MEASUREMENT_FRAME.iter_unpack(response.content))
+        self.assertEqual(len(frames), 1)
+        system_id, timestamp, ph, temperature, tds = frames[0]
+        self.assertEqual(system_id, self.system1.id)
+        self.assertEqual(timestamp, 1714564800000)
+        self.assertEqual(ph, 6.5)
+        self.assertTrue(math.isnan(temperature))
+
+    def test_frames_of_a_large_system_id(self):
+        system = HydroponicSystem.objects.create(
+            id=2 ** 32 + 1, owner=self.user, name='Large')
+        response = self.post_frames([(system.id, 0, 6.5, 25.5, 800)])
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        response = self.client.get(
+            '/api/measurements/', {'system': system.id, 'format': 'frames'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        frame, = MEASUREMENT_FRAME.iter_unpack(response.content)
+        self.assertEqual(frame[0], system.id)
+
+    def test_errors_rendered_as_json(self):
+        response = self.client.get(
+            '/api/measurements/0/', HTTP_ACCEPT=MEASUREMENT_FRAME_MEDIA_TYPE)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_other_payloads_rendered_as_json(self):
+        save_measurements(
+            [Measurement(system=self.system1, ph=6.5, tds=800)])
+        for url, params in (
+                ('/api/measurements/aggregate/', {'bucket': 'hour'}),
+                ('/api/measurements/',
+                 {'system': self.system1.id, 'downsample': 10}),
+                ('/api/measurements/last-measurements-by-system/',
+                 {'system': self.system1.id})):
+            with self.subTest(url=url):
+                response = self.client.get(
+                    url, {**params, 'format': 'frames'})
+                self.assertEqual(
+                    response.status_code, status.HTTP_200_OK)
+                self.assertEqual(
+                    response['Content-Type'], 'application/json')
+                self.assertTrue(response.json())
+
+
+class SystemCurrentStateTestCase(BaseTestCase):
+
+    def post_measurement(self, **data):
+        return self.client.post(
+            '/api/measurements/',
+            {'system': self.system1.id, **data},
+            format='json')
+
+    def test_create_updates_current_state(self):
+        self.post_measurement(
+            ph=6.5, temperature=25.0, tds=800,
+            timestamp='2024-05-01T12:00:00Z')
+        self.post_measurement(
+            ph=6.8, temperature=24.0, tds=820,
+            timestamp='2024-05-01T13:00:00Z')
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual(
+            (state.ph, state.temperature, state.tds), (6.8, 24.0, 820))
+        self.assertEqual(
+            state.timestamp,
+            datetime(2024, 5, 1, 13, tzinfo=timezone.utc))
+        self.assertEqual(state.reading_count, 2)
+        self.assertIsNotNone(state.last_seen)
+
+    def test_late_reading_does_not_replace_latest_values(self):
+        self.post_measurement(ph=6.8, timestamp='2024-05-01T13:00:00Z')
+        self.post_measurement(ph=6.5, timestamp='2024-05-01T12:00:00Z')
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual(state.ph, 6.8)
+        self.assertEqual(state.reading_count, 2)
+
+    def test_retries_are_counted_once(self):
+        for _ in range(2):
+            self.post_measurement(ph=6.5, idempotency_key='k1')
+            self.client.post(
+                '/api/measurements/bulk/',
+                [{'system': self.system1.id, 'ph': 6.6,
+                  'idempotency_key': 'k2'}],
+                format='json')
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual(state.reading_count, 2)
+
+    def test_bulk_stream_and_frames_update_current_state(self):
+        self.client.post(
+            '/api/measurements/bulk/',
+            [{'system': self.system1.id, 'ph': 6.5},
+             {'system': self.system2.id, 'ph': 6.6}],
+            format='json')
+        self.client.generic(
+            'POST', '/api/measurements/stream/',
+            json.dumps({'system': self.system1.id, 'ph': 6.7}),
+            content_type='application/x-ndjson')
+        self.client.generic(
+            'POST', '/api/measurements/bulk/',
+            MEASUREMENT_FRAME.pack(self.system2.id, 0, 6.8, 25.0, 800),
+            content_type=MEASUREMENT_FRAME_MEDIA_TYPE)
+        states = {
+            state.system_id: state
+            for state in SystemCurrentState.objects.all()}
+        self.assertEqual(states[self.system1.id].ph, 6.7)
+        self.assertEqual(states[self.system1.id].reading_count, 2)
+        self.assertEqual(states[self.system2.id].ph, 6.8)
+        self.assertEqual(states[self.system2.id].reading_count, 2)
+
+    def test_buffer_flush_updates_current_state(self):
+        buffer = MeasurementBuffer()
+        buffer.put(Measurement(system=self.system1, ph=6.5))
+        buffer.flush()
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual((state.ph, state.reading_count), (6.5, 1))
+
+    def test_update_and_delete_refresh_current_state(self):
+        self.post_measurement(ph=6.5, timestamp='2024-05-01T12:00:00Z')
+        latest = self.post_measurement(
+            ph=6.8, timestamp='2024-05-01T13:00:00Z').json()
+
+        self.client.patch(
+            f"/api/measurements/{latest['id']}/",
+            {'system': self.system2.id},
+            format='json')
+        first = SystemCurrentState.objects.get(system=self.system1)
+        second = SystemCurrentState.objects.get(system=self.system2)
+        self.assertEqual((first.ph, first.reading_count), (6.5, 1))
+        self.assertEqual((second.ph, second.reading_count), (6.8, 1))
+
+        self.client.delete(f"/api/measurements/{latest['id']}/")
+        second.refresh_from_db()
+        self.assertIsNone(second.ph)
+        self.assertIsNone(second.timestamp)
+        self.assertEqual(second.reading_count, 0)
+
+    def test_systems_list_includes_current_state(self):
+        self.post_measurement(ph=6.5, temperature=25.0, tds=800)
+        # validators, count, page of systems joined with
+        # their state
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                '/api/hydroponic-systems/', {'recent_measurements': 0})
+        results = {
+            system['name']: system for system in response.json()['results']}
+        self.assertEqual(results['Sys1']['current_state']['ph'], 6.5)
+        self.assertEqual(
+            results['Sys1']['current_state']['reading_count'], 1)
+        self.assertIsNone(results['Sys2']['current_state'])
+
+    def test_rebuild_current_state(self):
+        Measurement.objects.create(
+            system=self.system1, ph=6.5,
+            timestamp=datetime(2024, 5, 1, 12, tzinfo=timezone.utc))
+        Measurement.objects.create(
+            system=self.system1, ph=6.8,
+            timestamp=datetime(2024, 5, 1, 13, tzinfo=timezone.utc))
+        call_command('rebuild_current_state', stdout=mock.Mock())
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual((state.ph, state.reading_count), (6.8, 2))
+        self.assertEqual(state.last_seen, state.timestamp)
+
+
+class MeasurementRollupTestCase(BaseTestCase):
+
+    def post_measurements(self, *rows):
+        response = self.client.post(
+            '/api/measurements/bulk/',
+            [{'system': self.system1.id, **row} for row in rows],
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_ingest_updates_hourly_and_daily_rollups(self):
+        self.post_measurements(
+            {'ph': 6.0, 'tds': 800, 'timestamp': '2024-05-01T12:10:00Z'},
+            {'ph': 7.0, 'timestamp': '2024-05-01T12:50:00Z'})
+        self.post_measurements(
+            {'ph': 6.5, 'timestamp': '2024-05-01T13:05:00Z'})
+
+        hourly = HourlyMeasurementRollup.objects.order_by('bucket')
+        self.assertEqual(
+            [(rollup.bucket.hour, rollup.count) for rollup in hourly],
+            [(12, 2), (13, 1)])
+        first = hourly[0]
+        self.assertEqual((first.ph_count, first.ph_sum), (2, 13.0))
+        self.assertEqual(first.ph_sum_squares, 85.0)
+        self.assertEqual((first.ph_min, first.ph_max), (6.0, 7.0))
+        self.assertEqual((first.tds_count, first.tds_min), (1, 800))
+        self.assertEqual(first.temperature_count, 0)
+        self.assertIsNone(first.temperature_min)
+
+        daily = DailyMeasurementRollup.objects.get()
+        self.assertEqual(
+            daily.bucket, datetime(2024, 5, 1, tzinfo=timezone.utc))
+        self.assertEqual((daily.count, daily.ph_min, daily.ph_max),
+                         (3, 6.0, 7.0))
+
+    def test_update_and_delete_rebuild_rollups(self):
+        self.post_measurements(
+            {'ph': 6.0, 'timestamp': '2024-05-01T12:10:00Z'},
+            {'ph': 7.0, 'timestamp': '2024-05-01T12:50:00Z'})
+        highest = Measurement.objects.get(ph=7.0)
+
+        self.client.patch(
+            f'/api/measurements/{highest.id}/',
+            {'timestamp': '2024-05-01T14:00:00Z'},
+            format='json')
+        self.assertEqual(
+            [(rollup.bucket.hour, rollup.count, rollup.ph_max)
+             for rollup in HourlyMeasurementRollup.objects.order_by(
+                 'bucket')],
+            [(12, 1, 6.0), (14, 1, 7.0)])
+
+        self.client.delete(f'/api/measurements/{highest.id}/')
+        self.assertEqual(
+            [(rollup.bucket.hour, rollup.count)
+             for rollup in HourlyMeasurementRollup.objects.all()],
+            [(12, 1)])
+        daily = DailyMeasurementRollup.objects.get()
+        self.assertEqual((daily.count, daily.ph_max), (1, 6.0))
+
+    def assertRollupsMatchMeasurements(self):
+        rollups = sorted(
+            (model.__name__, rollup.system_id, rollup.bucket, rollup.count,
+             rollup.ph_count, rollup.ph_sum, rollup.ph_sum_squares,
+             rollup.ph_min, rollup.ph_max, rollup.tds_count)
+            for model in (HourlyMeasurementRollup, DailyMeasurementRollup)
+            for rollup in model.objects.all())
+        call_command('rebuild_rollups', stdout=mock.Mock())
+        rebuilt = sorted(
+            (model.__name__, rollup.system_id, rollup.bucket, rollup.count,
+             rollup.ph_count, rollup.ph_sum, rollup.ph_sum_squares,
+             rollup.ph_min, rollup.ph_max, rollup.tds_count)
+            for model in (HourlyMeasurementRollup, DailyMeasurementRollup)
+            for rollup in model.objects.all())
+        self.assertEqual(len(rollups), len(rebuilt))
+        for row, expected in zip(rollups, rebuilt):
+            self.assertEqual(row[:5] + row[7:], expected[:5] + expected[7:])
+            self.assertAlmostEqual(row[5], expected[5])
+            self.assertAlmostEqual(row[6], expected[6])
+
+    def test_update_and_delete_update_rollups_incrementally(self):
+        self.post_measurements(
+            {'ph': 6.0, 'tds': 800, 'timestamp': '2024-05-01T12:10:00Z'},
+            {'ph': 6.5, 'timestamp': '2024-05-01T12:30:00Z'},
+            {'ph': 7.0, 'timestamp': '2024-05-01T12:50:00Z'})
+        middle = Measurement.objects.get(ph=6.5)
+        url = f'/api/measurements/{middle.id}/'
+
+        with mock.patch('management.rollups.rebuild_rollups') as rebuild:
+            for data in (
+                    {'ph': 6.6},
+                    {'timestamp': '2024-05-01T14:00:00Z'},
+                    {'system': self.system2.id}):
+                response = self.client.patch(url, data, format='json')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            response = self.client.delete(url)
+            self.assertEqual(
+                response.status_code, status.HTTP_204_NO_CONTENT)
+        # Only the buckets left empty by the last changes were rebuilt.
+        self.assertEqual(
+            [call.kwargs['models'] for call in rebuild.call_args_list],
+            [[HourlyMeasurementRollup], [HourlyMeasurementRollup],
+             [DailyMeasurementRollup]])
+        hourly = HourlyMeasurementRollup.objects.get(
+            system=self.system1, count__gt=0)
+        self.assertEqual(
+            (hourly.count, hourly.ph_min, hourly.ph_max), (2, 6.0, 7.0))
+        self.assertAlmostEqual(hourly.ph_sum, 13.0)
+        self.assertAlmostEqual(hourly.ph_sum_squares, 85.0)
+        self.assertEqual(hourly.tds_count, 1)
+        daily = DailyMeasurementRollup.objects.get(
+            system=self.system1, count__gt=0)
+        self.assertEqual(
+            (daily.count, daily.ph_min, daily.ph_max), (2, 6.0, 7.0))
+        self.assertAlmostEqual(daily.ph_sum, 13.0)
+
+    def test_incremental_rollups_match_rebuilt_ones(self):
+        self.post_measurements(*(
+            {'ph': 6.0 + index / 10, 'tds': 800 + index,
+             'timestamp': f'2024-05-01T1{index % 3}:{index}0:00Z'}
+            for index in range(6)))
+        for measurement in Measurement.objects.order_by('id')[:4]:
+            self.client.patch(
+                f'/api/measurements/{measurement.id}/',
+                {'ph': 6.25, 'timestamp': '2024-05-02T10:00:00Z'},
+                format='json')
+        self.client.delete(
+            f'/api/measurements/{Measurement.objects.last().id}/')
+        self.client.patch(
+            f'/api/measurements/{Measurement.objects.first().id}/',
+            {'system': self.system2.id}, format='json')
+        self.assertRollupsMatchMeasurements()
+
+    def test_aggregate_reads_rollups(self):
+        self.post_measurements(*(
+            {'ph': 6.0 + index / 10, 'temperature': 20 + index,
+             'timestamp': f'2024-05-0{1 + index % 3}T1{index}:00:00Z'}
+            for index in range(10)))
+        params = {
+            'bucket': 'day',
+            'system': self.system1.id,
+            'timestamp_min': '2024-05-01T00:00:00Z'}
+        raw = self.client.get(
+            '/api/measurements/aggregate/', {**params, 'source': 'raw'})
+        # validators, validation of the system filter,
+        # one query over the daily rollups
+        with self.assertNumQueries(3):
+            rolled_up = self.client.get(
+                '/api/measurements/aggregate/', params)
+        self.assertEqual(len(rolled_up.json()), 3)
+        for expected, row in zip(raw.json(), rolled_up.json()):
+            self.assertEqual(row['bucket'], expected['bucket'])
+            for metric in ('ph', 'temperature', 'tds'):
+                for name in ('min', 'max', 'count'):
+                    self.assertEqual(
+                        row[metric][name], expected[metric][name])
+                for name in ('avg', 'stddev'):
+                    if expected[metric][name] is None:
+                        self.assertIsNone(row[metric][name])
+                    else:
+                        self.assertAlmostEqual(
+                            row[metric][name], expected[metric][name])
+
+    def test_aggregate_in_time_zone_offset_by_half_an_hour(self):
+        self.post_measurements(*(
+            {'ph': 6.0 + index / 10,
+             'timestamp': f'2024-05-01T12:{index * 10:02}:00Z'}
+            for index in range(6)))
+        with timezone_override('Asia/Kolkata'):
+            for bucket in ('hour', 'day'):
+                with self.subTest(bucket=bucket):
+                    params = {'bucket': bucket, 'system': self.system1.id}
+                    raw = self.client.get(
+                        '/api/measurements/aggregate/',
+                        {**params, 'source': 'raw'}).json()
+                    with mock.patch(
+                            'management.views.aggregate_rollups') as rollups:
+                        response = self.client.get(
+                            '/api/measurements/aggregate/', params)
+                    rollups.assert_not_called()
+                    self.assertEqual(response.json(), raw)
+            self.assertEqual(
+                [row['ph']['count'] for row in self.client.get(
+                    '/api/measurements/aggregate/',
+                    {'bucket': 'hour'}).json()],
+                [3, 3])
+
+    def test_rebuild_rollups_command(self):
+        Measurement.objects.bulk_create([
+            Measurement(
+                system=self.system1, ph=6.5,
+                timestamp=datetime(2024, 5, day, 12, tzinfo=timezone.utc))
+            for day in (1, 2, 3)])
+        call_command('rebuild_rollups', stdout=mock.Mock())
+        self.assertEqual(HourlyMeasurementRollup.objects.count(), 3)
+        self.assertEqual(DailyMeasurementRollup.objects.count(), 3)
+
+        Measurement.objects.filter(timestamp__day=2).delete()
+        call_command(
+            'rebuild_rollups',
+            '--start', '2024-05-02T00:00:00Z',
+            '--end', '2024-05-03T00:00:00Z',
+            stdout=mock.Mock())
+        self.assertEqual(
+            [rollup.bucket.day
+             for rollup in DailyMeasurementRollup.objects.order_by(
+                 'bucket')],
+            [1, 3])
+
+
+class MeasurementRetentionTestCase(BaseTestCase):
+    retention = {
+        'RAW_DAYS': 30,
+        'HOURLY_DAYS': 365,
+        'DAILY_DAYS': None,
+        'BATCH_SIZE': 2}
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Both readings of a day fall into the same hour.
+        midday = datetime.now(timezone.utc).replace(hour=12, minute=30)
+        save_measurements([
+            Measurement(
+                system=system, ph=6.5,
+                timestamp=midday - timedelta(days=days, minutes=minutes))
+            for system in (cls.system1, cls.system2, cls.other_system)
+            for days in (400, 40, 10)
+            for minutes in (0, 1)])
+
+    def apply_retention(self, **settings):
+        out = io.StringIO()
+        with override_settings(
+                MEASUREMENT_RETENTION={**self.retention, **settings}):
+            call_command('apply_retention', stdout=out)
+        return out.getvalue()
+
+    def test_expired_rows_are_deleted_and_rollups_kept(self):
+        output = self.apply_retention()
+        self.assertIn('raw: deleted 12 rows', output)
+        self.assertIn('hourly: deleted 3 rows', output)
+        self.assertIn('daily: deleted 0 rows', output)
+        self.assertIn('rows/s', output)
+        self.assertEqual(Measurement.objects.count(), 6)
+        self.assertEqual(
+            HourlyMeasurementRollup.objects.count(), 6)
+        self.assertEqual(DailyMeasurementRollup.objects.count(), 9)
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual(state.reading_count, 2)
+
+        # Aggregates over the compacted range still count every reading.
+        response = self.client.get('/api/measurements/aggregate/', {
+            'bucket': 'day', 'system': self.system1.id})
+        self.assertEqual(
+            [row['ph']['count'] for row in response.json()], [2, 2, 2])
+
+        self.assertIn('raw: deleted 0 rows', self.apply_retention())
+
+    def daily_counts(self, system):
+        return list(DailyMeasurementRollup.objects.filter(
+            system=system).order_by('bucket').values_list(
+                'count', flat=True))
+
+    def test_compacted_rollups_are_not_rebuilt(self):
+        self.apply_retention()
+        state = SystemCurrentState.objects.get(system=self.system1)
+        self.assertEqual(
+            state.compacted_before,
+            datetime.now(timezone.utc).replace(
+                hour=0, minute=0, second=0, microsecond=0)
+            - timedelta(days=30))
+        call_command(
+            'rebuild_rollups', '--start',
+            (state.compacted_before - timedelta(days=500)).isoformat(),
+            stdout=io.StringIO())
+        self.assertEqual(self.daily_counts(self.system1), [2, 2, 2])
+        self.assertEqual(HourlyMeasurementRollup.objects.filter(
+            system=self.system1).count(), 2)
+
+        # A reading moved into a compacted day is added to its rollup,
+        # which still holds the deleted readings.
+        measurement = Measurement.objects.filter(
+            system=self.system1).first()
+        response = self.client.patch(
+            f'/api/measurements/{measurement.id}/',
+            {'timestamp': (state.compacted_before
+                           - timedelta(days=10)).isoformat()},
+            format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.daily_counts(self.system1), [2, 3, 1])
+
+    def test_system_policy_replaces_the_default(self):
+        RetentionPolicy.objects.create(
+            system=self.system2, raw_days=None, hourly_days=None,
+            daily_days=100)
+        RetentionPolicy.objects.create(
+            system=self.other_system, raw_days=5, hourly_days=5,
+            daily_days=None)
+        self.apply_retention()
+        self.assertEqual(
+            dict(Measurement.objects.values_list('system').annotate(
+                count=Count('id'))),
+            {self.system1.id: 2, self.system2.id: 6})
+        self.assertEqual(
+            dict(HourlyMeasurementRollup.objects.values_list(
+                'system').annotate(count=Count('id'))),
+            {self.system1.id: 2, self.system2.id: 3})
+        self.assertEqual(
+            dict(DailyMeasurementRollup.objects.values_list(
+                'system').annotate(count=Count('id'))),
+            {self.system1.id: 3, self.system2.id: 2,
+             self.other_system.id: 3})
+
+    def test_nothing_is_deleted_by_default(self):
+        output = self.apply_retention(
+            RAW_DAYS=None, HOURLY_DAYS=None, DAILY_DAYS=None)
+        self.assertIn('raw: deleted 0 rows', output)
+        self.assertEqual(Measurement.objects.count(), 18)
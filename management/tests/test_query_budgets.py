@@ -0,0 +1,158 @@
+import json
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from hydroponics.query_budget import QueryBudgetExceeded, get_query_budget
+from .. import urls
+from ..models import HydroponicSystem, Measurement
+from ..state import save_measurements
+from ..views import HydroponicSystemViewSet
+from .utils import (
+    APITestCase,
+    enforce_query_budgets,
+    generate_jwt_token,
+    iter_endpoints)
+
+
+class QueryBudgetDeclarationTestCase(APITestCase):
+    def test_every_endpoint_has_a_budget(self):
+        endpoints = list(iter_endpoints(urls.urlpatterns))
+        self.assertTrue(endpoints)
+        for route, view_class, name in endpoints:
+            with self.subTest(route=route, action=name):
+                self.assertIsNotNone(
+                    get_query_budget(view_class, name),
+                    f"{view_class.__name__}.{name} has no query budget.")
+
+
+@enforce_query_budgets
+class QueryBudgetTestCase(APITestCase):
+    """
+    Requests every endpoint with enough systems and measurements to show
+    per-row queries. A request exceeding its budget raises.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        cls.systems = [
+            HydroponicSystem.objects.create(
+                owner=cls.user, name=f'Sys{index}')
+            for index in range(5)]
+        start = datetime.now(timezone.utc) - timedelta(days=2)
+        save_measurements([
+            Measurement(
+                system=system, ph=6.5, temperature=25.0, tds=800,
+                timestamp=start + timedelta(minutes=30 * index))
+            for system in cls.systems
+            for index in range(20)])
+
+    def setUp(self):
+        self.access_token = generate_jwt_token(
+            self.client, 'test_user', 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + self.access_token)
+        self.system = self.systems[0]
+        self.measurement = Measurement.objects.filter(
+            system=self.system).first()
+
+    def assertSuccess(self, response):
+        self.assertLess(response.status_code, 300, response.content)
+
+    def test_api_root(self):
+        self.assertSuccess(self.client.get('/api/'))
+
+    def test_hydroponic_system_endpoints(self):
+        url = '/api/hydroponic-systems/'
+        detail_url = f'{url}{self.system.id}/'
+        self.assertSuccess(self.client.get(url))
+        self.assertSuccess(self.client.get(url, {'page_size': 100}))
+        self.assertSuccess(self.client.post(
+            url, {'name': 'New', 'description': 'New'}, format='json'))
+        self.assertSuccess(self.client.get(detail_url))
+        self.assertSuccess(self.client.put(
+            detail_url, {'name': 'Renamed', 'description': 'Renamed'},
+            format='json'))
+        self.assertSuccess(self.client.patch(
+            detail_url, {'name': 'Patched'}, format='json'))
+        self.assertSuccess(self.client.delete(detail_url))
+
+    def test_measurement_endpoints(self):
+        url = '/api/measurements/'
+        detail_url = f'{url}{self.measurement.id}/'
+        row = {'system': self.system.id, 'ph': 6.8}
+        for params in (
+                {},
+                {'page_size': 100, 'count': 'exact'},
+                {'pagination': 'keyset', 'page_size': 100},
+                {'system': self.system.id, 'downsample': 10}):
+            self.assertSuccess(self.client.get(url, params))
+        self.assertSuccess(self.client.post(url, row, format='json'))
+        self.assertSuccess(self.client.get(detail_url))
+        self.assertSuccess(self.client.put(detail_url, {
+            **row, 'timestamp': '2024-05-01T12:00:00Z'}, format='json'))
+        self.assertSuccess(self.client.patch(
+            detail_url, {'system': self.systems[1].id}, format='json'))
+        self.assertSuccess(self.client.delete(detail_url))
+
+    def test_measurement_read_actions(self):
+        url = '/api/measurements/'
+        self.assertSuccess(self.client.get(
+            f'{url}last-measurements/',
+            {'system_name': 'Sys1', 'num_measurements': 100}))
+        self.assertSuccess(self.client.get(
+            f'{url}last-measurements-by-system/',
+            {'system': ','.join(str(system.id) for system in self.systems),
+             'num_measurements': 100}))
+        for bucket in ('hour', '15m'):
+            self.assertSuccess(self.client.get(
+                f'{url}aggregate/', {'bucket': bucket}))
+
+    @override_settings(RESPONSE_CACHE={'ENABLED': True})
+    def test_cached_read_endpoints(self):
+        cache.clear()
+        for _ in range(2):
+            self.assertSuccess(self.client.get('/api/hydroponic-systems/'))
+            self.assertSuccess(self.client.get('/api/measurements/'))
+            self.test_measurement_read_actions()
+
+    def test_measurement_ingest_actions(self):
+        url = '/api/measurements/'
+        rows = [
+            {'system': system.id, 'ph': 6.5, 'idempotency_key': str(index)}
+            for index, system in enumerate(self.systems * 10)]
+        self.assertSuccess(self.client.post(
+            f'{url}bulk/', rows, format='json'))
+        self.assertSuccess(self.client.generic(
+            'POST', f'{url}stream/',
+            '\n'.join(json.dumps(row) for row in rows),
+            content_type='application/x-ndjson'))
+
+    def test_async_endpoints(self):
+        url = '/api/async/measurements/'
+        self.assertSuccess(self.client.get(url, {'page_size': 100}))
+        self.assertSuccess(self.client.post(
+            url, {'system': self.system.id, 'ph': 6.5}, format='json'))
+        self.assertSuccess(self.client.get(
+            f'{url}last-measurements/',
+            {'system_name': 'Sys1', 'num_measurements': 100}))
+        response = self.client.get(
+            f'{url}last-measurements/', {'system_name': 'Missing'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_exceeded_budget_raises(self):
+        with mock.patch.dict(
+                HydroponicSystemViewSet.query_budgets, {'list': 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/api/hydroponic-systems/')
+
+    @override_settings(QUERY_BUDGET={'ENABLED': True, 'RAISE': False})
+    def test_exceeded_budget_is_logged(self):
+        with mock.patch.dict(
+                HydroponicSystemViewSet.query_budgets, {'list': 1}):
+            with self.assertLogs('hydroponics.query_budget', 'WARNING'):
+                response = self.client.get('/api/hydroponic-systems/')
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,237 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from ..models import HydroponicSystem, Measurement
+from ..response_cache import check_shared_cache, fetch, get_stats
+from ..retention import apply_retention
+from ..state import save_measurements
+from .utils import APITestCase, generate_jwt_token
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': True})
+class ResponseCacheTestCase(APITestCase):
+    url = '/api/measurements/'
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='test_user', password='test_password')
+        self.other_user = User.objects.create_user(
+            username='other_user', password='test_password')
+        self.system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys1')
+        self.other_system = HydroponicSystem.objects.create(
+            owner=self.user, name='Sys2')
+        save_measurements([
+            Measurement(system=system, ph=6.5, temperature=25.0, tds=800)
+            for system in (self.system, self.other_system)])
+        self.login('test_user')
+
+    def login(self, username):
+        access_token = generate_jwt_token(
+            self.client, username, 'test_password')['access']
+        self.client.credentials(
+            HTTP_AUTHORIZATION='Bearer ' + access_token)
+
+    def get(self, url, params=None):
+        response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def write(self, method, url, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(
+                url, data, format='json')
+        self.assertLess(response.status_code, 300, response.content)
+        return response
+
+    def test_repeated_request_is_served_from_cache(self):
+        first = self.get(self.url)
+        # the validators of conditional requests
+        with self.assertNumQueries(1):
+            second = self.get(self.url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(first.json(), second.json())
+
+    def test_cached_endpoints(self):
+        for url, params in (
+                ('/api/hydroponic-systems/', {}),
+                (f'{self.url}last-measurements/', {'system_name': 'Sys1'}),
+                (f'{self.url}last-measurements-by-system/',
+                 {'system': self.system.id})):
+            with self.subTest(url=url):
+                self.get(url, params)
+                self.assertEqual(self.get(url, params)['X-Cache'], 'HIT')
+
+    def test_parameters_are_part_of_the_key(self):
+        self.get(self.url, {'system': self.system.id})
+        response = self.get(self.url, {'system': self.other_system.id})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(
+            [row['system'] for row in response.json()['results']],
+            [self.other_system.id])
+
+    def test_responses_are_scoped_per_user(self):
+        self.get(self.url)
+        self.login('other_user')
+        response = self.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['results'], [])
+
+    def test_created_measurement_invalidates(self):
+        self.get(self.url)
+        self.write('post', self.url, {'system': self.system.id, 'ph': 7.0})
+        response = self.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['count'], 3)
+
+    def test_write_to_another_system_keeps_scoped_responses(self):
+        params = {'system': self.system.id}
+        self.get(self.url, params)
+        self.get(self.url)
+        self.write(
+            'post', f'{self.url}bulk/',
+            [{'system': self.other_system.id, 'ph': 7.0}])
+        self.assertEqual(self.get(self.url, params)['X-Cache'], 'HIT')
+        self.assertEqual(self.get(self.url)['X-Cache'], 'MISS')
+
+    def test_updated_and_deleted_measurements_invalidate(self):
+        measurement = Measurement.objects.filter(system=self.system).first()
+        detail_url = f'{self.url}{measurement.id}/'
+        self.get(self.url)
+        self.write('patch', detail_url, {'ph': 5.0})
+        response = self.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn(5.0, [row['ph'] for row in response.json()['results']])
+        self.write('delete', detail_url)
+        self.assertEqual(self.get(self.url).json()['count'], 1)
+
+    def test_system_writes_invalidate(self):
+        url = f'{self.url}last-measurements/'
+        self.get(url, {'system_name': 'Sys1'})
+        self.get('/api/hydroponic-systems/')
+        self.write(
+            'patch', f'/api/hydroponic-systems/{self.system.id}/',
+            {'name': 'Renamed'})
+        response = self.client.get(url, {'system_name': 'Sys1'})
+        self.assertEqual(response.status_code, 404)
+        response = self.get('/api/hydroponic-systems/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertIn(
+            'Renamed', [row['name'] for row in response.json()['results']])
+        self.write(
+            'post', '/api/hydroponic-systems/',
+            {'name': 'New', 'description': 'New'})
+        self.assertEqual(
+            self.get('/api/hydroponic-systems/').json()['count'], 3)
+
+    def test_retention_invalidates(self):
+        self.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True), \
+                override_settings(MEASUREMENT_RETENTION={'RAW_DAYS': 0}):
+            apply_retention(now=timezone.now() + timedelta(days=2))
+        response = self.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_error_responses_are_not_cached(self):
+        url = f'{self.url}last-measurements/'
+        for _ in range(2):
+            response = self.client.get(url, {'system_name': 'Missing'})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response['X-Cache'], 'MISS')
+
+    @override_settings(RESPONSE_CACHE={'ENABLED': False})
+    def test_disabled(self):
+        self.get(self.url)
+        self.assertNotIn('X-Cache', self.get(self.url))
+
+    def test_stats(self):
+        self.get(self.url)
+        self.get(self.url)
+        self.get(self.url)
+        stats = get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 2 / 3)
+        out = StringIO()
+        call_command('response_cache_stats', '--reset', stdout=out)
+        self.assertIn('hits: 2, misses: 1', out.getvalue())
+        self.assertEqual(get_stats()['hits'], 0)
+
+
+@override_settings(RESPONSE_CACHE={'ENABLED': True, 'LOCK_WAIT': 1.0})
+class ResponseCacheStampedeTestCase(APITestCase):
+    key = 'response-cache:response:test'
+
+    def setUp(self):
+        cache.clear()
+        self.compute = mock.Mock(return_value=('value', 0.5))
+
+    def test_miss_computes_and_releases_the_lock(self):
+        self.assertEqual(
+            fetch(cache, self.key, self.compute), (('value', 0.5), False))
+        self.assertIsNone(cache.get(f'{self.key}:lock'))
+        self.assertEqual(
+            fetch(cache, self.key, self.compute), (('value', 0.5), True))
+        self.compute.assert_called_once()
+
+    def test_concurrent_miss_waits_for_the_value(self):
+        cache.add(f'{self.key}:lock', True)
+
+        def computed_elsewhere(seconds):
+            cache.set(self.key, ('other', 0.5))
+
+        with mock.patch(
+                'management.response_cache.time.sleep',
+                side_effect=computed_elsewhere):
+            self.assertEqual(
+                fetch(cache, self.key, self.compute), (('other', 0.5), True))
+        self.compute.assert_not_called()
+
+    def test_released_lock_without_value_stops_waiting(self):
+        cache.add(f'{self.key}:lock', True)
+
+        def failed_elsewhere(seconds):
+            cache.delete(f'{self.key}:lock')
+
+        with mock.patch(
+                'management.response_cache.time.sleep',
+                side_effect=failed_elsewhere) as sleep:
+            self.assertEqual(
+                fetch(cache, self.key, self.compute), (('value', 0.5), False))
+        sleep.assert_called_once()
+        self.compute.assert_called_once()
+
+    @override_settings(RESPONSE_CACHE={'ENABLED': True, 'LOCK_WAIT': 0.1})
+    def test_concurrent_miss_computes_after_waiting(self):
+        cache.add(f'{self.key}:lock', True)
+        self.assertEqual(
+            fetch(cache, self.key, self.compute), (('value', 0.5), False))
+        self.compute.assert_called_once()
+        self.assertTrue(cache.get(f'{self.key}:lock'))
+
+
+@override_settings(PRODUCTION=True, RESPONSE_CACHE={'ENABLED': True})
+class SharedCacheCheckTestCase(APITestCase):
+    def check_ids(self):
+        return [error.id for error in check_shared_cache(None)]
+
+    def test_process_local_cache_is_rejected_in_production(self):
+        self.assertEqual(self.check_ids(), ['management.E001'])
+        with override_settings(PRODUCTION=False):
+            self.assertEqual(self.check_ids(), [])
+        with override_settings(RESPONSE_CACHE={'ENABLED': False}):
+            self.assertEqual(self.check_ids(), [])
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/0'}})
+    def test_shared_cache_is_accepted(self):
+        self.assertEqual(self.check_ids(), [])
@@ -1,4 +1,27 @@
+from django.test import override_settings
+from django.urls import URLResolver
+from rest_framework import test
 from rest_framework.test import APIClient
+from hydroponics.authentication import user_cache
+from ..device_keys import device_key_cache
+
+# Makes requests exceeding the query budget of their view raise
+# `QueryBudgetExceeded`, see hydroponics/query_budget.py.
+enforce_query_budgets = override_settings(
+    QUERY_BUDGET={'ENABLED': True, 'RAISE': True})
+
+
+class APITestCase(test.APITestCase):
+    """
+    Starts every test with empty in-process caches, like it starts with
+    an empty mail outbox, so that query counts do not depend on the
+    order of the tests.
+    """
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        user_cache.clear()
+        device_key_cache.clear()
 
 
 def generate_jwt_token(
@@ -13,3 +36,29 @@ def generate_jwt_token(
     if response.status_code == 200:
         return response.json()
     return None
+
+
+def iter_endpoints(urlpatterns, prefix: str = ''):
+    """
+    Yield the route, view class and action or handler name of every
+    endpoint of `urlpatterns`, e.g. `('measurements/', MeasurementViewSet,
+    'list')`.
+    """
+    for pattern in urlpatterns:
+        route = prefix + str(pattern.pattern)
+        if isinstance(pattern, URLResolver):
+            yield from iter_endpoints(pattern.url_patterns, route)
+            continue
+        # Viewsets only set `cls`, other views set `view_class` too.
+        view_class = getattr(
+            pattern.callback, 'cls',
+            getattr(pattern.callback, 'view_class', None))
+        actions = getattr(pattern.callback, 'actions', None)
+        if actions is None:
+            actions = {
+                method: method
+                for method in view_class.http_method_names
+                if method not in ('head', 'options')
+                and hasattr(view_class, method)}
+        for name in actions.values():
+            yield route, view_class, name
@@ -1,10 +1,15 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from .async_views import (
+    AsyncLastMeasurementsView,
+    AsyncMeasurementView)
 from .views import (
+    APIRootView,
     HydroponicSystemViewSet,
     MeasurementViewSet)
 
 router = DefaultRouter()
+router.APIRootView = APIRootView
 router.register(
     r'hydroponic-systems',
     HydroponicSystemViewSet,
@@ -16,4 +21,12 @@ router.register(
 
 urlpatterns = [
     path('', include(router.urls)),
+    path(
+        'async/measurements/',
+        AsyncMeasurementView.as_view(),
+        name='async-measurement-list'),
+    path(
+        'async/measurements/last-measurements/',
+        AsyncLastMeasurementsView.as_view(),
+        name='async-measurement-last-measurements'),
 ]
@@ -1,10 +1,94 @@
-from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import User
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from .models import DeviceKey, HydroponicSystem
 
 
-def check_owner_permission(
-        request_user: User,
-        instance_owner: User) -> None:
-    if request_user != instance_owner:
-        raise PermissionDenied(
-            "You do not have permission for this action.")
+def parse_system_id(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class OwnedSystemCache:
+    """
+    Hydroponic systems of one user. Systems are looked up with queries
+    scoped to the owner, so a system which does not exist and a system
+    owned by someone else are both resolved to `None`, and each system
+    is looked up at most once.
+
+    With `only_system`, e.g. the system of a device key, that system is
+    the only one owned and nothing is looked up.
+    """
+
+    def __init__(self, user: User, only_system: HydroponicSystem = None):
+        self.user = user
+        self.only_system = only_system
+        self.systems = {}
+        if only_system is not None:
+            self.systems[only_system.pk] = only_system
+
+    def add(self, system: HydroponicSystem) -> None:
+        if self.only_system is None and system.owner_id == self.user.pk:
+            self.systems[system.pk] = system
+
+    def get(self, system_id):
+        system_id = parse_system_id(system_id)
+        if system_id is None:
+            return None
+        if system_id not in self.systems:
+            self.systems[system_id] = None if self.only_system else (
+                HydroponicSystem.objects.filter(
+                    pk=system_id, owner_id=self.user.pk).first())
+        return self.systems[system_id]
+
+    def owned_ids(self, system_ids) -> set:
+        """
+        Return the subset of `system_ids` owned by the user, looking up
+        all systems which are not cached yet with a single query. Values
+        which are not valid ids are ignored.
+        """
+        ids = {parse_system_id(system_id) for system_id in system_ids}
+        ids.discard(None)
+        missing = ids - self.systems.keys()
+        if missing and self.only_system is None:
+            for system in HydroponicSystem.objects.filter(
+                    owner_id=self.user.pk, id__in=missing):
+                self.systems[system.pk] = system
+        for system_id in missing - self.systems.keys():
+            self.systems[system_id] = None
+        return {
+            system_id for system_id in ids
+            if self.systems[system_id] is not None}
+
+
+def get_owned_systems(request) -> OwnedSystemCache:
+    """
+    Return the `OwnedSystemCache` of the request, created on first use.
+    """
+    cache = getattr(request, '_owned_systems', None)
+    if cache is None:
+        device_key = getattr(request, 'auth', None)
+        cache = request._owned_systems = OwnedSystemCache(
+            request.user,
+            device_key.system if isinstance(device_key, DeviceKey)
+            else None)
+    return cache
+
+
+def latest_per_system(queryset, num_measurements: int):
+    """
+    Limit a measurement queryset to the `num_measurements` latest
+    measurements of each system. The rows are numbered with
+    `ROW_NUMBER() OVER (PARTITION BY system_id ORDER BY timestamp DESC)`,
+    so the measurements of any number of systems are read in one query.
+    """
+    return queryset.annotate(
+        row_number=Window(
+            RowNumber(),
+            partition_by=F('system_id'),
+            order_by=[F('timestamp').desc(), F('id').desc()]),
+    ).filter(row_number__lte=num_measurements)
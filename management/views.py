@@ -1,22 +1,102 @@
 from rest_framework import (
+    routers,
     viewsets,
     permissions,
     filters,
+    exceptions,
     status)
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.authentication import (
+    JWTStatelessUserAuthentication)
 from .models import (
     HydroponicSystem,
     Measurement)
 from .serializers import (
+    MAX_BULK_MEASUREMENTS,
+    DeviceKeySerializer,
     HydroponicSystemSerializer,
-    MeasurementSerializer)
+    MeasurementBulkSerializer,
+    MeasurementSerializer,
+    measurement_values,
+    represent_measurements)
 from .filters import (
     HydroponicSystemFilter,
     MeasurementFilter)
-from .utils import check_owner_permission
+from .aggregates import (
+    BUCKET_UNITS,
+    aggregate_by_bucket,
+    aggregate_rollups,
+    format_bucket,
+    format_rollup_bucket,
+    parse_bucket,
+    rollup_model_for)
+from .buffer import BufferFull, get_measurement_buffer
+from .conditional import conditional_response
+from .device_keys import (
+    DeviceKeyAuthentication,
+    DeviceKeyScope,
+    create_device_key)
+from .downsampling import MIN_DOWNSAMPLE, downsample_measurements
+from .frames import (
+    MeasurementFrameParser,
+    MeasurementFrameRenderer,
+    MeasurementFrames,
+    clean_frame)
+from .ingest import (
+    CSV_CONTENT_TYPES,
+    INGEST_CHUNK_SIZE,
+    MAX_INGEST_CHUNK_SIZE,
+    NDJSON_CONTENT_TYPES,
+    ingest_rows,
+    iter_csv_rows,
+    iter_ndjson_rows)
+from .response_cache import cached_response, invalidate
+from .rollups import add_to_rollups, remove_from_rollups, truncate
+from .state import refresh_current_state, save_measurements
+from .utils import get_owned_systems, latest_per_system, parse_system_id
 from django_filters.rest_framework import DjangoFilterBackend
-from django.core.exceptions import ObjectDoesNotExist
+from hydroponics.authentication import get_jwt_authentication_settings
+from hydroponics.pagination import KeysetPagination
+from hydroponics.query_budget import UNLIMITED, query_budget
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import transaction
+from django.db.models import Prefetch, Q
+from copy import copy
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+
+MAX_LAST_MEASUREMENTS = 100
+MAX_AGGREGATE_BUCKETS = 10000
+RECENT_MEASUREMENTS = 10
+MAX_RECENT_MEASUREMENTS = 100
+MAX_LAST_MEASUREMENTS_SYSTEMS = 100
+MAX_DOWNSAMPLE = 10000
+# Actions which only need the id of the user, and can authenticate it
+# from the token claims with `STATELESS_INGEST` or with a device key.
+INGEST_ACTIONS = ('create', 'bulk', 'stream')
+
+
+def requested_system_ids(request):
+    """
+    Return the ids of the systems given in the `system` parameter, as
+    the scope of a cached response, or `None` when the response may
+    depend on all systems of the user.
+    """
+    system_ids = [
+        parse_system_id(value)
+        for values in request.query_params.getlist('system')
+        for value in values.split(',')]
+    if not system_ids or None in system_ids \
+            or 'system_name' in request.query_params:
+        return None
+    return system_ids
+
+
+class APIRootView(routers.APIRootView):
+    query_budgets = {'get': 1}
 
 
 class PaginationMixin:
@@ -26,6 +106,12 @@ class PaginationMixin:
 
 
 class BasePermissionViewSet(PaginationMixin, viewsets.ModelViewSet):
+    """
+    Querysets of subclasses are scoped to the requesting user, so the
+    lookup done by `get_object()` is also the ownership check of the
+    update and delete actions.
+    """
+
     permission_classes = [
         permissions.IsAuthenticated]
 
@@ -33,17 +119,6 @@ class BasePermissionViewSet(PaginationMixin, viewsets.ModelViewSet):
         serializer.save(
             owner=self.request.user)
 
-    def perform_destroy(self, instance):
-        check_owner_permission(
-            self.request.user, instance.owner)
-        instance.delete()
-
-    def perform_update(self, serializer):
-        instance = self.get_object()
-        check_owner_permission(
-            self.request.user, instance.owner)
-        serializer.save()
-
 
 class HydroponicSystemViewSet(BasePermissionViewSet):
     queryset = HydroponicSystem.objects.all()
@@ -53,55 +128,274 @@ class HydroponicSystemViewSet(BasePermissionViewSet):
         filters.SearchFilter]
     filterset_class = HydroponicSystemFilter
     search_fields = ['name', 'description']
+    # Read actions check the validators of conditional requests, see
+    # `management.conditional`, and cache misses look up the systems of
+    # the user, see `management.response_cache`.
+    query_budgets = {
+        'list': 6,
+        'create': 2,
+        'retrieve': 4,
+        'update': 4,
+        'partial_update': 4,
+        'destroy': 9,
+    }
 
     def get_queryset(self):
-        return HydroponicSystem.objects.filter(
-            owner=self.request.user)
+        queryset = HydroponicSystem.objects.filter(
+            owner=self.request.user).select_related(
+                'owner', 'current_state')
+        if self.action in (
+                'destroy', 'device_keys', 'revoke_device_key'):
+            return queryset
+        num_measurements = self.get_num_recent_measurements()
+        if not num_measurements:
+            return queryset
+        # A sliced prefetch numbers the measurements with a window
+        # function, so a page of systems costs one extra query.
+        return queryset.prefetch_related(Prefetch(
+            'measurements',
+            queryset=Measurement.objects.order_by(
+                '-timestamp', '-id')[:num_measurements],
+            to_attr='recent_measurements'))
+
+    def get_num_recent_measurements(self) -> int:
+        value = self.request.query_params.get(
+            'recent_measurements', RECENT_MEASUREMENTS)
+        try:
+            value = int(value)
+        except ValueError:
+            raise exceptions.ValidationError({
+                'recent_measurements': ['A valid integer is required.']})
+        return max(0, min(value, MAX_RECENT_MEASUREMENTS))
 
     def paginate_queryset(self, queryset):
         queryset = queryset.order_by('name')
         return super().paginate_queryset(queryset)
 
+    @conditional_response(last_modified=False)
+    @cached_response()
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_response()
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @action(
+            detail=True,
+            methods=['get', 'post'],
+            url_path='device-keys')
+    @query_budget(3)
+    def device_keys(self, request, pk=None):
+        """
+        List the device keys of the system, or create one. The key is
+        only returned when it is created.
+        """
+        system = self.get_object()
+        if request.method == 'GET':
+            return Response(DeviceKeySerializer(
+                system.device_keys.order_by('id'), many=True).data)
+        serializer = DeviceKeySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        device_key, key = create_device_key(
+            system, serializer.validated_data['name'])
+        return Response(
+            {**DeviceKeySerializer(device_key).data, 'key': key},
+            status=status.HTTP_201_CREATED)
+
+    @action(
+            detail=True,
+            methods=['delete'],
+            url_path=r'device-keys/(?P<key_id>[0-9]+)')
+    @query_budget(4)
+    def revoke_device_key(self, request, pk=None, key_id=None):
+        system = self.get_object()
+        deleted, _ = system.device_keys.filter(pk=key_id).delete()
+        if not deleted:
+            return Response({
+                "error": "Device key not found."},
+                status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        invalidate([serializer.instance.pk], [self.request.user.pk])
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        invalidate([serializer.instance.pk], [self.request.user.pk])
+
+    def perform_destroy(self, instance):
+        invalidate([instance.pk], [self.request.user.pk])
+        super().perform_destroy(instance)
+
 
 class MeasurementViewSet(BasePermissionViewSet):
     queryset = Measurement.objects.all()
     serializer_class = MeasurementSerializer
+    permission_classes = BasePermissionViewSet.permission_classes + [
+        DeviceKeyScope]
+    device_key_actions = INGEST_ACTIONS
     filter_backends = [
         DjangoFilterBackend,
         filters.OrderingFilter]
     filterset_class = MeasurementFilter
     ordering_fields = ['ph', 'temperature', 'tds', 'timestamp']
+    # Counts over the pagination count limit are planner estimates.
+    count_strategy = 'estimated'
+    # Moving a measurement refreshes the state and rollups of both
+    # systems and of both days, and in the worst case rebuilds the
+    # rollups it was removed from.
+    query_budgets = {
+        'list': 5,
+        'create': 3,
+        'retrieve': 3,
+        'update': 18,
+        'partial_update': 18,
+        'destroy': 13,
+    }
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [
+        MeasurementFrameRenderer]
+
+    @property
+    def pagination_class(self):
+        """
+        Keyset pagination is used with `?pagination=keyset`, page number
+        pagination otherwise.
+        """
+        request = getattr(self, 'request', None)
+        if request is not None and request.query_params.get(
+                'pagination') == 'keyset':
+            return KeysetPagination
+        return api_settings.DEFAULT_PAGINATION_CLASS
+
+    def initialize_request(self, request, *args, **kwargs):
+        request = super().initialize_request(request, *args, **kwargs)
+        if self.action in INGEST_ACTIONS:
+            authenticators = list(request.authenticators)
+            if get_jwt_authentication_settings()['STATELESS_INGEST']:
+                authenticators = [JWTStatelessUserAuthentication()]
+            request.authenticators = authenticators + [
+                DeviceKeyAuthentication()]
+        return request
 
     def get_queryset(self):
-        return Measurement.objects.filter(
+        queryset = Measurement.objects.filter(
             system__owner=self.request.user)
+        if self.detail:
+            queryset = queryset.select_related('system')
+        return queryset
 
-    def perform_create(self, serializer):
+    def get_object(self):
+        instance = super().get_object()
+        # The system was loaded by the scoped query, so validating an
+        # unchanged `system` on update needs no further lookup.
+        get_owned_systems(self.request).add(instance.system)
+        return instance
+
+    @conditional_response(requested_system_ids, last_modified=False)
+    @cached_response(requested_system_ids)
+    def list(self, request, *args, **kwargs):
+        """
+        Measurements are read as values and represented without the
+        serializer, which is much cheaper for large pages.
+        """
+        if 'downsample' in request.query_params:
+            return self.downsampled_list(request)
+        queryset = measurement_values(
+            self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(
+                represent_measurements(page))
+        return Response(represent_measurements(queryset))
+
+    @conditional_response()
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def downsampled_list(self, request):
+        """
+        Return at most `downsample` points per metric of the filtered
+        measurements of one system, selected with LTTB, unpaginated and
+        ordered by timestamp.
+        """
+        system_id = parse_system_id(request.query_params.get('system'))
+        if system_id is None:
+            return Response({
+                "error": "downsample requires a system."},
+                status=status.HTTP_400_BAD_REQUEST)
         try:
-            system = HydroponicSystem.objects.get(
-                id=self.request.data['system'])
-            check_owner_permission(
-                self.request.user,
-                system.owner)
-            serializer.save()
-        except ObjectDoesNotExist:
-            return Response(
-                {"error": "Hydroponic system not found."},
-                status=status.HTTP_404_NOT_FOUND)
+            threshold = int(request.query_params['downsample'])
+        except ValueError:
+            threshold = None
+        if threshold is None or not (
+                MIN_DOWNSAMPLE <= threshold <= MAX_DOWNSAMPLE):
+            return Response({
+                "error": (f"downsample must be an integer between "
+                          f"{MIN_DOWNSAMPLE} and {MAX_DOWNSAMPLE}.")},
+                status=status.HTTP_400_BAD_REQUEST)
 
-    def perform_update(self, serializer):
-        instance = self.get_object()
-        check_owner_permission(
-            self.request.user, instance.system.owner)
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response({
+            'system': system_id,
+            **downsample_measurements(queryset, threshold)})
+
+    def create(self, request, *args, **kwargs):
+        buffer = get_measurement_buffer()
+        if buffer is None:
+            return super().create(request, *args, **kwargs)
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        measurement = Measurement(**serializer.validated_data)
+        try:
+            buffer.put(measurement)
+        except BufferFull:
+            return Response({
+                "error": "Too many pending measurements, retry later."},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '1'})
+        return Response(
+            serializer.to_representation(measurement),
+            status=status.HTTP_202_ACCEPTED)
+
+    def perform_create(self, serializer):
         serializer.save()
 
+    def perform_update(self, serializer):
+        previous = copy(serializer.instance)
+        with transaction.atomic():
+            measurement = serializer.save()
+            if measurement.system_id == previous.system_id:
+                refresh_current_state(previous.system_id)
+                add_to_rollups(measurement)
+                remove_from_rollups(previous)
+                return
+            # Lock the rows of both systems in a fixed order to avoid
+            # deadlocks.
+            for system_id, count_delta, update_rollups in sorted([
+                    (previous.system_id, -1,
+                     partial(remove_from_rollups, previous)),
+                    (measurement.system_id, 1,
+                     partial(add_to_rollups, measurement))],
+                    key=itemgetter(0)):
+                refresh_current_state(system_id, count_delta)
+                update_rollups()
+
     def perform_destroy(self, instance):
-        instance.delete()
+        with transaction.atomic():
+            instance.delete()
+            refresh_current_state(instance.system_id, -1)
+            remove_from_rollups(instance)
 
     @action(
             detail=False,
             methods=['get'],
             url_path='last-measurements')
+    @query_budget(5)
+    @conditional_response()
+    @cached_response()
     def last_measurements(self, request):
         system_name = request.query_params.get('system_name')
         num_measurements = request.query_params.get(
@@ -117,12 +411,253 @@ class MeasurementViewSet(BasePermissionViewSet):
         try:
             system = HydroponicSystem.objects.get(
                 name=system_name, owner=request.user)
-            measurements = Measurement.objects.filter(
-                system=system).order_by(
-                    '-timestamp')[:num_measurements]
-            serializer = MeasurementSerializer(measurements, many=True)
-            return Response(serializer.data)
+            measurements = measurement_values(
+                Measurement.objects.filter(system=system).order_by(
+                    '-timestamp', '-id'))[:num_measurements]
+            return Response(represent_measurements(measurements))
         except ObjectDoesNotExist:
             return Response({
                 "error": "System not found or you do not have permission."},
                 status=status.HTTP_404_NOT_FOUND)
+
+    @action(
+            detail=False,
+            methods=['get'],
+            url_path='last-measurements-by-system')
+    @query_budget(4)
+    @conditional_response(requested_system_ids, last_modified=False)
+    @cached_response(requested_system_ids)
+    def last_measurements_by_system(self, request):
+        """
+        Return the last `num_measurements` measurements of each system
+        given by id in `system` or by name in `system_name`. Both can be
+        repeated or comma separated. All systems are read with a single
+        windowed query, and systems without measurements are omitted.
+        """
+        def get_list(name):
+            return [
+                value.strip()
+                for values in request.query_params.getlist(name)
+                for value in values.split(',')
+                if value.strip()]
+
+        system_ids = [
+            parse_system_id(value) for value in get_list('system')]
+        system_names = get_list('system_name')
+        if None in system_ids:
+            return Response({
+                "error": "system must be a list of integers."},
+                status=status.HTTP_400_BAD_REQUEST)
+        if not system_ids and not system_names:
+            return Response({
+                "error": "system or system_name is required."},
+                status=status.HTTP_400_BAD_REQUEST)
+        if len(system_ids) + len(system_names) > \
+                MAX_LAST_MEASUREMENTS_SYSTEMS:
+            return Response({
+                "error": (f"At most {MAX_LAST_MEASUREMENTS_SYSTEMS} "
+                          f"systems can be requested.")},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            num_measurements = int(
+                request.query_params.get('num_measurements', 10))
+        except ValueError:
+            return Response({
+                "error": "num_measurements must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= num_measurements <= MAX_LAST_MEASUREMENTS:
+            return Response({
+                "error": (f"num_measurements must be between 1 and "
+                          f"{MAX_LAST_MEASUREMENTS}.")},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        measurements = measurement_values(latest_per_system(
+            Measurement.objects.filter(
+                Q(system_id__in=system_ids)
+                | Q(system__name__in=system_names),
+                system__owner=request.user),
+            num_measurements).order_by('system_id', '-timestamp', '-id'))
+        return Response([
+            {'system': system_id,
+             'measurements': represent_measurements(rows)}
+            for system_id, rows in groupby(
+                measurements, key=lambda row: row['system_id'])])
+
+    @action(
+            detail=False,
+            methods=['get'],
+            url_path='aggregate')
+    @query_budget(4)
+    @conditional_response(requested_system_ids, last_modified=False)
+    def aggregate(self, request):
+        """
+        Return min, max, avg, stddev and count of every metric per system
+        and time bucket, for the measurements selected by the
+        `MeasurementFilter` parameters. The `bucket` parameter is one of
+        minute, hour, day or a custom interval such as 15m, 6h or 2d.
+        Buckets of whole hours or days are combined from the rollups
+        unless `source=raw` is given.
+        """
+        bucket = parse_bucket(request.query_params.get('bucket', 'hour'))
+        if bucket is None:
+            return Response({
+                "error": ("bucket must be one of "
+                          + ", ".join(BUCKET_UNITS)
+                          + " or an interval such as 15m, 6h or 2d.")},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        rollups = self.get_rollup_queryset(bucket)
+        if rollups is not None:
+            rows = aggregate_rollups(rollups, bucket)
+            format_row = format_rollup_bucket
+        else:
+            rows = aggregate_by_bucket(
+                self.filter_queryset(self.get_queryset()), bucket)
+            format_row = format_bucket
+        rows = list(rows[:MAX_AGGREGATE_BUCKETS + 1])
+        if len(rows) > MAX_AGGREGATE_BUCKETS:
+            return Response({
+                "error": (f"More than {MAX_AGGREGATE_BUCKETS} buckets, "
+                          f"narrow the range or use larger buckets.")},
+                status=status.HTTP_400_BAD_REQUEST)
+        return Response([format_row(row) for row in rows])
+
+    def get_rollup_queryset(self, bucket):
+        """
+        Return the rollups to aggregate instead of the measurements, or
+        `None` when the measurements are needed: for buckets finer than
+        an hour, filters on metric values and ranges which are not
+        aligned to the rollup buckets.
+        """
+        model = rollup_model_for(bucket)
+        if model is None or self.request.query_params.get('source') == 'raw':
+            return None
+        filterset = MeasurementFilter(
+            self.request.query_params,
+            queryset=self.get_queryset(),
+            request=self.request)
+        if not filterset.is_valid():
+            return None
+        filters = {
+            name: value
+            for name, value in filterset.form.cleaned_data.items()
+            if value not in (None, '')}
+        if filters.keys() - {'system', 'timestamp_min', 'timestamp_max'}:
+            return None
+
+        queryset = model.objects.filter(system__owner=self.request.user)
+        if 'system' in filters:
+            queryset = queryset.filter(system=filters['system'])
+        for name, lookup in (
+                ('timestamp_min', 'gte'), ('timestamp_max', 'lt')):
+            value = filters.get(name)
+            if value is None:
+                continue
+            if truncate(value, model.bucket_unit) != value:
+                return None
+            queryset = queryset.filter(**{f'bucket__{lookup}': value})
+        return queryset
+
+    @action(
+            detail=False,
+            methods=['post'],
+            url_path='bulk',
+            parser_classes=api_settings.DEFAULT_PARSER_CLASSES + [
+                MeasurementFrameParser])
+    @query_budget(5)
+    def bulk(self, request):
+        rows = request.data
+        if isinstance(rows, MeasurementFrames):
+            return self.bulk_frames(request, rows)
+        system_ids = get_owned_systems(request).owned_ids(
+            [row.get('system') for row in rows if isinstance(row, dict)]
+            if isinstance(rows, list) else [])
+        serializer = MeasurementBulkSerializer(
+            data=rows,
+            many=True,
+            max_length=MAX_BULK_MEASUREMENTS,
+            context={'owned_system_ids': system_ids})
+
+        if not serializer.is_valid():
+            errors = serializer.errors
+            if isinstance(errors, list):
+                errors = [
+                    {'index': index, 'errors': row_errors}
+                    for index, row_errors in enumerate(errors)
+                    if row_errors]
+            return Response(
+                {"errors": errors},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            serializer.save()
+        return Response(
+            {"accepted": len(serializer.validated_data)},
+            status=status.HTTP_201_CREATED)
+
+    def bulk_frames(self, request, frames):
+        if len(frames) > MAX_BULK_MEASUREMENTS:
+            return Response({
+                "errors": {"non_field_errors": [
+                    f"Ensure this field has no more than "
+                    f"{MAX_BULK_MEASUREMENTS} elements."]}},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        system_ids = get_owned_systems(request).owned_ids(
+            frames.system_ids())
+        measurements = []
+        errors = []
+        for index, frame in enumerate(frames):
+            try:
+                measurements.append(clean_frame(frame, system_ids))
+            except ValidationError as error:
+                errors.append(
+                    {'index': index, 'errors': error.message_dict})
+        if errors:
+            return Response(
+                {"errors": errors},
+                status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            save_measurements(measurements)
+        return Response(
+            {"accepted": len(measurements)},
+            status=status.HTTP_201_CREATED)
+
+    @action(
+            detail=False,
+            methods=['post'],
+            url_path='stream')
+    # One insert per chunk and one ownership check per system.
+    @query_budget(UNLIMITED)
+    def stream(self, request):
+        content_type = request.content_type.split(';')[0].strip().lower()
+        if content_type in NDJSON_CONTENT_TYPES:
+            iter_rows = iter_ndjson_rows
+        elif content_type in CSV_CONTENT_TYPES:
+            iter_rows = iter_csv_rows
+        else:
+            return Response({
+                "error": ("Content type must be one of: "
+                          + ", ".join(
+                              NDJSON_CONTENT_TYPES + CSV_CONTENT_TYPES)
+                          + ".")},
+                status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        chunk_size = request.query_params.get(
+            'chunk_size', INGEST_CHUNK_SIZE)
+        try:
+            chunk_size = int(chunk_size)
+        except ValueError:
+            return Response({
+                "error": "chunk_size must be an integer."},
+                status=status.HTTP_400_BAD_REQUEST)
+        chunk_size = max(1, min(chunk_size, MAX_INGEST_CHUNK_SIZE))
+
+        # Read the body straight from the request stream, so that it is
+        # never held in memory as a whole by `request.data`.
+        stream = request.stream
+        rows = iter_rows(stream) if stream is not None else []
+        summary = ingest_rows(get_owned_systems(request), rows, chunk_size)
+        return Response(summary, status=status.HTTP_200_OK)